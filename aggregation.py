@@ -0,0 +1,234 @@
+# aggregation.py
+"""
+对网格变量在一段时间范围内做统计：平均、最大/最小值、百分位数、AR 出现次数，
+以及相对月气候态的距平。
+
+计算按时间块在 dask 本地调度器上并行进行，归约逐块合并，不会把整段时间范围
+一次读入内存；按日、按月等分组的结果以流式方式写入磁盘。结果以
+(文件指纹, 变量, 时间范围, 统计方式) 为键缓存在 AGG_CACHE_DIR 中，重复请求
+直接读取缓存。
+
+用法:
+    python aggregation.py ERA5.nc --var ivt --op max --freq 1D --out ivt_daily_max.nc
+    python aggregation.py ERA5_AR.nc --var shapemap --op ar_count --start 0 --end 1439
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import dask
+import numpy as np
+import xarray as xr
+
+from derived import add_derived_variables
+from data_loader import load_dataset_from_path, open_source
+from frame_store import is_frame_store, open_frame_store
+from labels import ar_mask, label_fill_values
+from multifile import is_multifile_pattern, match_files
+
+# 统计结果的磁盘缓存目录
+AGG_CACHE_DIR = os.environ.get('AR_VIS_AGG_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ar_vis_aggregates'))
+
+# 缓存结果的版本，统计规则改变时递增，旧版本的缓存不再读取
+AGG_CACHE_VERSION = 2
+
+# 可用的统计方式及其显示名称
+AGGREGATE_OPS = {
+    'mean': '时间平均',
+    'max': '最大值',
+    'min': '最小值',
+    'percentile': '百分位数',
+    'ar_count': 'AR 出现次数',
+    'anomaly': '相对气候态距平',
+}
+
+# 归约时每个 dask 块包含的时间步数
+AGG_TIME_CHUNK = 64
+
+# 百分位数需要整段时间序列，按纬度带分块时每块允许占用的内存（字节）
+PERCENTILE_BLOCK_BYTES = 256 * 1024 ** 2
+
+
+def source_fingerprint(source):
+    """
+    返回数据文件的指纹（路径、大小、修改时间的哈希），用作缓存键的一部分。
+
+    source 不是磁盘上的文件或目录（例如浏览器上传后只保存在内存中的文件）时返回 None，
+    这类数据不做磁盘缓存。source 为多文件的 glob 模式时，指纹包含全部匹配文件。
+    """
+    if is_multifile_pattern(source):
+        paths = match_files(source)
+        if not paths:
+            return None
+        key = '|'.join(f"{path}|{os.path.getsize(path)}|{os.path.getmtime(path)}" for path in paths)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+    if not source or not os.path.exists(source):
+        return None
+    stat = os.stat(source)
+    key = f"{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def open_in_time_blocks(source, time_chunk=AGG_TIME_CHUNK):
+    """
+    从磁盘重新打开数据，按 time_chunk 个时间步分块，使每个存储块只解压一次。
+    派生变量同样加入，其逐时间步结果与应用中打开的数据集共用缓存。
+    """
+    chunks = {'time': time_chunk}
+    if is_frame_store(source):
+        return add_derived_variables(open_frame_store(source, chunks=chunks))
+    return add_derived_variables(open_source(source, chunks=chunks))
+
+
+def _cache_path(fingerprint, var_name, start, end, op, q, freq):
+    key = json.dumps([AGG_CACHE_VERSION, fingerprint, var_name, start, end, op, q, freq])
+    return os.path.join(AGG_CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.nc')
+
+
+def _percentile(da, q, freq):
+    # 分位数要求时间维在同一个块中，因此改为按纬度带分块
+    row_bytes = da.sizes['time'] * da.sizes['lon'] * da.dtype.itemsize
+    band = int(max(1, min(da.sizes['lat'], PERCENTILE_BLOCK_BYTES // max(row_bytes, 1))))
+    da = da.chunk({'time': -1, 'lat': band})
+    if freq:
+        return da.resample(time=freq).quantile(q / 100, dim='time', skipna=True).drop_vars('quantile')
+    return da.quantile(q / 100, dim='time', skipna=True).drop_vars('quantile')
+
+
+def _climatology(da):
+    """逐月气候态：整段记录中每个日历月份的平均场。"""
+    return da.groupby('time.month').mean('time')
+
+
+def _reduce(da, op, q=None, freq=None, climatology=None):
+    """返回描述统计计算的惰性 DataArray。"""
+    if op == 'percentile':
+        return _percentile(da, q, freq)
+    if op == 'ar_count':
+        # shapemap 中非 NaN 且不等于填充值的格点属于某个 AR（见 labels.ar_mask）
+        da = ar_mask(da, label_fill_values(da)).astype(np.int32)
+        return da.resample(time=freq).sum() if freq else da.sum('time')
+    if op == 'anomaly':
+        # 每个时间步减去对应月份的气候态，再求平均
+        da = (da.groupby('time.month') - climatology).drop_vars('month')
+        op = 'mean'
+    reducer = da.resample(time=freq) if freq else da
+    if op == 'mean':
+        return reducer.mean('time', skipna=True)
+    if op == 'max':
+        return reducer.max('time', skipna=True)
+    if op == 'min':
+        return reducer.min('time', skipna=True)
+    raise ValueError(f"不支持的统计方式: {op}")
+
+
+def aggregate(ds, var_name, op, start=0, end=None, q=None, freq=None, source=None, scheduler='threads',
+              num_workers=None):
+    """
+    计算网格变量在时间范围 [start, end] 内的统计结果。
+
+    参数:
+    - ds (xarray.Dataset): 惰性打开的数据集。
+    - var_name (str): (time, lat, lon) 变量名。
+    - op (str): AGGREGATE_OPS 中的统计方式。
+    - start, end (int): 起止时间步索引（均包含），end 默认为最后一个时间步。
+    - q (float): op 为 percentile 时的百分位数（0-100）。
+    - freq (str): 分组频率，例如 '1D'、'1MS'；为 None 时对整个范围归约为一张图。
+    - source (str): 数据文件路径，用于磁盘缓存的键；为 None 时不缓存。
+    - scheduler (str): dask 本地调度器，'threads' 或 'processes'。
+    - num_workers (int): 并行数，默认为 CPU 核数。
+
+    返回:
+    - xarray.DataArray: 不分组时为 (lat, lon)，分组时为 (time, lat, lon)，纬度保持源文件顺序。
+    """
+    if op not in AGGREGATE_OPS:
+        raise ValueError(f"不支持的统计方式: {op}")
+    if op == 'percentile' and (q is None or not 0 <= q <= 100):
+        raise ValueError("百分位数需在 0 到 100 之间")
+    n_times = ds.sizes['time']
+    end = n_times - 1 if end is None else min(int(end), n_times - 1)
+    start = max(0, int(start))
+    if start > end:
+        raise ValueError("时间范围为空")
+    q = float(q) if op == 'percentile' else None
+
+    fingerprint = source_fingerprint(source)
+    path = _cache_path(fingerprint, var_name, start, end, op, q, freq) if fingerprint else None
+    if path is not None and os.path.exists(path):
+        return _read_cached(path, var_name)
+
+    # 应用中打开的数据集按单个时间步分块，文件在磁盘上时改为按时间块重新打开
+    started = time.perf_counter()
+    blocked = open_in_time_blocks(source) if fingerprint else None
+    try:
+        da = (blocked if blocked is not None else ds)[var_name].transpose('time', 'lat', 'lon')
+        climatology = None
+        if op == 'anomaly':
+            # 气候态取整段记录，与所选时间范围无关，单独缓存
+            climatology_path = _cache_path(fingerprint, var_name, 0, n_times - 1, 'climatology', None, None) \
+                if fingerprint else None
+            climatology = _compute(_climatology(da.chunk({'time': AGG_TIME_CHUNK})).rename(var_name),
+                                   climatology_path, scheduler, num_workers)
+        result = _reduce(da.isel(time=slice(start, end + 1)).chunk({'time': AGG_TIME_CHUNK}), op, q, freq,
+                         climatology)
+        result = result.rename(var_name)
+        result.attrs = dict(ds[var_name].attrs, aggregation=op, time_range=f"{start}-{end}")
+
+        result = _compute(result, path, scheduler, num_workers)
+    finally:
+        if blocked is not None:
+            blocked.close()
+    print(f"统计 {var_name} {AGGREGATE_OPS[op]} [{start}, {end}]"
+          f"{f' 按 {freq} 分组' if freq else ''} 用时 {time.perf_counter() - started:.1f} 秒")
+    return result
+
+
+def _read_cached(path, var_name):
+    with xr.open_dataset(path) as cached:
+        return cached[var_name].load()
+
+
+def _compute(result, path, scheduler, num_workers):
+    """在 dask 本地调度器上计算惰性结果；给出缓存路径时逐块写入磁盘后再读回。"""
+    if path is not None and os.path.exists(path):
+        return _read_cached(path, result.name)
+    with dask.config.set(scheduler=scheduler, num_workers=num_workers or os.cpu_count()):
+        if path is None:
+            return result.load()
+        os.makedirs(AGG_CACHE_DIR, exist_ok=True)
+        result.to_dataset().to_netcdf(path + '.tmp', format='NETCDF4')
+    os.replace(path + '.tmp', path)
+    return _read_cached(path, result.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='计算网格变量在一段时间内的统计结果')
+    parser.add_argument('source', help='数据文件或逐帧存储目录')
+    parser.add_argument('--var', required=True, help='(time, lat, lon) 变量名')
+    parser.add_argument('--op', choices=list(AGGREGATE_OPS), default='mean', help='统计方式')
+    parser.add_argument('--q', type=float, default=95, help='op 为 percentile 时的百分位数')
+    parser.add_argument('--start', type=int, default=0, help='起始时间步索引')
+    parser.add_argument('--end', type=int, default=None, help='结束时间步索引（包含）')
+    parser.add_argument('--freq', default=None, help="分组频率，例如 1D（逐日）、1MS（逐月）")
+    parser.add_argument('--scheduler', choices=('threads', 'processes'), default='threads', help='dask 调度器')
+    parser.add_argument('--workers', type=int, default=None, help='并行数')
+    parser.add_argument('--out', default=None, help='结果另存为 NetCDF 文件')
+    args = parser.parse_args()
+
+    ds = load_dataset_from_path(args.source)[0]
+    if ds is None:
+        raise SystemExit(f"无法打开 {args.source}")
+    result = aggregate(ds, args.var, args.op, args.start, args.end, args.q, args.freq, source=args.source,
+                       scheduler=args.scheduler, num_workers=args.workers)
+    if args.out:
+        result.to_netcdf(args.out)
+        print(f"结果已写入 {args.out}")
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,39 @@
+import os
 import dash
 from layout import app_layout
 from callbacks import register_callbacks
+from ingest import register_ingest_routes
+from metrics import register_metrics_routes
 
-app = dash.Dash(__name__)
-app.layout = app_layout
-register_callbacks(app)
+
+def create_app(shared_datasets=False):
+    """
+    创建并配置 Dash 应用。
+
+    参数:
+    - shared_datasets (bool): 多进程部署时为 True，加载的数据集通过共享目录在各 worker 间共享
+      （见 shared_store.py）。
+
+    返回:
+    - dash.Dash: 配置好布局、回调和附加接口的应用。
+    """
+    app = dash.Dash(__name__)
+    app.layout = app_layout
+    register_callbacks(app, shared_datasets=shared_datasets)
+    register_ingest_routes(app.server)
+    register_metrics_routes(app)
+    return app
+
+
+def create_server():
+    """
+    供多进程 WSGI 服务器使用的入口，例如：
+    gunicorn -w 4 -b 0.0.0.0:8050 "app:create_server()"
+    """
+    return create_app(shared_datasets=True).server
+
+
+app = create_app(shared_datasets=os.environ.get('AR_VIS_SHARED_DATASETS') == '1')
 
 if __name__ == '__main__':
     app.run(debug=True)
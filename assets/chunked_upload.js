@@ -0,0 +1,73 @@
+// chunked_upload.js
+// 将大文件按块流式上传到服务器临时目录，避免 dcc.Upload 的 base64 编码和整文件内存拷贝。
+(function () {
+    var CHUNK_SIZE = 8 * 1024 * 1024;
+
+    function randomUploadId() {
+        var bytes = new Uint8Array(16);
+        window.crypto.getRandomValues(bytes);
+        return Array.from(bytes, function (b) {
+            return ('0' + b.toString(16)).slice(-2);
+        }).join('');
+    }
+
+    function setProgress(text) {
+        var el = document.getElementById('stream-upload-progress');
+        if (el) {
+            el.textContent = text;
+        }
+    }
+
+    async function uploadFile(file) {
+        var uploadId = randomUploadId();
+        for (var offset = 0; offset < file.size; offset += CHUNK_SIZE) {
+            var response = await fetch('/upload/' + uploadId + '/chunk?offset=' + offset, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/octet-stream'},
+                body: file.slice(offset, offset + CHUNK_SIZE)
+            });
+            if (!response.ok) {
+                throw new Error('分块上传失败 (HTTP ' + response.status + ')');
+            }
+            var sent = Math.min(offset + CHUNK_SIZE, file.size);
+            setProgress('正在上传 ' + file.name + ': ' + (sent / file.size * 100).toFixed(1) + '%');
+        }
+
+        var complete = await fetch('/upload/' + uploadId + '/complete', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({filename: file.name, size: file.size})
+        });
+        var result = await complete.json();
+        if (!complete.ok) {
+            throw new Error(result.error || ('HTTP ' + complete.status));
+        }
+        return result;
+    }
+
+    document.addEventListener('click', function (event) {
+        var button = event.target && event.target.closest('#stream-upload-button');
+        if (!button) {
+            return;
+        }
+        var input = document.createElement('input');
+        input.type = 'file';
+        input.accept = '.nc,.nc4,.netcdf,.grib,.grib2,.grb,.grb2';
+        input.addEventListener('change', function () {
+            if (!input.files.length) {
+                return;
+            }
+            var file = input.files[0];
+            uploadFile(file).then(function (result) {
+                setProgress('已上传文件: ' + file.name + '，正在处理中...');
+                // 通知服务器端回调从临时文件打开数据集
+                window.dash_clientside.set_props('stream-upload-store', {
+                    data: {upload_id: result.upload_id, filename: result.filename}
+                });
+            }).catch(function (err) {
+                setProgress('上传失败: ' + err.message);
+            });
+        });
+        input.click();
+    });
+})();
@@ -0,0 +1,124 @@
+// playback.js
+// 客户端播放引擎：播放、暂停、逐帧切换以及播放窗口内的帧都在浏览器中完成，
+// 只有窗口外的帧和下一个播放窗口才需要请求服务器。
+(function () {
+    // 服务器请求超过该时间仍未返回时不再等待，继续播放
+    var REQUEST_TIMEOUT_MS = 5000;
+
+    // base64 类型化数组 {dtype, bdata} 和 TypedArray 是完整的数组值，不按嵌套对象合并
+    function isPlainObject(value) {
+        return value !== null && typeof value === 'object' && !Array.isArray(value) &&
+            !ArrayBuffer.isView(value) && !('bdata' in value);
+    }
+
+    // 将逐帧更新的属性合并到轨迹中，嵌套对象（如 marker）只更新其中的子属性
+    function mergeProps(target, props) {
+        Object.keys(props).forEach(function (key) {
+            var value = props[key];
+            if (isPlainObject(value) && isPlainObject(target[key])) {
+                target[key] = mergeProps(Object.assign({}, target[key]), value);
+            } else {
+                target[key] = value;
+            }
+        });
+        return target;
+    }
+
+    function windowFor(windowData, storedData) {
+        if (!windowData || !storedData || windowData.dataset_id !== storedData.dataset_id) {
+            return null;
+        }
+        return windowData;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        playback: {
+            control: function (playN, pauseN, nextN, prevN, currentIndex, maxIndex, storedData) {
+                var noUpdate = window.dash_clientside.no_update;
+                if (!storedData) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                var buttonId = window.dash_clientside.callback_context.triggered_id;
+                if (buttonId === 'play-button') {
+                    return [false, noUpdate];
+                } else if (buttonId === 'pause-button') {
+                    return [true, noUpdate];
+                } else if (buttonId === 'next-button') {
+                    return [true, currentIndex < maxIndex ? currentIndex + 1 : maxIndex];
+                } else if (buttonId === 'prev-button') {
+                    return [true, currentIndex > 0 ? currentIndex - 1 : 0];
+                }
+                throw window.dash_clientside.PreventUpdate;
+            },
+
+            advance: function (nIntervals, currentIndex, maxIndex, windowData, windowRequest, storedData, variable) {
+                var noUpdate = window.dash_clientside.no_update;
+                if (!storedData) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                var nTimes = maxIndex + 1;
+                var next = currentIndex < maxIndex ? currentIndex + 1 : 0;
+                if (variable !== 'Combined') {
+                    // 播放窗口只有综合图才有，网格变量逐帧由服务器渲染，不请求窗口
+                    return [next, noUpdate];
+                }
+                var current = windowFor(windowData, storedData);
+                var now = Date.now();
+
+                if (current && current.frames.hasOwnProperty(next)) {
+                    // 当前窗口快播放完时，提前请求从当前位置开始的下一个窗口
+                    var remaining = (current.last - next + nTimes) % nTimes;
+                    var requested = windowRequest && windowRequest.start === next;
+                    var complete = Object.keys(current.frames).length >= nTimes;
+                    if (remaining < current.margin && !complete && !requested && current.start !== next) {
+                        return [next, {start: next, ts: now}];
+                    }
+                    return [next, noUpdate];
+                }
+
+                // 下一帧所在的窗口已经请求但尚未返回时暂停推进，像视频缓冲一样等待
+                var pending = windowRequest && windowRequest.start === next &&
+                    (!current || current.start !== next) && now - windowRequest.ts < REQUEST_TIMEOUT_MS;
+                if (pending) {
+                    return [noUpdate, noUpdate];
+                }
+                if (current && current.start === next) {
+                    // 窗口已返回但不包含该帧，交由服务器逐帧渲染
+                    return [next, noUpdate];
+                }
+                return [next, {start: next, ts: now}];
+            },
+
+            show_frame: function (timeIndex, variable, windowData, figure, layoutState, storedData) {
+                var noUpdate = window.dash_clientside.no_update;
+                var current = windowFor(windowData, storedData);
+                var frame = null;
+                if (variable === 'Combined' && current && figure && layoutState &&
+                    layoutState.dataset_id === current.dataset_id && layoutState.slots === current.slots &&
+                    (layoutState.outline || null) === (current.outline || null) &&
+                    JSON.stringify(layoutState.viewport || null) === JSON.stringify(current.viewport || null)) {
+                    frame = current.frames[timeIndex] || null;
+                }
+                if (frame === null) {
+                    // 窗口中没有该帧，请求服务器渲染
+                    return [noUpdate, noUpdate, {index: timeIndex, variable: variable, ts: Date.now()}];
+                }
+
+                var fig = Object.assign({}, figure, {data: figure.data.slice()});
+                frame.updates.forEach(function (update) {
+                    fig.data[update[0]] = mergeProps(Object.assign({}, fig.data[update[0]]), update[1]);
+                });
+                var layout = figure.layout || {};
+                fig.layout = Object.assign({}, layout, {title: Object.assign({}, layout.title, {text: frame.title})});
+                return [fig, frame.time_display, noUpdate];
+            },
+
+            set_interval: function (fps) {
+                if (!fps || fps <= 0) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                return Math.round(1000 / fps);
+            }
+        }
+    });
+})();
@@ -0,0 +1,391 @@
+# benchmark.py
+"""
+基于合成数据（synthetic.py）的性能基准测试。
+
+对每组网格大小、时间步数和 AR 密度生成一个数据文件，测量:
+- 加载耗时和峰值内存：从服务器路径打开，以及浏览器上传（base64 解码）两种方式；
+- 逐帧渲染耗时：create_combined_ar_figure 和网格场 create_field_figure；
+- AR 轨迹索引中紧凑存储的标签场和逐 AR 变量的大小（与稠密存储相比），以及从中渲染的耗时；
+- 序列化后的图形大小：完整图形和逐帧增量更新 (Patch)；
+- 回调的请求/响应字节数和耗时：通过 Flask 测试客户端调用 update_output 和 update_graph，
+  与浏览器发出的请求相同。
+
+结果保存为 JSON，可以与之前的结果比较:
+    python benchmark.py --preset small medium --out after.json --compare before.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+
+import numpy as np
+import plotly
+import plotly.io
+import psutil
+from dash._utils import split_callback_id
+
+import ingest
+from app import app
+from data_loader import load_dataset, load_dataset_from_path
+from frame_cache import frame_cache
+from layout import initial_figure as base_figure
+from plot_functions import (count_ar_slots, create_combined_ar_figure, create_combined_ar_patch, create_field_figure,
+                            field_coarsening_factor, outline_tolerance)
+from spatial_index import frame_index_cache, geo_viewport
+from synthetic import parse_grid, write_synthetic
+from tracks import AXIS_VARIABLES, LABEL_VARIABLE, TRACK_COLUMNS, build_track_index
+
+# 预设的测试规模：(纬度格点数, 经度格点数, 时间步数, 平均 AR 个数)
+BENCHMARK_PRESETS = {
+    'small': (181, 360, 24, 15),
+    'medium': (361, 720, 48, 25),
+    'large': (721, 1440, 24, 40),
+}
+
+# 局部视口测试使用的地图视图：(缩放比例, 中心经度, 中心纬度)，约为北太平洋
+BENCHMARK_VIEW = (6.0, 200.0, 40.0)
+
+# 内存采样间隔（秒）
+MEMORY_SAMPLE_INTERVAL = 0.005
+
+
+class PeakMemory:
+    """
+    在后台线程中定期采样进程的常驻内存，记录 with 代码块执行期间的峰值。
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.process.memory_info().rss
+        self.peak = self.baseline
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    @property
+    def peak_mb(self):
+        return self.peak / 1024 ** 2
+
+    @property
+    def delta_mb(self):
+        return (self.peak - self.baseline) / 1024 ** 2
+
+
+def _stats(samples_ms):
+    samples = np.asarray(samples_ms, dtype=float)
+    return {'mean': float(samples.mean()), 'p50': float(np.percentile(samples, 50)),
+            'p95': float(np.percentile(samples, 95)), 'max': float(samples.max()), 'n': len(samples)}
+
+
+def _json_size(obj):
+    """按 Dash 发送给浏览器的方式序列化后的字节数。"""
+    return len(plotly.io.json.to_json_plotly(obj).encode('utf-8'))
+
+
+def _frame_indices(n_times, n_frames):
+    return np.unique(np.linspace(0, n_times - 1, min(n_frames, n_times)).astype(int))
+
+
+def benchmark_load(path):
+    """从服务器路径和 base64 上传两种方式打开文件的耗时和峰值内存。"""
+    results = {}
+    with PeakMemory() as memory:
+        started = time.perf_counter()
+        ds = load_dataset_from_path(path)[0]
+        elapsed = time.perf_counter() - started
+    ds.close()
+    results['path'] = {'ms': elapsed * 1000, 'peak_rss_mb': memory.peak_mb, 'delta_rss_mb': memory.delta_mb}
+
+    with open(path, 'rb') as f:
+        contents = 'data:application/x-netcdf;base64,' + base64.b64encode(f.read()).decode('ascii')
+    with PeakMemory() as memory:
+        started = time.perf_counter()
+        ds = load_dataset(contents, os.path.basename(path))[0]
+        elapsed = time.perf_counter() - started
+    ds.close()
+    results['upload'] = {'ms': elapsed * 1000, 'peak_rss_mb': memory.peak_mb, 'delta_rss_mb': memory.delta_mb,
+                         'request_bytes': len(contents)}
+    return results
+
+
+def benchmark_render(path, n_frames):
+    """逐帧渲染耗时及序列化后的完整图形和增量更新大小，不经过帧缓存。"""
+    ds, time_coords, lons, lats, _ = load_dataset_from_path(path)
+    indices = _frame_indices(len(time_coords), n_frames)
+    render_ms, figure_bytes, patch_bytes, serialize_ms = [], [], [], []
+    with PeakMemory() as memory:
+        slots = None
+        for index in indices:
+            started = time.perf_counter()
+            fig, _ = create_combined_ar_figure(int(index), base_figure, ds, time_coords, lons, lats)
+            render_ms.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            figure_bytes.append(_json_size(fig))
+            serialize_ms.append((time.perf_counter() - started) * 1000)
+            if slots is not None:
+                patch = create_combined_ar_patch(fig, slots)
+                if patch is not None:
+                    patch_bytes.append(_json_size(patch.to_plotly_json()))
+            slots = count_ar_slots(fig)
+    combined = {'render_ms': _stats(render_ms), 'serialize_ms': _stats(serialize_ms),
+                'figure_bytes': _stats(figure_bytes), 'peak_rss_mb': memory.peak_mb}
+    if patch_bytes:
+        combined['patch_bytes'] = _stats(patch_bytes)
+
+    # 同样的帧以 AR 轮廓绘制（未缩放时的容差），不经过轮廓缓存
+    tolerance = outline_tolerance(lons)
+    outline_ms, outline_bytes, vertices = [], [], []
+    for index in indices:
+        started = time.perf_counter()
+        fig, _ = create_combined_ar_figure(int(index), base_figure, ds, time_coords, lons, lats,
+                                           outline_tolerance=tolerance)
+        outline_ms.append((time.perf_counter() - started) * 1000)
+        outline_bytes.append(_json_size(fig))
+        vertices.append(sum(len(ring) for trace in fig.data if trace.type == 'choropleth'
+                            for polygon in trace.geojson['features'][0]['geometry']['coordinates']
+                            for ring in polygon))
+    outline = {'render_ms': _stats(outline_ms), 'figure_bytes': _stats(outline_bytes),
+               'vertices': _stats(vertices), 'tolerance': tolerance}
+
+    # 缩放到局部视口时的渲染：第一次建立该时间步的空间索引，第二次为索引已缓存的耗时
+    viewport = geo_viewport(*BENCHMARK_VIEW)
+    cold_ms, warm_ms, viewport_bytes = [], [], []
+    for index in indices:
+        for samples in (cold_ms, warm_ms):
+            started = time.perf_counter()
+            fig, _ = create_combined_ar_figure(int(index), base_figure, ds, time_coords, lons, lats,
+                                               cache_key=path, viewport=viewport)
+            samples.append((time.perf_counter() - started) * 1000)
+        viewport_bytes.append(_json_size(fig))
+    frame_index_cache.invalidate(path)
+    zoomed = {'render_ms': _stats(cold_ms), 'indexed_render_ms': _stats(warm_ms),
+              'figure_bytes': _stats(viewport_bytes), 'viewport': viewport}
+
+    # 从 AR 轨迹索引的紧凑存储渲染同样的帧；内存比较的是这些变量在文件中的稠密大小
+    catalog = build_track_index(ds)
+    catalog_ms = []
+    for index in indices:
+        started = time.perf_counter()
+        create_combined_ar_figure(int(index), base_figure, ds, time_coords, lons, lats, catalog=catalog)
+        catalog_ms.append((time.perf_counter() - started) * 1000)
+    dense_names = [name for name in list(TRACK_COLUMNS.values()) + list(AXIS_VARIABLES) + [LABEL_VARIABLE]
+                   if name in ds.data_vars]
+    compact = {'render_ms': _stats(catalog_ms), 'catalog_bytes': catalog.nbytes,
+               'dense_bytes': int(sum(ds[name].nbytes for name in dense_names))}
+
+    factor = field_coarsening_factor(len(lats), len(lons))
+    field_ms, field_bytes = [], []
+    for index in indices:
+        started = time.perf_counter()
+        fig, _ = create_field_figure(int(index), base_figure, ds, 'ivt', time_coords, lons, lats, factor, None)
+        field_ms.append((time.perf_counter() - started) * 1000)
+        field_bytes.append(_json_size(fig))
+    ds.close()
+    field = {'render_ms': _stats(field_ms), 'figure_bytes': _stats(field_bytes), 'factor': factor}
+    return {'combined': combined, 'outline': outline, 'viewport': zoomed, 'catalog': compact, 'field': field}
+
+
+def _find_callback(output, input_id):
+    """返回输出中包含 output、第一个输入为 input_id 的回调在 callback_map 中的键。"""
+    for key, spec in app.callback_map.items():
+        if output in key and spec['inputs'] and spec['inputs'][0]['id'] == input_id:
+            return key
+    raise KeyError(f"没有输出 {output}、以 {input_id} 为输入的回调")
+
+
+def _dispatch(client, output_key, values, changed):
+    """
+    以浏览器的请求格式调用一个回调。
+
+    参数:
+    - values (dict): 'id.property' -> 值，未给出的输入和状态为 None。
+    - changed (str): 触发回调的 'id.property'。
+
+    返回:
+    - tuple: (请求字节数, 响应字节数, 耗时毫秒, 解析后的响应)
+    """
+    spec = app.callback_map[output_key]
+
+    def with_values(items):
+        return [dict(item, value=values.get(f"{item['id']}.{item['property']}")) for item in items]
+
+    outputs = split_callback_id(output_key)
+    body = json.dumps({'output': output_key, 'outputs': outputs, 'inputs': with_values(spec['inputs']),
+                       'state': with_values(spec['state']), 'changedPropIds': [changed]}).encode('utf-8')
+    started = time.perf_counter()
+    response = client.post('/_dash-update-component', data=body, content_type='application/json')
+    elapsed = (time.perf_counter() - started) * 1000
+    if response.status_code != 200:
+        raise RuntimeError(f"回调 {output_key} 返回 {response.status_code}")
+    return len(body), len(response.data), elapsed, response.get_json()
+
+
+def _response_value(response, component_id, prop):
+    for key, value in response['response'].get(component_id, {}).items():
+        if key.split('@')[0] == prop:
+            return value
+    return None
+
+
+def benchmark_callbacks(path, n_frames):
+    """
+    通过 Flask 测试客户端测量 update_output 和 update_graph 的请求/响应大小和耗时。
+
+    update_output 只提交后台加载任务，之后像浏览器一样轮询 poll_load_job 直到第一帧返回；
+    update_output 的耗时记为到第一帧显示为止的总耗时，响应大小为返回第一帧的那次轮询。
+    """
+    # 让路径选择器可以打开生成的文件
+    data_dir = os.path.dirname(os.path.abspath(path))
+    if data_dir not in ingest.DATA_DIRS:
+        ingest.DATA_DIRS.append(data_dir)
+    client = app.server.test_client()
+    load_key = _find_callback('load-job-store.data', 'upload-data')
+    poll_key = _find_callback('data-store.data', 'load-job-interval')
+    graph_key = _find_callback('map-graph.figure', 'frame-request-store')
+
+    started = time.perf_counter()
+    request_bytes, response_bytes, elapsed, response = _dispatch(
+        client, load_key, {'load-path-button.n_clicks': 1, 'path-picker.value': path}, 'load-path-button.n_clicks')
+    job_store = _response_value(response, 'load-job-store', 'data')
+    store = None
+    while store is None:
+        time.sleep(0.05)
+        request_bytes, response_bytes, _, response = _dispatch(
+            client, poll_key, {'load-job-interval.n_intervals': 1, 'load-job-store.data': job_store},
+            'load-job-interval.n_intervals')
+        store = _response_value(response, 'data-store', 'data')
+        if store is None and _response_value(response, 'load-job-interval', 'disabled'):
+            break
+    elapsed = (time.perf_counter() - started) * 1000
+    layout_state = _response_value(response, 'map-layout-store', 'data')
+    results = {'update_output': {'request_bytes': request_bytes, 'response_bytes': response_bytes, 'ms': elapsed}}
+    if store is None:
+        raise RuntimeError(f"update_output 未能加载 {path}")
+
+    n_times = _response_value(response, 'time-slider', 'max') + 1
+    full, patch = {'request': [], 'response': [], 'ms': []}, {'request': [], 'response': [], 'ms': []}
+    for index in _frame_indices(n_times, n_frames):
+        request = {'index': int(index), 'variable': 'Combined', 'ts': 0}
+        # 浏览器中还没有该数据集的轨迹布局时返回完整图形，否则返回增量更新；每次都清空帧缓存，测量冷渲染
+        for state, samples in ((None, full), (layout_state, patch)):
+            frame_cache.invalidate(store['dataset_id'])
+            values = {'frame-request-store.data': request, 'data-store.data': store, 'interval-component.disabled': True,
+                      'map-layout-store.data': state, 'time-slider.value': int(index),
+                      'variable-selector.value': 'Combined'}
+            sent, received, elapsed, _ = _dispatch(client, graph_key, values, 'frame-request-store.data')
+            samples['request'].append(sent)
+            samples['response'].append(received)
+            samples['ms'].append(elapsed)
+    results['update_graph_full'] = {name: _stats(values) for name, values in full.items()}
+    results['update_graph_patch'] = {name: _stats(values) for name, values in patch.items()}
+    return results
+
+
+def run_benchmark(n_lat, n_lon, n_times, n_ars, data_dir, n_frames=10, seed=0):
+    """生成一组合成数据（已存在时直接使用）并运行全部测量。"""
+    path = os.path.join(data_dir, f"synthetic_{n_lat}x{n_lon}_t{n_times}_ar{n_ars}_s{seed}.nc")
+    if not os.path.exists(path):
+        write_synthetic(path, n_times, n_lat, n_lon, n_ars, seed)
+    print(f"测试 {os.path.basename(path)} ...")
+    return {
+        'config': {'n_lat': n_lat, 'n_lon': n_lon, 'n_times': n_times, 'n_ars': n_ars, 'seed': seed,
+                   'file_bytes': os.path.getsize(path)},
+        'load': benchmark_load(path),
+        'render': benchmark_render(path, n_frames),
+        'callbacks': benchmark_callbacks(path, n_frames),
+    }
+
+
+def _flatten(results, prefix=''):
+    """将嵌套结果展开为 {'a.b.c': 数值}，用于比较两次运行。"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare_results(before, after):
+    """逐项打印两次运行中相同配置的结果及其比值。"""
+    previous = {json.dumps(run['config'], sort_keys=True): run for run in before['runs']}
+    for run in after['runs']:
+        old = previous.get(json.dumps(run['config'], sort_keys=True))
+        if old is None:
+            continue
+        config = run['config']
+        print(f"\n{config['n_lat']}x{config['n_lon']}, {config['n_times']} 个时间步, {config['n_ars']} 个 AR:")
+        old_flat = _flatten(old)
+        for name, value in _flatten(run).items():
+            if name.startswith('config.') or name.endswith('.n') or name not in old_flat:
+                continue
+            ratio = value / old_flat[name] if old_flat[name] else float('nan')
+            print(f"  {name:55s} {old_flat[name]:14.1f} -> {value:14.1f}  ({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='使用合成数据运行性能基准测试')
+    parser.add_argument('--preset', nargs='*', choices=list(BENCHMARK_PRESETS), default=['small'],
+                        help='预设的测试规模')
+    parser.add_argument('--grid', default=None, help='自定义网格，例如 721x1440（与 --times、--ars 一起使用）')
+    parser.add_argument('--times', type=int, default=24, help='自定义测试的时间步数')
+    parser.add_argument('--ars', type=int, default=20, help='自定义测试的平均 AR 个数')
+    parser.add_argument('--frames', type=int, default=10, help='每项逐帧测量的帧数')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'ar_vis_benchmark'),
+                        help='合成数据文件的存放目录，已存在的文件直接复用')
+    parser.add_argument('--out', default=None,
+                        help='结果 JSON 文件，默认写入 --data-dir 中的 benchmark_results.json，不在当前目录留下文件')
+    parser.add_argument('--compare', default=None, help='与之前保存的结果 JSON 比较')
+    args = parser.parse_args()
+
+    configs = [BENCHMARK_PRESETS[name] for name in args.preset or []]
+    if args.grid:
+        configs.append(parse_grid(args.grid) + (args.times, args.ars))
+    os.makedirs(args.data_dir, exist_ok=True)
+    out = args.out or os.path.join(args.data_dir, 'benchmark_results.json')
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'numpy': np.__version__, 'plotly': plotly.__version__, 'cpus': os.cpu_count()},
+        'runs': [run_benchmark(*config, args.data_dir, args.frames, args.seed) for config in configs],
+    }
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=1)
+    print(f"结果已写入 {out}")
+
+    for run in results['runs']:
+        render, callbacks = run['render']['combined'], run['callbacks']
+        print(f"{run['config']['n_lat']}x{run['config']['n_lon']}: 加载 {run['load']['path']['ms']:.0f} ms，"
+              f"渲染 p50 {render['render_ms']['p50']:.0f} ms，完整图形 {render['figure_bytes']['mean'] / 1024:.0f} KB，"
+              f"update_graph 增量响应 {callbacks['update_graph_patch']['response']['mean'] / 1024:.0f} KB")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
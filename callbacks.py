@@ -1,15 +1,324 @@
 # register_callbacks.py
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash import Patch, html, no_update
 import dash.exceptions
 import plotly.graph_objects as go
-from data_loader import load_dataset
-from plot_functions import create_combined_ar_figure
+from aggregation import AGGREGATE_OPS, aggregate
+from data_loader import load_dataset, load_dataset_from_path
+from dataset_registry import dataset_registry, estimate_resident_nbytes
+from frame_cache import frame_cache, PREFETCH_FRAMES, PLAYBACK_WINDOW_FRAMES, PLAYBACK_WINDOW_MARGIN
+from ingest import list_data_files, resolve_data_path, spool_path
+from jobs import FINISHED_STATES, LOAD_STAGES, job_runner
+from labels import ar_mask, label_fill_values
+from layout import initial_figure as base_figure
+from metrics import timed_callback
+from outlines import outline_cache
+from pyramid import open_pyramid
+from shared_store import publish, read_manifest, save_upload, unpublish
+from spatial_index import frame_index_cache, geo_viewport
+from plot_functions import (create_combined_ar_figure, create_combined_ar_patch, combined_frame_updates,
+                            count_ar_slots, create_aggregate_figure, create_field_figure, create_field_patch,
+                            create_series_figure, create_track_trace, field_coarsening_factor, field_zoom_level,
+                            is_gridded_variable, outline_tolerance, visible_grid_size)
+from timeseries import box_mean_series, point_series, series_cache
+from tracks import load_track_index
 import base64
 import json
+import numpy as np
+import os
 import pandas as pd
+from functools import partial
 
+# AR 轨迹下拉框中最多列出的 AR 个数（按寿命从长到短）
+MAX_TRACK_OPTIONS = 500
 
-def register_callbacks(app):
+
+def _same_layout(layout_state, entry, variable, outline=None):
+    """
+    判断浏览器中的图形是否已是该数据集、该变量的轨迹布局，可以只发送增量更新。
+
+    综合图的 AR 以格点或轮廓绘制时轨迹类型不同，两者之间不能互相增量更新；
+    同为轮廓时容差不同、以及视口不同都不影响轨迹结构。
+    """
+    return (layout_state is not None and layout_state.get('dataset_id') == entry.dataset_id
+            and layout_state.get('variable') == variable
+            and (layout_state.get('outline') is None) == (outline is None))
+
+
+def _get_entry(stored_data):
+    """
+    根据 dcc.Store 中的句柄从注册表取回数据集记录，不存在时返回 None。
+
+    多进程部署时句柄可能由其他 worker 创建：本进程的注册表中没有时按共享清单
+    打开同一份数据，以同一句柄注册。
+    """
+    if stored_data is None:
+        return None
+    dataset_id = stored_data.get('dataset_id')
+    entry = dataset_registry.get(dataset_id)
+    if entry is None and dataset_id is not None:
+        entry = _attach_shared(dataset_id)
+    return entry
+
+
+def _attach_shared(dataset_id):
+    """按共享清单惰性打开其他 worker 发布的数据集，清单不存在时返回 None。"""
+    manifest = read_manifest(dataset_id)
+    if manifest is None:
+        return None
+    source = manifest['source']
+    ds, time_coords, lons, lats, _ = load_dataset_from_path(source)
+    if ds is None:
+        return None
+    print(f"从共享清单打开数据集 {dataset_id}：{source}")
+    # 金字塔清单和轨迹索引都以文件指纹缓存在磁盘上，这里只是读取；索引还在建立时之后由 _entry_tracks 读取
+    dataset_registry.register(ds, time_coords, lons, lats, nbytes=estimate_resident_nbytes(ds), source=source,
+                              pyramid=open_pyramid(source),
+                              tracks=load_track_index(ds, source) if manifest.get('indexed') else None,
+                              dataset_id=dataset_id)
+    return dataset_registry.get(dataset_id)
+
+
+def _entry_tracks(entry):
+    """返回数据集的 AR 轨迹索引；由其他 worker 的加载任务建立时，在其发布后从磁盘缓存读取。"""
+    if entry.tracks is None and entry.source is not None:
+        manifest = read_manifest(entry.dataset_id)
+        if manifest is not None and manifest.get('indexed'):
+            entry.tracks = load_track_index(entry.ds, entry.source)
+    return entry.tracks
+
+
+def _combined_frame_job(entry, time_index, outline=None, viewport=None):
+    """
+    返回大气河流综合可视化某一帧的 (缓存键, 渲染函数)。
+
+    outline 为轮廓简化容差，为 None 时 AR 以格点绘制；viewport 为地图视口，为 None 时
+    绘制全球。两者作为渲染选项计入缓存键。AR 轨迹索引建立后从其紧凑存储中读取 AR 格点
+    和逐 AR 变量，渲染结果与从数据集读取相同，缓存键不变。
+    """
+    viewport = tuple(viewport) if viewport is not None else None
+    catalog = entry.tracks if entry.tracks is not None and entry.tracks.has_frames else None
+    options = (outline, viewport) if outline is not None or viewport is not None else ()
+    key = (entry.dataset_id, 'Combined', time_index, options)
+    # 以布局中的初始图形为底图，保留地图样式等静态设置
+    render = partial(create_combined_ar_figure, time_index, base_figure, entry.ds, entry.time_coords, entry.lons,
+                     entry.lats, outline_tolerance=outline, cache_key=entry.dataset_id, viewport=viewport,
+                     catalog=catalog)
+    return key, render
+
+
+def _field_frame_job(entry, var_name, time_index, factor, zoom=1.0, viewport=None):
+    """返回网格变量某一帧的 (缓存键, 渲染函数)，粗化倍数、缩放级别和视口作为渲染选项计入缓存键。"""
+    viewport = tuple(viewport) if viewport is not None else None
+    key = (entry.dataset_id, var_name, time_index, (factor, zoom, viewport))
+    render = partial(create_field_figure, time_index, base_figure, entry.ds, var_name, entry.time_coords, entry.lons,
+                     entry.lats, factor, entry.pyramid, zoom=zoom, viewport=viewport)
+    return key, render
+
+
+def _field_view(entry, relayout_data):
+    """
+    网格场按当前地图视图渲染的选项：(粗化倍数, 缩放级别, 视口)。
+    粗化倍数按视口内的格点数计算，放大后显示更细的格点。
+    """
+    zoom = field_zoom_level(_geo_zoom(relayout_data))
+    viewport = _geo_viewport(relayout_data)
+    factor = field_coarsening_factor(len(entry.lats), len(entry.lons), zoom,
+                                     visible_grid_size(entry.lons, entry.lats, viewport))
+    return factor, zoom, viewport
+
+
+def _geo_zoom(relayout_data):
+    """从 map-graph 的 relayoutData 中取出地图缩放比例，没有缩放信息时返回 1。"""
+    if not relayout_data:
+        return 1.0
+    scale = relayout_data.get('geo.projection.scale')
+    if scale is None:
+        scale = relayout_data.get('geo', {}).get('projection', {}).get('scale', 1.0)
+    return float(scale)
+
+
+def _geo_viewport(relayout_data):
+    """
+    从 map-graph 的 relayoutData 中估计地图的可见范围（见 spatial_index.geo_viewport），
+    显示全球时返回 None。返回列表以便与 dcc.Store 中保存的视口直接比较。
+    """
+    if not relayout_data:
+        return None
+    geo = relayout_data.get('geo', {})
+    center = geo.get('center', {})
+    center_lon = relayout_data.get('geo.center.lon', center.get('lon', 180.0))
+    center_lat = relayout_data.get('geo.center.lat', center.get('lat', 0.0))
+    viewport = geo_viewport(_geo_zoom(relayout_data), float(center_lon), float(center_lat))
+    return list(viewport) if viewport is not None else None
+
+
+def _format_jst(timestamp):
+    return pd.Timestamp(timestamp).tz_localize('UTC').tz_convert('Asia/Tokyo').strftime('%Y-%m-%d %H:%M')
+
+
+def _selection_box(selected_data):
+    """
+    从框选结果中取出 ((最小纬度, 最大纬度), (西边界, 东边界))，没有有效框选时返回 None。
+
+    经度在 [0, 360) 内、自西向东：西边界大于东边界表示区域跨过 0° 经线，不能按最小值
+    和最大值排序，否则得到的是所选区域之外的部分。
+    """
+    if not selected_data:
+        return None
+    corners = (selected_data.get('range') or {}).get('geo')
+    if corners:
+        # 框选的两个角依次为左上和右下，即西北角和东南角
+        (lon0, lat0), (lon1, lat1) = corners
+        return (min(lat0, lat1), max(lat0, lat1)), (lon0 % 360, lon1 % 360)
+    points = selected_data.get('points') or []
+    if not points:
+        return None
+    lats = [point['lat'] for point in points]
+    lons = np.sort(np.mod([point['lon'] for point in points], 360))
+    # 覆盖全部点的最短经度区间：去掉相邻点之间（含首尾相接处）最大的空隙
+    gaps = np.diff(np.append(lons, lons[0] + 360))
+    widest = int(np.argmax(gaps))
+    return (min(lats), max(lats)), (float(lons[(widest + 1) % len(lons)]), float(lons[widest]))
+
+
+def _release_store(stored_data):
+    """释放句柄对应的数据集及其已渲染的帧。"""
+    dataset_id = stored_data.get('dataset_id')
+    dataset_registry.release(dataset_id)
+    frame_cache.invalidate(dataset_id)
+    outline_cache.invalidate(dataset_id)
+    frame_index_cache.invalidate(dataset_id)
+    unpublish(dataset_id)
+
+
+def _initial_view(entry, options):
+    """
+    返回数据集的初始显示：(初始变量, 第一帧图形, 时间显示, 轨迹布局)。
+    """
+    initial_variable = options[0]['value'] if options else None
+    gridded = [option['value'] for option in options if is_gridded_variable(entry.ds, option['value'])]
+    if 'shapemap' not in entry.ds.data_vars and gridded:
+        # 不含大气河流识别结果的文件（如 ERA5 原始场）没有综合图，初始显示第一个网格变量
+        initial_variable = gridded[0]
+        factor = field_coarsening_factor(len(entry.lats), len(entry.lons))
+        initial_figure, initial_time_display = frame_cache.get_or_render(
+            *_field_frame_job(entry, initial_variable, 0, factor))
+        layout_state = {'dataset_id': entry.dataset_id, 'variable': initial_variable, 'factor': factor,
+                        'zoom': 1.0, 'viewport': None}
+    else:
+        initial_figure, initial_time_display = frame_cache.get_or_render(*_combined_frame_job(entry, 0))
+
+        # 记录浏览器中图形的轨迹布局，之后的帧只发送增量更新
+        layout_state = {'dataset_id': entry.dataset_id, 'variable': 'Combined',
+                        'slots': count_ar_slots(initial_figure), 'outline': None, 'viewport': None}
+    return initial_variable, initial_figure, initial_time_display, layout_state
+
+
+def _load_job(job, trigger_id, contents, filename, source, temp_path, shared_datasets):
+    """
+    后台加载任务：解码、打开数据集、渲染第一帧、建立 AR 轨迹索引。
+
+    第一帧渲染进帧缓存后即在任务状态中记下 dataset_id 和 first_frame，浏览器随即显示，
+    索引在之后继续建立。第一帧之前取消时释放数据集；之后取消只停止建立索引，
+    已显示的数据仍可浏览（没有 AR 轨迹筛选）。
+    """
+    # 多进程部署时上传内容先写入共享目录，之后与服务器上的文件一样按路径打开
+    in_memory = trigger_id == 'upload-data' and not shared_datasets
+    dataset_id = None
+    shown = False
+    try:
+        if trigger_id == 'upload-data':
+            job.report('decode')
+            if shared_datasets:
+                source = temp_path = save_upload(contents, filename)
+        job.check_cancelled()
+        if in_memory:
+            ds, time_coords, lons, lats, options_new = load_dataset(contents, filename)
+        else:
+            job.report('open')
+            ds, time_coords, lons, lats, options_new = load_dataset_from_path(source)
+        if ds is None:
+            raise ValueError("文件加载失败")
+        job.check_cancelled()
+
+        # 数据集保存在服务器端，dcc.Store 中只存放句柄。
+        # 惰性模式下上传文件解码后的字节仍保存在内存缓冲区中，一并计入预算；
+        # 从磁盘打开的文件只计入已读入内存的部分
+        nbytes = estimate_resident_nbytes(ds)
+        pyramid = None
+        if in_memory:
+            nbytes += len(contents) * 3 // 4
+        else:
+            # 磁盘上的文件如果已经预先生成了多分辨率金字塔，只需读取其清单
+            pyramid = open_pyramid(source)
+        # 共享模式下临时文件由共享清单管理，某个 worker 的注册表淘汰该数据集时不删除文件
+        dataset_id = dataset_registry.register(ds, time_coords, lons, lats, nbytes=nbytes, source=source,
+                                               temp_path=None if shared_datasets else temp_path, pyramid=pyramid)
+        if shared_datasets:
+            publish(dataset_id, source, temp_path)
+
+        job.report('first_frame', dataset_id=dataset_id)
+        _initial_view(dataset_registry.get(dataset_id), options_new)
+        job.check_cancelled()
+        job.report('index', first_frame=True, options=options_new)
+        shown = True
+
+        # 扫描全部时间步建立 AR 轨迹索引，磁盘上的文件再次打开时直接读取缓存
+        tracks = load_track_index(ds, None if in_memory else source, progress=job.progress)
+        entry = dataset_registry.get(dataset_id)
+        if entry is not None:
+            entry.tracks = tracks
+        if shared_datasets:
+            publish(dataset_id, source, temp_path, indexed=True)
+    except Exception:
+        # 第一帧显示之前失败或取消：释放已注册的数据集（连同临时文件）或直接删除临时文件
+        if dataset_id is not None and not shown:
+            _release_store({'dataset_id': dataset_id})
+        elif dataset_id is None and temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _format_progress(status):
+    """加载任务状态的显示：阶段文字和进度条。"""
+    if status is None:
+        return ""
+    stages = [stage for stage in LOAD_STAGES if stage != 'decode' or status.get('upload')]
+    if status['state'] == 'failed':
+        text = f"{status.get('filename', '')} 处理失败: {status.get('error', '')}"
+    elif status['state'] == 'cancelled':
+        text = f"{status.get('filename', '')} 已取消加载" + ("（AR 轨迹索引未建立）" if status.get('first_frame') else "")
+    else:
+        text = f"{status.get('filename', '')}：{LOAD_STAGES[status['stage']]}"
+        if status.get('progress') is not None:
+            text += f" {status['progress']:.0%}"
+    position = stages.index(status['stage']) if status['stage'] in stages else 0
+    return [html.Span(text, style={'marginRight': '10px'}),
+            html.Progress(value=str(position), max=str(len(stages) - 1))]
+
+
+def _format_series_progress(status):
+    """时间优先副本建立任务的显示文字，任务结束后不再显示。"""
+    if status is None or status['state'] in ('done', 'cancelled'):
+        return ""
+    if status['state'] == 'failed':
+        return f"{status.get('variable', '')} 的时间序列副本建立失败，继续直接读取数据: {status.get('error', '')}"
+    text = f"正在后台建立 {status.get('variable', '')} 的时间序列副本（建好后查询更快）"
+    if status.get('progress') is not None:
+        text += f" {status['progress']:.0%}"
+    return text
+
+
+def register_callbacks(app, shared_datasets=False):
+    """
+    注册全部回调函数。
+
+    参数:
+    - app (dash.Dash): Dash 应用。
+    - shared_datasets (bool): 多进程部署时为 True。上传的文件写入共享目录后按路径惰性打开，
+      加载的数据集发布到共享清单，任何 worker 都可以按句柄打开。
+    """
     # 添加一个新回调函数，专门用于在选择文件后立即显示文件名
     @app.callback(
         Output('output-filename', 'children', allow_duplicate=True),
@@ -21,6 +330,68 @@ def register_callbacks(app):
             return f"已选择文件: {filename}，正在处理中..."
         return ""
 
+    @app.callback(
+        Output('path-picker', 'options'),
+        Output('path-picker', 'value'),
+        Input('path-input', 'value'),
+        prevent_initial_call=True
+    )
+    def update_path_picker(path):
+        options = list_data_files(path)
+        if not options:
+            return [], None
+        # 输入的是单个文件时直接选中它
+        return options, options[0]['value'] if len(options) == 1 else None
+
+    @app.callback(
+        Output('load-job-store', 'data'),
+        Output('load-job-interval', 'disabled'),
+        Output('load-progress', 'children'),
+        [Input('upload-data', 'contents'),
+         Input('load-path-button', 'n_clicks'),
+         Input('stream-upload-store', 'data')],
+        [State('upload-data', 'filename'),
+         State('path-picker', 'value'),
+         State('data-store', 'data')],
+        prevent_initial_call=True
+    )
+    @timed_callback
+    def update_output(contents, load_clicks, stream_upload, filename, picked_path, previous_store):
+        trigger_id = dash.callback_context.triggered_id
+        temp_path = None
+
+        if trigger_id == 'upload-data':
+            # 增加更详细的调试信息
+            if contents is None:
+                print(f"警告：回调函数被触发，但文件内容为空。可能文件读取失败。")
+                raise dash.exceptions.PreventUpdate
+            print(f"用户已上传文件：{filename}，文件内容已成功接收。开始处理...")
+            source = filename
+        elif trigger_id == 'load-path-button':
+            source = resolve_data_path(picked_path)
+            if source is None:
+                raise dash.exceptions.PreventUpdate
+            print(f"从服务器本地路径加载文件：{source}")
+        elif trigger_id == 'stream-upload-store' and stream_upload is not None:
+            source = spool_path(stream_upload.get('upload_id'), stream_upload.get('filename'))
+            if source is None:
+                raise dash.exceptions.PreventUpdate
+            temp_path = source
+            print(f"分块上传的文件已写入临时文件：{source}，开始处理...")
+        else:
+            raise dash.exceptions.PreventUpdate
+
+        # 新文件替换旧文件时，显式释放服务器端保存的旧数据集
+        if previous_store is not None:
+            _release_store(previous_store)
+
+        # 解码、打开、渲染第一帧和建立索引都在后台任务中进行，浏览器定时查询进度
+        display_name = filename if trigger_id == 'upload-data' else os.path.basename(source.rstrip('/\\'))
+        job_id = job_runner.submit(_load_job, trigger_id, contents if trigger_id == 'upload-data' else None,
+                                   filename, source, temp_path, shared_datasets, filename=display_name,
+                                   upload=trigger_id == 'upload-data')
+        return {'job_id': job_id}, False, _format_progress(job_runner.status(job_id))
+
     @app.callback(
         [Output('variable-selector', 'options'),
          Output('variable-selector', 'value'),
@@ -29,140 +400,451 @@ def register_callbacks(app):
          Output('time-slider', 'value', allow_duplicate=True),
          Output('data-store', 'data'),
          Output('map-graph', 'figure'),
-         Output('time-display', 'children')],
-        Input('upload-data', 'contents'),
-        State('upload-data', 'filename'),
+         Output('time-display', 'children'),
+         Output('map-layout-store', 'data'),
+         Output('load-job-store', 'data', allow_duplicate=True),
+         Output('load-job-interval', 'disabled', allow_duplicate=True),
+         Output('load-progress', 'children', allow_duplicate=True)],
+        Input('load-job-interval', 'n_intervals'),
+        [State('load-job-store', 'data'),
+         State('data-store', 'data')],
         prevent_initial_call=True
     )
-    def update_output(contents, filename):
-        # 增加更详细的调试信息
-        if contents is None:
-            print(f"警告：回调函数被触发，但文件内容为空。可能文件读取失败。")
-            raise dash.exceptions.PreventUpdate
-
-        print(f"用户已上传文件：{filename}，文件内容已成功接收。开始处理...")
+    @timed_callback
+    def poll_load_job(n_intervals, job_store, current_store):
+        status = job_runner.status((job_store or {}).get('job_id'))
+        if status is None:
+            return [no_update] * 9 + [None, True, ""]
 
-        try:
-            ds_dict, time_coords, lons, lats, options_new = load_dataset(contents, filename)
-
-            if not ds_dict:
+        finished = status['state'] in FINISHED_STATES
+        # 任务状态变化时更新 load-job-store，AR 轨迹筛选在索引建好后据此刷新
+        job_update = dict(job_store, state=status['state']) if status['state'] != job_store.get('state') else no_update
+        progress = _format_progress(status)
+        dataset_id = status.get('dataset_id')
+        if not status.get('first_frame') or (current_store or {}).get('dataset_id') == dataset_id:
+            if status['state'] == 'failed' and not status.get('first_frame'):
                 initial_figure = go.Figure()
-                initial_figure.update_layout(title="文件加载失败")
-                return [], None, 0, None, 0, None, initial_figure, "文件加载失败"
-
-            max_time = len(time_coords) - 1
-            initial_variable = options_new[0]['value'] if options_new else None
+                initial_figure.update_layout(title=f"文件处理失败: {status.get('error', '')}")
+                return [], None, 0, None, 0, None, initial_figure, "文件处理失败", None, job_update, True, progress
+            return [no_update] * 9 + [job_update, finished, progress]
 
-            store_data = {
-                'ds': ds_dict,
-                'time_coords': time_coords,
-                'lons': lons,
-                'lats': lats,
-            }
-
-            initial_figure, initial_time_display = create_combined_ar_figure(0, go.Figure(), ds_dict, time_coords, lons,
-                                                                             lats)
-
-            return options_new, initial_variable, max_time, None, 0, store_data, initial_figure, initial_time_display
-
-        except Exception as e:
-            print(f"文件处理错误: {e}")
-            initial_figure = go.Figure()
-            initial_figure.update_layout(title=f"文件处理失败: {e}")
-            return [], None, 0, None, 0, None, initial_figure, "文件处理失败"
+        # 第一帧已渲染：立即显示，索引在后台继续建立
+        entry = _get_entry({'dataset_id': dataset_id})
+        if entry is None:
+            return [no_update] * 9 + [job_update, finished, progress]
+        initial_variable, initial_figure, initial_time_display, layout_state = _initial_view(entry, status['options'])
+        return (status['options'], initial_variable, len(entry.time_coords) - 1, None, 0, {'dataset_id': dataset_id},
+                initial_figure, initial_time_display, layout_state, job_update, finished, progress)
 
     @app.callback(
+        Output('load-progress', 'children', allow_duplicate=True),
+        Input('cancel-load-button', 'n_clicks'),
+        State('load-job-store', 'data'),
+        prevent_initial_call=True
+    )
+    def cancel_load_job(n_clicks, job_store):
+        if not job_store:
+            raise dash.exceptions.PreventUpdate
+        job_runner.cancel(job_store['job_id'])
+        return "正在取消..."
+
+    # 播放控制、定时推进和窗口内帧的显示都在浏览器端完成（assets/playback.js）
+    app.clientside_callback(
+        ClientsideFunction(namespace='playback', function_name='control'),
         [Output('interval-component', 'disabled'),
          Output('time-slider', 'value', allow_duplicate=True)],
         [Input('play-button', 'n_clicks'),
          Input('pause-button', 'n_clicks'),
          Input('next-button', 'n_clicks'),
          Input('prev-button', 'n_clicks')],
-        [State('interval-component', 'disabled'),
-         State('time-slider', 'value'),
+        [State('time-slider', 'value'),
+         State('time-slider', 'max'),
          State('data-store', 'data')],
         prevent_initial_call=True
     )
-    def control_playback(play_n, pause_n, next_n, prev_n, is_disabled, current_index, stored_data):
-        if stored_data is None:
-            raise dash.exceptions.PreventUpdate
-
-        time_coords = stored_data['time_coords']
-
-        ctx = dash.callback_context
-        if not ctx.triggered:
-            raise dash.exceptions.PreventUpdate
 
-        button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-        max_index = len(time_coords) - 1
+    app.clientside_callback(
+        ClientsideFunction(namespace='playback', function_name='advance'),
+        [Output('time-slider', 'value', allow_duplicate=True),
+         Output('window-request-store', 'data')],
+        Input('interval-component', 'n_intervals'),
+        [State('time-slider', 'value'),
+         State('time-slider', 'max'),
+         State('playback-window-store', 'data'),
+         State('window-request-store', 'data'),
+         State('data-store', 'data'),
+         State('variable-selector', 'value')],
+        prevent_initial_call=True
+    )
 
-        if button_id == 'play-button':
-            return False, current_index
-        elif button_id == 'pause-button':
-            return True, current_index
-        elif button_id == 'next-button':
-            new_index = (current_index + 1) if current_index < max_index else max_index
-            return True, new_index
-        elif button_id == 'prev-button':
-            new_index = (current_index - 1) if current_index > 0 else 0
-            return True, new_index
+    app.clientside_callback(
+        ClientsideFunction(namespace='playback', function_name='show_frame'),
+        [Output('map-graph', 'figure', allow_duplicate=True),
+         Output('time-display', 'children', allow_duplicate=True),
+         Output('frame-request-store', 'data')],
+        [Input('time-slider', 'value'),
+         Input('variable-selector', 'value')],
+        [State('playback-window-store', 'data'),
+         State('map-graph', 'figure'),
+         State('map-layout-store', 'data'),
+         State('data-store', 'data')],
+        prevent_initial_call=True
+    )
 
-        raise dash.exceptions.PreventUpdate
+    app.clientside_callback(
+        ClientsideFunction(namespace='playback', function_name='set_interval'),
+        Output('interval-component', 'interval'),
+        Input('fps-input', 'value')
+    )
 
     @app.callback(
-        Output('time-slider', 'value', allow_duplicate=True),
-        Input('interval-component', 'n_intervals'),
-        State('time-slider', 'value'),
-        State('data-store', 'data'),
+        Output('playback-window-store', 'data'),
+        Input('window-request-store', 'data'),
+        [State('data-store', 'data'),
+         State('map-layout-store', 'data')],
         prevent_initial_call=True
     )
-    def update_slider_on_interval(n_intervals, current_index, stored_data):
-        if stored_data is None:
+    @timed_callback
+    def load_playback_window(window_request, stored_data, layout_state):
+        entry = _get_entry(stored_data)
+        outline = layout_state.get('outline') if layout_state else None
+        viewport = layout_state.get('viewport') if layout_state else None
+        if entry is None or window_request is None or not _same_layout(layout_state, entry, 'Combined', outline):
             raise dash.exceptions.PreventUpdate
 
-        time_coords = stored_data['time_coords']
-        max_index = len(time_coords) - 1
-        new_index = (current_index + 1) if current_index < max_index else 0
-        return new_index
+        start = int(window_request['start']) % entry.n_times
+        n_frames = min(PLAYBACK_WINDOW_FRAMES, entry.n_times)
+        jobs = [_combined_frame_job(entry, (start + step) % entry.n_times, outline, viewport)
+                for step in range(n_frames)]
+        # 先把窗口内的帧交给后台线程池并行渲染，再按顺序收集
+        frame_cache.prefetch(jobs)
+
+        frames = {}
+        last = start
+        for key, render in jobs:
+            fig, time_display = frame_cache.get_or_render(key, render)
+            updates = combined_frame_updates(fig, layout_state['slots'])
+            if updates is None:
+                # 该帧需要更多的轨迹槽位，交由服务器发送完整图形
+                break
+            last = key[2]
+            frames[str(last)] = {'updates': updates, 'title': fig.layout.title.text, 'time_display': time_display}
+
+        # 顺便在后台渲染下一个窗口开头的几帧
+        frame_cache.prefetch([
+            _combined_frame_job(entry, (start + n_frames + step) % entry.n_times, outline, viewport)
+            for step in range(PREFETCH_FRAMES)
+        ])
+
+        return {'dataset_id': entry.dataset_id, 'slots': layout_state['slots'], 'outline': outline,
+                'viewport': viewport, 'start': start, 'last': last, 'margin': PLAYBACK_WINDOW_MARGIN,
+                'frames': frames}
 
     @app.callback(
         [Output('map-graph', 'figure', allow_duplicate=True),
-         Output('time-display', 'children', allow_duplicate=True)],
-        [Input('time-slider', 'value'),
-         Input('variable-selector', 'value')],
-        [State('map-graph', 'figure'),
-         State('data-store', 'data')],
+         Output('time-display', 'children', allow_duplicate=True),
+         Output('map-layout-store', 'data', allow_duplicate=True)],
+        [Input('frame-request-store', 'data'),
+         Input('map-graph', 'relayoutData'),
+         Input('ar-render-mode', 'value')],
+        [State('data-store', 'data'),
+         State('interval-component', 'disabled'),
+         State('map-layout-store', 'data'),
+         State('time-slider', 'value'),
+         State('variable-selector', 'value')],
         prevent_initial_call=True
     )
-    def update_graph(selected_time_index, selected_variable, current_figure, stored_data):
-        fig = go.Figure(current_figure)
+    @timed_callback
+    def update_graph(frame_request, relayout_data, render_mode, stored_data, playback_disabled, layout_state,
+                     slider_index, selector_variable):
+        # 浏览器中的图形不再随请求上传，标题等只通过 Patch 修改
+        fig = Patch()
 
-        if stored_data is None or selected_variable is None:
+        if stored_data is None:
+            raise dash.exceptions.PreventUpdate
+        triggered_id = dash.callback_context.triggered_id
+        if triggered_id == 'map-graph':
+            # 地图缩放和平移影响网格场的粗化倍数，以及综合图的视口和 AR 轮廓的简化容差
+            selected_time_index, selected_variable = slider_index, selector_variable
+            if layout_state is None or layout_state.get('variable') != selected_variable \
+                    or ('factor' not in layout_state and selected_variable != 'Combined'):
+                raise dash.exceptions.PreventUpdate
+        elif triggered_id == 'ar-render-mode':
+            # 切换 AR 的绘制方式只影响综合图
+            selected_time_index, selected_variable = slider_index, selector_variable
+            if selected_variable != 'Combined':
+                raise dash.exceptions.PreventUpdate
+        else:
+            # 只有客户端播放窗口中没有的帧才会请求到这里
+            if frame_request is None:
+                raise dash.exceptions.PreventUpdate
+            selected_time_index = frame_request['index']
+            selected_variable = frame_request['variable']
+        if selected_variable is None:
             raise dash.exceptions.PreventUpdate
 
-        ds_dict = stored_data['ds']
-        time_coords = stored_data['time_coords']
-        lons = stored_data['lons']
-        lats = stored_data['lats']
+        entry = _get_entry(stored_data)
+        if entry is None:
+            fig['layout']['title']['text'] = "数据已从服务器内存中释放，请重新上传文件"
+            return [fig, "数据已过期", no_update]
 
         try:
             if selected_variable == 'Combined':
-                fig, time_display = create_combined_ar_figure(selected_time_index, current_figure, ds_dict, time_coords,
-                                                              lons, lats)
+                outline = None
+                if render_mode == 'outline':
+                    outline = outline_tolerance(entry.lons, _geo_zoom(relayout_data))
+                # 只发送地图视口内的要素；视口按固定粒度对齐，小幅平移不会触发重新渲染
+                viewport = _geo_viewport(relayout_data)
+                if triggered_id == 'map-graph' and layout_state.get('outline') == outline \
+                        and layout_state.get('viewport') == viewport:
+                    raise dash.exceptions.PreventUpdate
+                full_figure, time_display = frame_cache.get_or_render(
+                    *_combined_frame_job(entry, selected_time_index, outline, viewport))
+
+                # 播放时下一帧可以预知，在后台提前渲染后续若干帧
+                if not playback_disabled:
+                    frame_cache.prefetch([
+                        _combined_frame_job(entry, (selected_time_index + step) % entry.n_times, outline, viewport)
+                        for step in range(1, PREFETCH_FRAMES + 1)
+                    ])
+
+                # 浏览器中已是该数据集的固定轨迹布局时只发送变化的轨迹数据，否则发送完整图形
+                if _same_layout(layout_state, entry, 'Combined', outline):
+                    patch = create_combined_ar_patch(full_figure, layout_state['slots'])
+                    if patch is not None:
+                        if layout_state.get('outline') == outline and layout_state.get('viewport') == viewport:
+                            return [patch, time_display, no_update]
+                        return [patch, time_display, dict(layout_state, outline=outline, viewport=viewport)]
+                layout_state = {'dataset_id': entry.dataset_id, 'variable': 'Combined',
+                                'slots': count_ar_slots(full_figure), 'outline': outline, 'viewport': viewport}
+                return [full_figure, time_display, layout_state]
+            elif is_gridded_variable(entry.ds, selected_variable):
+                # 按当前地图视口和缩放级别在服务器端裁剪、粗化网格场
+                factor, zoom, viewport = _field_view(entry, relayout_data)
+                view = {'factor': factor, 'zoom': zoom, 'viewport': viewport}
+                unchanged = all(layout_state.get(name) == value for name, value in view.items()) \
+                    if layout_state is not None else False
+                if triggered_id == 'map-graph' and unchanged:
+                    raise dash.exceptions.PreventUpdate
+                full_figure, time_display = frame_cache.get_or_render(
+                    *_field_frame_job(entry, selected_variable, selected_time_index, factor, zoom, viewport))
+
+                # 轨迹结构与视图无关，同一变量只需更新格点数据
+                if _same_layout(layout_state, entry, selected_variable):
+                    return [create_field_patch(full_figure), time_display,
+                            no_update if unchanged else dict(layout_state, **view)]
+                layout_state = dict(view, dataset_id=entry.dataset_id, variable=selected_variable)
+                return [full_figure, time_display, layout_state]
             else:
-                fig = go.Figure(current_figure)
-                fig.update_layout(title=f"动态变量 {selected_variable} 的可视化")
-                time_display = f"正在显示变量: {selected_variable}"
+                fig['layout']['title']['text'] = f"动态变量 {selected_variable} 的可视化"
+                time_display = f"正在显示变量: {selected_variable}（非经纬度网格变量，暂不支持绘制）"
 
-            return [fig, time_display]
+            return [fig, time_display, no_update]
 
+        except dash.exceptions.PreventUpdate:
+            raise
         except Exception as e:
             print(f"错误详情: {str(e)}")
-            fig.update_layout(
-                title="发生错误",
-                annotations=[
-                    {'text': f"可视化数据时出错：{str(e)}", 'x': 0.5, 'y': 0.5, 'xref': 'paper', 'yref': 'paper',
-                     'showarrow': False, 'font': {'size': 16}}]
-            )
+            fig['layout']['title']['text'] = "发生错误"
+            fig['layout']['annotations'] = [
+                {'text': f"可视化数据时出错：{str(e)}", 'x': 0.5, 'y': 0.5, 'xref': 'paper', 'yref': 'paper',
+                 'showarrow': False, 'font': {'size': 16}}]
             time_display = "发生错误"
-            return [fig, time_display]
+            return [fig, time_display, no_update]
+
+    @app.callback(
+        [Output('aggregate-range', 'max'),
+         Output('aggregate-range', 'value')],
+        Input('data-store', 'data'),
+        prevent_initial_call=True
+    )
+    def update_aggregate_range(stored_data):
+        entry = _get_entry(stored_data)
+        if entry is None:
+            return 0, [0, 0]
+        return entry.n_times - 1, [0, entry.n_times - 1]
+
+    @app.callback(
+        [Output('map-graph', 'figure', allow_duplicate=True),
+         Output('time-display', 'children', allow_duplicate=True),
+         Output('map-layout-store', 'data', allow_duplicate=True)],
+        Input('aggregate-button', 'n_clicks'),
+        [State('aggregate-op', 'value'),
+         State('aggregate-percentile', 'value'),
+         State('aggregate-range', 'value'),
+         State('variable-selector', 'value'),
+         State('data-store', 'data'),
+         State('map-graph', 'relayoutData')],
+        prevent_initial_call=True
+    )
+    @timed_callback
+    def show_aggregate(n_clicks, op, percentile, time_range, selected_variable, stored_data, relayout_data):
+        entry = _get_entry(stored_data)
+        if entry is None:
+            raise dash.exceptions.PreventUpdate
+
+        # AR 出现次数总是由 shapemap 统计，其他统计作用于当前选择的网格变量
+        var_name = 'shapemap' if op == 'ar_count' else selected_variable
+        fig = Patch()
+        if not is_gridded_variable(entry.ds, var_name):
+            fig['layout']['title']['text'] = "时间统计需要 (time, lat, lon) 网格变量"
+            return [fig, f"变量 {var_name} 不是经纬度网格变量，无法做时间统计", no_update]
+
+        start, end = time_range
+        try:
+            result = aggregate(entry.ds, var_name, op, start, end, q=percentile, source=entry.source)
+        except Exception as e:
+            print(f"时间统计出错: {e}")
+            fig['layout']['title']['text'] = f"时间统计失败: {e}"
+            return [fig, "时间统计失败", no_update]
+
+        label = AGGREGATE_OPS[op] if op != 'percentile' else f"第 {percentile:g} 百分位数"
+        period = f"{_format_jst(entry.time_coords[start])} 至 {_format_jst(entry.time_coords[end])}"
+        units = '次' if op == 'ar_count' else entry.ds[var_name].attrs.get('units', '')
+        factor, zoom, viewport = _field_view(entry, relayout_data)
+        full_figure, n_points = create_aggregate_figure(base_figure, result.values, entry.lons, entry.lats, var_name,
+                                                        units, f"{var_name} {label} ({period})", factor,
+                                                        diverging=op == 'anomaly', zoom=zoom, viewport=viewport)
+        time_display = (f"统计: {var_name} {label} | 时间范围 (JST): {period}，共 {end - start + 1} 个时间步 | "
+                        f"显示格点: {n_points} (粗化倍数 {factor})")
+        # 统计图不属于任何逐帧布局，之后拖动滑块时重新发送完整图形
+        return [full_figure, time_display, {'dataset_id': entry.dataset_id, 'variable': f'aggregate:{op}'}]
+
+    @app.callback(
+        [Output('series-graph', 'figure'),
+         Output('series-graph', 'style'),
+         Output('series-job-store', 'data'),
+         Output('series-job-interval', 'disabled')],
+        [Input('map-graph', 'clickData'),
+         Input('map-graph', 'selectedData')],
+        [State('variable-selector', 'value'),
+         State('data-store', 'data')],
+        prevent_initial_call=True
+    )
+    @timed_callback
+    def show_time_series(click_data, selected_data, selected_variable, stored_data):
+        entry = _get_entry(stored_data)
+        if entry is None:
+            raise dash.exceptions.PreventUpdate
+
+        # 网格变量显示其数值；AR 综合图等其他视图显示该处是否被 AR 覆盖（见 labels.ar_mask）
+        if is_gridded_variable(entry.ds, selected_variable):
+            var_name, indicator = selected_variable, False
+        elif is_gridded_variable(entry.ds, 'shapemap'):
+            var_name, indicator = 'shapemap', True
+        else:
+            raise dash.exceptions.PreventUpdate
+        units = '' if indicator else entry.ds[var_name].attrs.get('units', '')
+        y_title = 'AR 覆盖' if indicator else (f"{var_name} ({units})" if units else var_name)
+
+        style = {'height': '35vh', 'border': '1px solid #ddd', 'marginTop': '10px'}
+        try:
+            if dash.callback_context.triggered[0]['prop_id'] == 'map-graph.selectedData':
+                box = _selection_box(selected_data)
+                if box is None:
+                    raise dash.exceptions.PreventUpdate
+                (lat0, lat1), (lon0, lon1) = box
+                series = box_mean_series(entry.ds, var_name, (lat0, lat1), (lon0, lon1), entry.source, indicator)
+                title = (f"{var_name} 区域{'覆盖比例' if indicator else '平均'} "
+                         f"(纬度 {lat0:.2f}~{lat1:.2f}, 经度 {lon0:.2f}~{lon1:.2f})")
+            else:
+                if not click_data or not click_data.get('points'):
+                    raise dash.exceptions.PreventUpdate
+                point = click_data['points'][0]
+                series = point_series(entry.ds, var_name, [point['lat']], [point['lon']], entry.source)
+                if indicator:
+                    series = ar_mask(series, label_fill_values(entry.ds[var_name])).astype(float)
+                title = f"{var_name} 时间序列 (纬度 {point['lat']:.2f}, 经度 {point['lon']:.2f})"
+        except dash.exceptions.PreventUpdate:
+            raise
+        except Exception as e:
+            print(f"提取时间序列出错: {e}")
+            fig = go.Figure()
+            fig.update_layout(title=f"提取时间序列失败: {e}")
+            return fig, style, no_update, no_update
+
+        # 时间优先副本仍在后台建立时显示其进度
+        job_id = series_cache.build_job(entry.source, var_name)
+        return (create_series_figure(entry.time_coords, series, [var_name], title, y_title), style,
+                {'job_id': job_id} if job_id else None, job_id is None)
+
+    @app.callback(
+        [Output('series-progress', 'children'),
+         Output('series-job-interval', 'disabled', allow_duplicate=True)],
+        [Input('series-job-interval', 'n_intervals'),
+         Input('series-job-store', 'data')],
+        prevent_initial_call=True
+    )
+    def poll_series_job(n_intervals, job_store):
+        status = series_cache.runner.status((job_store or {}).get('job_id'))
+        return _format_series_progress(status), status is None or status['state'] in FINISHED_STATES
+
+    @app.callback(
+        [Output('track-selector', 'options'),
+         Output('track-selector', 'value')],
+        [Input('data-store', 'data'),
+         Input('track-min-lifetime', 'value'),
+         Input('track-min-length', 'value'),
+         Input('track-landfall-only', 'value'),
+         Input('map-graph', 'selectedData'),
+         # 轨迹索引在第一帧显示之后才建好，加载任务结束时刷新
+         Input('load-job-store', 'data')],
+        prevent_initial_call=True
+    )
+    @timed_callback
+    def update_track_options(stored_data, min_lifetime, min_length, landfall_only, selected_data, job_store):
+        entry = _get_entry(stored_data)
+        if entry is None or _entry_tracks(entry) is None:
+            return [], None
+        landfall_box = _selection_box(selected_data) if landfall_only else None
+        if landfall_only and landfall_box is None and \
+                dash.callback_context.triggered[0]['prop_id'] == 'map-graph.selectedData':
+            raise dash.exceptions.PreventUpdate
+
+        # 筛选和汇总都在索引上完成，不读取数据文件
+        kids = entry.tracks.filter(min_lifetime, min_length, landfall_box)
+        summary = entry.tracks.summary()
+        rows = np.flatnonzero(np.isin(summary['kid'], kids))
+        rows = rows[np.argsort(-np.nan_to_num(summary['lifetime'][rows], nan=-np.inf), kind='stable')]
+        options = [{'label': f"AR {summary['kid'][row]:g} | {_format_jst(entry.time_coords[summary['first'][row]])} ~ "
+                             f"{_format_jst(entry.time_coords[summary['last'][row]])} | {summary['steps'][row]} 个时间步",
+                    'value': float(summary['kid'][row])}
+                   for row in rows[:MAX_TRACK_OPTIONS]]
+        return options, None
+
+    @app.callback(
+        Output('map-graph', 'figure', allow_duplicate=True),
+        Input('show-track-button', 'n_clicks'),
+        [State('track-selector', 'value'),
+         State('data-store', 'data')],
+        prevent_initial_call=True
+    )
+    @timed_callback
+    def show_track(n_clicks, kid, stored_data):
+        entry = _get_entry(stored_data)
+        if entry is None or _entry_tracks(entry) is None or kid is None:
+            raise dash.exceptions.PreventUpdate
+        # 轨迹追加在现有轨迹之后，不影响逐帧增量更新使用的轨迹位置；重新绘制整张图时清除
+        fig = Patch()
+        fig['data'].append(create_track_trace(entry.tracks, kid, entry.time_coords))
+        return fig
+
+    @app.callback(
+        Output('time-slider', 'value', allow_duplicate=True),
+        [Input('track-genesis-button', 'n_clicks'),
+         Input('track-landfall-button', 'n_clicks')],
+        [State('track-selector', 'value'),
+         State('data-store', 'data')],
+        prevent_initial_call=True
+    )
+    def jump_to_track_event(genesis_clicks, landfall_clicks, kid, stored_data):
+        entry = _get_entry(stored_data)
+        if entry is None or _entry_tracks(entry) is None or kid is None:
+            raise dash.exceptions.PreventUpdate
+        if dash.callback_context.triggered_id == 'track-genesis-button':
+            time_index = entry.tracks.genesis(kid)
+        else:
+            time_index = entry.tracks.landfall(kid)
+        if time_index is None:
+            raise dash.exceptions.PreventUpdate
+        return time_index
@@ -0,0 +1,257 @@
+# convert.py
+"""
+把 NetCDF/GRIB 源文件离线转换为按逐帧读取优化的分块存储（见 frame_store.py）。
+
+ERA5 原始文件的分块和压缩方式通常面向整段时间序列，单个时间步的读取需要解压
+大量无关数据。转换后每个变量按 1 个（或少量）时间步分块、空间维度不分块，
+可选 float32 或 int16（scale_factor/add_offset）打包以减小体积。各时间段在多个
+进程中并行写入，中断后再次运行会跳过已完成的时间段。
+
+时间段的长度按字节数确定（DEFAULT_PART_BYTES），每个时间段再按 WRITE_BLOCK_BYTES
+大小的时间块逐块读取和写入，每个工作进程同时只在内存中保留一个时间块，转换 0.25°
+的多年 ERA5 文件时内存占用也有上限。
+
+用法:
+    python convert.py ERA5_AR.nc --compressor zstd --pack int16 --workers 4
+    python convert.py ERA5_AR.nc --benchmark 50
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import dask
+import numpy as np
+
+from data_loader import load_dataset_from_path, open_source, read_frame
+from frame_store import STORE_FORMAT, STORE_VERSION, default_store_path, part_path, read_manifest, write_manifest
+
+# 每个时间段文件（未压缩）的目标字节数，按此确定每段的时间步数；时间段也是并行和断点续做的单位
+DEFAULT_PART_BYTES = 4 * 1024 ** 3
+
+# 工作进程每次读入并写出的时间块的字节数上限（至少一个时间步）
+WRITE_BLOCK_BYTES = 256 * 1024 ** 2
+
+COMPRESSORS = ('none', 'zlib', 'zstd', 'blosc_lz4', 'blosc_zstd')
+PACKINGS = ('none', 'float32', 'int16')
+
+# int16 打包时保留 -32768 作为缺测值
+INT16_FILL = -32768
+INT16_MAX = 32767
+
+
+def _fingerprint(source_path):
+    stat = os.stat(source_path)
+    return {'path': os.path.abspath(source_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _time_variables(ds):
+    return [var for var in ds.data_vars if 'time' in ds[var].dims]
+
+
+def _times_for_bytes(ds, variables, nbytes, multiple=1):
+    """
+    nbytes 字节内可以容纳的时间步数（各变量一个时间步的未压缩大小之和），
+    向下取到 multiple 的整数倍，至少为 multiple。
+    """
+    step_bytes = sum(ds[var].dtype.itemsize * ds[var].size // ds.sizes['time'] for var in variables)
+    steps = nbytes // max(1, step_bytes)
+    return int(max(multiple, steps // multiple * multiple))
+
+
+def _int16_scaling(ds, variables):
+    """
+    统计每个变量的取值范围，确定 int16 打包使用的 scale_factor 和 add_offset。
+
+    取值全为整数且在 int16 范围内的变量（如标签图）按原值存储，不损失精度。
+    """
+    stats = {}
+    for var in variables:
+        values = ds[var]
+        whole = (values.isnull() | (values == np.round(values))).all()
+        stats[var] = (values.min(), values.max(), whole)
+    computed, = dask.compute(stats)
+
+    scaling = {}
+    for var, (vmin, vmax, whole) in computed.items():
+        vmin, vmax = float(vmin), float(vmax)
+        if not np.isfinite(vmin) or not np.isfinite(vmax):
+            scaling[var] = (1.0, 0.0)
+        elif bool(whole) and -INT16_MAX <= vmin and vmax <= INT16_MAX:
+            scaling[var] = (1.0, 0.0)
+        else:
+            scale = (vmax - vmin) / (2 * INT16_MAX) or 1.0
+            scaling[var] = (scale, (vmax + vmin) / 2)
+    return scaling
+
+
+def _encoding(block, variables, time_chunk, compressor, complevel, packing, scaling):
+    encoding = {}
+    for var in variables:
+        dims = block[var].dims
+        chunks = tuple(min(time_chunk, block.sizes[dim]) if dim == 'time' else block.sizes[dim] for dim in dims)
+        enc = {'chunksizes': chunks}
+        if compressor == 'zlib':
+            enc.update(zlib=True, complevel=complevel, shuffle=True)
+        elif compressor != 'none':
+            enc.update(compression=compressor, complevel=complevel, shuffle=True)
+        if packing == 'float32' and block[var].dtype.kind == 'f':
+            enc['dtype'] = 'float32'
+        elif packing == 'int16' and var in scaling:
+            scale, offset = scaling[var]
+            enc.update(dtype='int16', scale_factor=scale, add_offset=offset, _FillValue=INT16_FILL)
+        encoding[var] = enc
+    return encoding
+
+
+def _convert_part(source_path, store_path, variables, start, stop, time_chunk, compressor, complevel,
+                  packing, scaling, write_times):
+    """
+    在工作进程中转换一个时间段。数据按 write_times 个时间步分块惰性读取，to_netcdf 使用
+    同步调度器逐块读取、写出，内存中同时只有一个时间块。
+    """
+    with open_source(source_path, chunks={'time': write_times}) as ds:
+        static = [var for var in ds.data_vars if 'time' not in ds[var].dims]
+        block = ds[variables + static].isel(time=slice(start, stop))
+        for var in block.variables:
+            # 源文件的分块、压缩和打包设置不再适用
+            block[var].encoding = {key: value for key, value in block[var].encoding.items()
+                                   if key in ('units', 'calendar')}
+
+        path = part_path(store_path, start)
+        with dask.config.set(scheduler='synchronous'):
+            block.to_netcdf(path + '.tmp', format='NETCDF4', engine='netcdf4',
+                            encoding=_encoding(block, variables, time_chunk, compressor, complevel, packing, scaling))
+    os.replace(path + '.tmp', path)
+    return start
+
+
+def convert(source_path, store_path=None, time_chunk=1, part_times=None, compressor='zlib',
+            complevel=1, packing='none', workers=None, part_bytes=DEFAULT_PART_BYTES):
+    """
+    将源文件转换（或继续转换）为逐帧存储。
+
+    参数:
+    - source_path (str): 源 NetCDF/GRIB 文件路径。
+    - store_path (str): 输出目录，默认为与源文件同名的 .frames 目录。
+    - time_chunk (int): 时间维分块大小，逐帧浏览时取 1。
+    - part_times (int): 每个时间段文件的时间步数，为 None 时按 part_bytes 计算。
+    - compressor (str): COMPRESSORS 之一。zstd 和 blosc 需要 netCDF-C 4.9 及以上。
+    - complevel (int): 压缩级别。
+    - packing (str): PACKINGS 之一。
+    - workers (int): 并行进程数，默认为 CPU 核数。
+    - part_bytes (int): 每个时间段文件的目标大小（未压缩字节数）。
+
+    返回:
+    - dict: 转换完成后的清单。
+    """
+    store_path = store_path or default_store_path(source_path)
+    with open_source(source_path) as ds:
+        variables = _time_variables(ds)
+        n_times = ds.sizes['time']
+        if part_times is None:
+            part_times = _times_for_bytes(ds, variables, part_bytes, time_chunk)
+        write_times = min(part_times, _times_for_bytes(ds, variables, WRITE_BLOCK_BYTES))
+
+        settings = {'format': STORE_FORMAT, 'version': STORE_VERSION, 'source': _fingerprint(source_path),
+                    'variables': variables, 'n_times': n_times, 'time_chunk': time_chunk, 'part_times': part_times,
+                    'compressor': compressor, 'complevel': complevel, 'packing': packing}
+        manifest = read_manifest(store_path)
+        if manifest is None or any(manifest.get(key) != value for key, value in settings.items()):
+            # 源文件或参数发生变化时从头转换
+            scaling = {}
+            if packing == 'int16':
+                print("统计各变量取值范围以确定 int16 打包参数...")
+                scaling = _int16_scaling(ds.chunk({'time': write_times}), variables)
+            manifest = dict(settings, scaling=scaling, parts=list(range(0, n_times, part_times)),
+                            completed=[], complete=False)
+    scaling = {var: tuple(value) for var, value in manifest['scaling'].items()}
+    os.makedirs(store_path, exist_ok=True)
+    write_manifest(store_path, manifest)
+
+    completed = set(manifest['completed'])
+    starts = [start for start in manifest['parts'] if start not in completed]
+    total_parts = len(manifest['parts'])
+    print(f"逐帧存储 {store_path}: 共 {total_parts} 个时间段，待转换 {len(starts)} 个")
+
+    if starts:
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_convert_part, source_path, store_path, variables, start,
+                                   min(start + part_times, n_times), time_chunk, compressor, complevel,
+                                   packing, scaling, write_times)
+                       for start in starts]
+            for future in as_completed(futures):
+                completed.add(future.result())
+                manifest['completed'] = sorted(completed)
+                write_manifest(store_path, manifest)
+                print(f"已完成 {len(completed)}/{total_parts} 个时间段，"
+                      f"用时 {time.perf_counter() - started:.1f} 秒")
+
+    manifest['complete'] = True
+    write_manifest(store_path, manifest)
+    return manifest
+
+
+def benchmark_frame_reads(path, n_frames=20, seed=0):
+    """
+    按应用的读取方式测量逐帧读取延迟：随机抽取若干时间步，读取全部变量的切片。
+
+    返回:
+    - dict: 包含打开耗时和每帧读取耗时统计（毫秒）的结果。
+    """
+    started = time.perf_counter()
+    ds, time_coords, _, _, _ = load_dataset_from_path(path)
+    if ds is None:
+        raise ValueError(f"无法打开 {path}")
+    open_ms = (time.perf_counter() - started) * 1000
+
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(time_coords), size=min(n_frames, len(time_coords)), replace=False)
+    variables = list(ds.data_vars)
+    timings = []
+    for index in indices:
+        started = time.perf_counter()
+        read_frame(ds, variables, int(index))
+        timings.append((time.perf_counter() - started) * 1000)
+    ds.close()
+
+    timings = np.array(timings)
+    return {'path': path, 'frames': len(timings), 'open_ms': open_ms, 'mean_ms': float(timings.mean()),
+            'p50_ms': float(np.percentile(timings, 50)), 'p95_ms': float(np.percentile(timings, 95)),
+            'max_ms': float(timings.max())}
+
+
+def _print_benchmark(label, result):
+    print(f"{label}: 打开 {result['open_ms']:.1f} ms，{result['frames']} 帧 平均 {result['mean_ms']:.1f} ms，"
+          f"p50 {result['p50_ms']:.1f} ms，p95 {result['p95_ms']:.1f} ms，最大 {result['max_ms']:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='将 NetCDF/GRIB 文件转换为按逐帧读取优化的分块存储')
+    parser.add_argument('source', help='源 NetCDF/GRIB 文件')
+    parser.add_argument('--out', default=None, help='输出目录，默认为 <源文件名>.frames')
+    parser.add_argument('--time-chunk', type=int, default=1, help='时间维分块大小')
+    parser.add_argument('--part-times', type=int, default=None,
+                        help='每个时间段文件的时间步数，默认按 --part-bytes 计算')
+    parser.add_argument('--part-bytes', type=int, default=DEFAULT_PART_BYTES,
+                        help='每个时间段文件的目标大小（未压缩字节数）')
+    parser.add_argument('--compressor', choices=COMPRESSORS, default='zlib', help='压缩方式')
+    parser.add_argument('--complevel', type=int, default=1, help='压缩级别')
+    parser.add_argument('--pack', choices=PACKINGS, default='none', help='数值打包方式')
+    parser.add_argument('--workers', type=int, default=None, help='并行进程数')
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                        help='转换后分别从源文件和转换结果随机读取 N 帧并比较读取延迟')
+    args = parser.parse_args()
+
+    store_path = args.out or default_store_path(args.source)
+    convert(args.source, store_path, args.time_chunk, args.part_times, args.compressor, args.complevel, args.pack,
+            args.workers, args.part_bytes)
+
+    if args.benchmark:
+        _print_benchmark('转换前', benchmark_frame_reads(args.source, args.benchmark))
+        _print_benchmark('转换后', benchmark_frame_reads(store_path, args.benchmark))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,74 +1,243 @@
 import xarray as xr
 import io
+import os
 import base64
+import hashlib
+import tempfile
 
+from derived import add_derived_variables
+from frame_store import is_frame_store, open_frame_store
+from multifile import is_multifile_pattern, open_multifile
+from metrics import metrics
 
-def load_dataset(file_content, file_name):
+# 逐帧浏览时每次只读取一个时间步，因此按单个时间步分块、空间维度不分块
+FRAME_CHUNKS = {'time': 1}
+
+# GRIB 消息索引的缓存目录，再次打开同一文件时不必重新扫描全部消息
+GRIB_INDEX_DIR = os.environ.get('AR_VIS_INDEX_DIR', os.path.join(tempfile.gettempdir(), 'ar_vis_grib_index'))
+
+# 各标准坐标名称常见的其他写法，按顺序取第一个存在的名称
+COORD_ALIASES = {
+    'time': ('valid_time', 'Time', 'TIME'),
+    'lat': ('latitude', 'Latitude', 'LATITUDE', 'LAT'),
+    'lon': ('longitude', 'Longitude', 'LONGITUDE', 'LON'),
+}
+
+# 文件扩展名 -> 读取函数。读取函数接收文件路径或文件对象，返回惰性打开的数据集
+READERS = {}
+
+
+def register_reader(*extensions):
+    """
+    注册处理若干扩展名的读取函数，用作装饰器。
+
+    示例:
+        @register_reader('.h5')
+        def read_hdf5(source):
+            return xr.open_dataset(source, engine='h5netcdf')
+    """
+    def decorator(reader):
+        for extension in extensions:
+            READERS[extension.lower()] = reader
+        return reader
+    return decorator
+
+
+@register_reader('.nc', '.nc4', '.netcdf')
+def read_netcdf(source):
+    return xr.open_dataset(source)
+
+
+@register_reader('.grib', '.grib2', '.grb', '.grb2')
+def read_grib(source):
+    """
+    用 cfgrib 读取 GRIB 文件。
+
+    首次打开时 cfgrib 需要扫描全部消息建立索引，索引保存在 GRIB_INDEX_DIR 中；
+    文件未改变时再次打开直接读取索引。文件中包含多组层次或网格不同的变量时，
+    只保留与变量最多的一组时间和网格一致的变量。
+    """
+    if not isinstance(source, str):
+        raise ValueError("GRIB 文件需要通过服务器路径或分块上传打开")
+    try:
+        import cfgrib
+    except ImportError:
+        raise ValueError("读取 GRIB 文件需要安装 cfgrib 和 eccodes")
+
+    os.makedirs(GRIB_INDEX_DIR, exist_ok=True)
+    key = hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest()[:16]
+    backend_kwargs = {'indexpath': os.path.join(GRIB_INDEX_DIR, key + '.{short_hash}.idx')}
+    try:
+        return xr.open_dataset(source, engine='cfgrib', backend_kwargs=backend_kwargs)
+    except cfgrib.dataset.DatasetBuildError:
+        groups = {}
+        for ds in cfgrib.open_datasets(source, backend_kwargs=backend_kwargs):
+            ds = normalize_coords(ds)
+            grid = tuple(ds.sizes.get(dim) for dim in ('time', 'lat', 'lon'))
+            groups.setdefault(grid, []).append(ds)
+        group = max(groups.values(), key=lambda datasets: sum(len(ds.data_vars) for ds in datasets))
+        return xr.merge(group, compat='override', combine_attrs='drop_conflicts')
+
+
+def normalize_coords(ds):
     """
-    根据文件内容和名称加载数据集，并将其转换为可JSON序列化的字典。
-    支持 .nc (NetCDF) 和 .grib 格式。
+    将坐标和维度名称统一为 time/lat/lon。
+
+    只重命名坐标、交换维度或增加长度为 1 的维度，不复制变量数据，惰性数据集
+    仍保持惰性。
+
+    参数:
+    - ds (xarray.Dataset): 原始数据集。
+
+    返回:
+    - xarray.Dataset: 使用标准名称的数据集。
+    """
+    # cfgrib 中 time 为起报时间，valid_time 才是数据对应的时刻
+    if 'step' in ds.dims and ds.sizes['step'] == 1:
+        ds = ds.squeeze('step')
+    if 'valid_time' in ds.variables:
+        if 'valid_time' in ds.dims:
+            ds = ds.drop_vars([name for name in ('time',) if name in ds.variables and name not in ds.dims])
+            ds = ds.rename({'valid_time': 'time'})
+        elif ds['valid_time'].dims == ('time',):
+            ds = ds.swap_dims({'time': 'valid_time'}).drop_vars('time').rename({'valid_time': 'time'})
+        elif 'step' in ds.dims:
+            print("警告：暂不支持包含多个预报步长的数据，时间维为起报时间")
+
+    renames = {}
+    for canonical, aliases in COORD_ALIASES.items():
+        if canonical in ds.variables or canonical in ds.dims:
+            continue
+        for alias in aliases:
+            if alias in ds.variables or alias in ds.dims:
+                renames[alias] = canonical
+                break
+    if renames:
+        ds = ds.rename(renames)
+
+    # 只有一个时刻的文件中 time 为标量坐标，补出长度为 1 的时间维
+    if 'time' in ds.coords and 'time' not in ds.dims and ds['time'].ndim == 0:
+        ds = ds.expand_dims('time')
+    return ds
+
+
+def open_source(source, file_name=None, chunks=None):
+    """
+    按扩展名选择读取函数打开数据文件，并统一坐标名称。source 为 glob 模式时把匹配的
+    全部文件沿 time 维惰性拼接（见 multifile.py）。
+
+    参数:
+    - source (str or file-like): 文件路径、glob 模式或文件对象。
+    - file_name (str): 用于判断格式的文件名，默认与 source 相同。
+    - chunks (dict): 统一名称后使用的 dask 分块，为 None 时不分块（仍为惰性读取）。
+
+    返回:
+    - xarray.Dataset
+    """
+    if file_name is None and is_multifile_pattern(source):
+        return open_multifile(source, open_source, chunks)
+    file_name = file_name or source
+    extension = os.path.splitext(file_name)[1].lower()
+    reader = READERS.get(extension)
+    if reader is None:
+        raise ValueError(f"不支持的文件格式: {os.path.basename(file_name)}")
+    ds = normalize_coords(reader(source))
+    if chunks:
+        ds = ds.chunk(chunks)
+    return ds
+
+
+def load_dataset(file_content, file_name, lazy=True):
+    """
+    根据文件内容和名称加载数据集，返回服务器端使用的 xarray 数据集。
+    支持 READERS 中注册的格式；GRIB 文件需要从磁盘读取，请使用 load_dataset_from_path。
 
     参数:
     - file_content (str): Base64 编码的文件内容。
     - file_name (str): 上传的文件名。
+    - lazy (bool): 为 True 时只读取元数据和坐标，变量数据在逐帧访问时才读取；
+      为 False 时一次性将全部变量读入内存。
 
     返回:
-    - tuple: (JSON字典, 时间坐标, 经度, 纬度, 可视化选项)
+    - tuple: (xarray数据集, 时间坐标, 经度, 纬度, 可视化选项)
     """
-    ds_dict = {}
-    time_coords = []
-    lons = []
-    lats = []
-    visualization_options = []
-
     try:
-        content_type, content_string = file_content.split(',')
-        decoded = base64.b64decode(content_string)
+        with metrics.stage('decode'):
+            content_type, content_string = file_content.split(',')
+            decoded = base64.b64decode(content_string)
 
         file_buffer = io.BytesIO(decoded)
-
-        if file_name.endswith('.nc'):
-            # 使用 dask 自动分块，优化大文件处理
-            ds = xr.open_dataset(file_buffer, chunks={'time': 1000})
-
-            ds_dict = {
-                'variables': {},
-                'coords': {
-                    # 将时间坐标转换为字符串，因为dcc.Store无法直接存储numpy日期时间对象
-                    'time': ds.time.values.astype(str).tolist(),
-                    'lon': ds.lon.values.tolist(),
-                    'lat': ds.lat.values.tolist()
-                }
-            }
-
-            # 提取所有变量的数据并转换为列表，使用dask.array.array将其转换为dask数组
-            for var in ds.data_vars:
-                if 'time' in ds[var].dims and 'lon' in ds[var].dims:
-                    # 仅加载可视化所需的数据，而不是整个数据集
-                    data = ds[var].values
-                    # 为了在dcc.Store中存储，需要将数据转换为列表
-                    ds_dict['variables'][var] = data.tolist()
-
-            time_coords = ds.time.values
-            lons = ds.lon.values
-            lats = ds.lat.values[::-1]
-
-            dynamic_options = [{'label': var, 'value': var} for var in ds.data_vars if
-                               'time' in ds[var].dims and 'lon' in ds[var].dims]
-            visualization_options = [
-                                        {'label': '大气河流可视化', 'value': 'Combined'},
-                                        {'label': '待拓展', 'value': 'Other'}
-                                    ] + dynamic_options
-
-            return ds_dict, time_coords, lons, lats, visualization_options
-
-        elif file_name.endswith('.grib'):
-            print("注意：目前尚不支持GRIB文件格式，请上传NetCDF文件。")
-            return {}, [], [], [], []
-        else:
-            print("不支持的文件格式。")
-            return {}, [], [], [], []
+        with metrics.stage('open'):
+            return _prepare_dataset(open_source(file_buffer, file_name, FRAME_CHUNKS), lazy)
 
     except Exception as e:
         print(f"错误：加载文件时出错 - {str(e)}")
-        return {}, [], [], [], []
+        return None, [], [], [], []
+
+
+def load_dataset_from_path(path, lazy=True):
+    """
+    从服务器本地路径加载数据集。
+
+    与 load_dataset 不同，文件不经过 base64 解码和内存缓冲，由 xarray/netCDF4
+    直接从磁盘按需读取。路径为 convert.py 生成的逐帧存储目录时直接打开该存储。
+
+    参数:
+    - path (str): 服务器本地的数据文件或逐帧存储路径。
+    - lazy (bool): 同 load_dataset。
+
+    返回:
+    - tuple: (xarray数据集, 时间坐标, 经度, 纬度, 可视化选项)
+    """
+    try:
+        with metrics.stage('open'):
+            if is_frame_store(path):
+                return _prepare_dataset(open_frame_store(path, chunks=FRAME_CHUNKS), lazy)
+            return _prepare_dataset(open_source(path, chunks=FRAME_CHUNKS), lazy)
+
+    except Exception as e:
+        print(f"错误：加载文件 {path} 时出错 - {str(e)}")
+        return None, [], [], [], []
+
+
+def _prepare_dataset(ds, lazy):
+    # 只保留可视化所需的 (time, lon) 变量，数据集保存在服务器端注册表中
+    dynamic_vars = [var for var in ds.data_vars if 'time' in ds[var].dims and 'lon' in ds[var].dims]
+    # 派生变量（见 derived.py）以惰性数组加入，和原有变量一样出现在变量选择框中
+    ds = add_derived_variables(ds[dynamic_vars])
+    dynamic_vars = list(ds.data_vars)
+    if not lazy:
+        ds = ds.load()
+
+    time_coords = ds.time.values
+    lons = ds.lon.values
+    lats = ds.lat.values[::-1]
+
+    dynamic_options = [{'label': f"{var}（派生：{ds[var].attrs['long_name']}）" if 'derived_from' in ds[var].attrs
+                        else var, 'value': var} for var in dynamic_vars]
+    visualization_options = [
+                                {'label': '大气河流可视化', 'value': 'Combined'},
+                                {'label': '待拓展', 'value': 'Other'}
+                            ] + dynamic_options
+
+    return ds, time_coords, lons, lats, visualization_options
+
+
+def read_frame(ds, var_names, time_index):
+    """
+    读取若干变量在指定时间步的二维（或一维）切片。
+
+    所有变量的切片在一次计算中读出，惰性数据集只会访问该时间步对应的数据块。
+
+    参数:
+    - ds (xarray.Dataset): 数据集。
+    - var_names (list): 变量名列表，数据集中不存在的变量会被忽略。
+    - time_index (int): 时间步索引。
+
+    返回:
+    - dict: {变量名: numpy数组}
+    """
+    names = [name for name in var_names if name in ds.data_vars]
+    with metrics.stage('slice'):
+        frame = ds[names].isel(time=time_index).compute()
+    return {name: frame[name].values for name in names}
@@ -0,0 +1,153 @@
+# dataset_registry.py
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from metrics import metrics
+
+# 注册表默认可占用的内存上限（字节），超出后按最近最少使用顺序淘汰
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def estimate_resident_nbytes(ds):
+    """
+    估算数据集实际驻留在内存中的字节数。
+
+    惰性打开的变量以 dask 数组表示（chunks 不为 None），只有在逐帧访问时才读取，
+    因此不计入；已读入内存的变量和坐标按其 nbytes 计入。
+    """
+    return int(sum(var.nbytes for var in ds.variables.values() if var.chunks is None))
+
+
+class DatasetEntry:
+    """
+    注册表中的一条记录，保存服务器端已打开的 xarray 数据集及其坐标。
+    """
+
+    def __init__(self, dataset_id, ds, time_coords, lons, lats, nbytes, source=None, temp_path=None, pyramid=None,
+                 tracks=None):
+        self.dataset_id = dataset_id
+        self.ds = ds
+        self.time_coords = time_coords
+        self.lons = lons
+        self.lats = lats
+        self.nbytes = nbytes
+        self.source = source
+        # 分块上传产生的临时文件，释放记录时一并删除
+        self.temp_path = temp_path
+        # 预先生成的多分辨率金字塔（见 pyramid.py），没有时为 None
+        self.pyramid = pyramid
+        # 全部时间步的 AR 轨迹索引（见 tracks.py），文件中没有逐 AR 变量时为 None
+        self.tracks = tracks
+
+    @property
+    def n_times(self):
+        return len(self.time_coords)
+
+    def close(self):
+        try:
+            self.ds.close()
+            if self.pyramid is not None:
+                self.pyramid.close()
+        except Exception as e:
+            print(f"警告：关闭数据集 {self.dataset_id} 时出错 - {str(e)}")
+        if self.temp_path is not None and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class DatasetRegistry:
+    """
+    按上传ID保存数据集的服务器端注册表。
+
+    浏览器端的 dcc.Store 只保存一个很小的句柄（dataset_id），回调函数通过句柄
+    从这里取回数据集，避免整份数据在每次请求中往返传输。总内存按字节预算做
+    LRU 淘汰，也可以通过 release 显式释放。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._current_bytes = 0
+
+    @property
+    def current_bytes(self):
+        return self._current_bytes
+
+    def register(self, ds, time_coords, lons, lats, nbytes=None, source=None, temp_path=None, pyramid=None,
+                 tracks=None, dataset_id=None):
+        """
+        注册一个数据集并返回其句柄。
+
+        参数:
+        - ds (xarray.Dataset): 已打开的数据集。
+        - time_coords, lons, lats: 数据集的时间、经度、纬度坐标。
+        - nbytes (int): 该数据集计入预算的字节数，默认按 estimate_resident_nbytes 估算。
+        - source (str): 数据来源（文件名或路径），仅用于显示和调试。
+        - temp_path (str): 释放时需要删除的临时文件路径。
+        - pyramid (Pyramid): 该文件的多分辨率金字塔。
+        - tracks (ARTrackIndex): 该文件的 AR 轨迹索引。
+        - dataset_id (str): 指定句柄，默认生成一个新的随机ID。
+
+        返回:
+        - str: 数据集句柄。
+        """
+        if dataset_id is None:
+            dataset_id = uuid.uuid4().hex
+        if nbytes is None:
+            nbytes = estimate_resident_nbytes(ds)
+
+        entry = DatasetEntry(dataset_id, ds, time_coords, lons, lats, nbytes, source, temp_path, pyramid,
+                             tracks)
+        with self._lock:
+            if dataset_id in self._entries:
+                self._remove(dataset_id)
+            self._entries[dataset_id] = entry
+            self._current_bytes += nbytes
+            self._evict()
+        return dataset_id
+
+    def get(self, dataset_id):
+        """根据句柄取回记录，不存在（或已被淘汰）时返回 None。"""
+        if dataset_id is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(dataset_id)
+            if entry is not None:
+                self._entries.move_to_end(dataset_id)
+            return entry
+
+    def release(self, dataset_id):
+        """显式释放一个数据集，返回是否确实释放了记录。"""
+        with self._lock:
+            if dataset_id not in self._entries:
+                return False
+            self._remove(dataset_id)
+            return True
+
+    def _remove(self, dataset_id):
+        entry = self._entries.pop(dataset_id)
+        self._current_bytes -= entry.nbytes
+        entry.close()
+
+    def _evict(self):
+        # 至少保留最近注册的一条记录，即使它本身已超出预算
+        while self._current_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest_id = next(iter(self._entries))
+            print(f"内存预算已满，释放数据集 {oldest_id}")
+            self._remove(oldest_id)
+
+    def __contains__(self, dataset_id):
+        with self._lock:
+            return dataset_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+# 进程内共享的全局注册表
+dataset_registry = DatasetRegistry()
+metrics.register_gauge('ar_vis_registry_bytes', '数据集注册表计入预算的字节数', lambda: dataset_registry.current_bytes)
+metrics.register_gauge('ar_vis_registry_datasets', '注册表中的数据集个数', lambda: len(dataset_registry))
@@ -0,0 +1,263 @@
+# derived.py
+"""
+由数据集中已有变量计算得到的派生变量（IVT 强度和方向、风速、降水单位换算等）。
+
+派生变量在 DERIVED_VARIABLES 中登记为若干输入变量上的向量化 NumPy 表达式，打开
+文件时对输入齐全的派生变量，以惰性的 dask 数组加入数据集，之后与文件中原有的
+变量一样出现在变量选择框中，逐帧渲染、时间统计和时间序列都直接使用。
+
+派生数组按时间块求值：某个时间步第一次被访问时读取输入、计算并把结果保存到
+有上限的缓存中；之后的帧、时间统计和序列查询读取缓存，不再读取输入或重新计算。
+缓存键由源文件的路径、大小和修改时间得到，与分块方式无关：应用中逐帧打开的数据集
+和时间统计按时间块重新打开的数据集共用缓存，再次打开同一文件时也仍然命中。
+"""
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import dask
+import dask.array as dsa
+import numpy as np
+from dask.base import tokenize
+
+from frame_store import MANIFEST_NAME, part_path, read_manifest
+from metrics import metrics
+from multifile import is_multifile_pattern, match_files
+
+# 派生变量结果缓存的内存上限（字节）
+DERIVED_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# name -> DerivedVariable
+DERIVED_VARIABLES = {}
+
+# inputs 为候选输入组合的列表，使用第一组在数据集中齐全的变量；
+# check(sources) 返回 False 时（如单位无法识别）不加入该派生变量
+DerivedVariable = namedtuple('DerivedVariable', ['name', 'inputs', 'func', 'units', 'label', 'check'])
+
+
+def register_derived(name, *inputs, units='', label=None, check=None):
+    """
+    登记一个派生变量，用作装饰器。被装饰的函数以 (sources, *输入数组) 调用，返回与
+    输入形状相同的数组；sources 为各输入变量的惰性 DataArray，只用于读取属性和坐标。
+
+    示例:
+        @register_derived('wind_speed', ('u', 'v'), units='m s-1', label='风速')
+        def wind_speed(sources, u, v):
+            return np.hypot(u, v)
+    """
+    def decorator(func):
+        DERIVED_VARIABLES[name] = DerivedVariable(name, [tuple(group) for group in inputs], func, units,
+                                                  label or name, check)
+        return func
+    return decorator
+
+
+@register_derived('ivt_magnitude', ('ivtx', 'ivty'), units='kg m-1 s-1', label='AR 质心 IVT 强度')
+def ivt_magnitude(sources, ivtx, ivty):
+    return np.hypot(ivtx, ivty)
+
+
+@register_derived('ivt_direction', ('ivtx', 'ivty'), units='degree', label='AR 质心 IVT 方向')
+def ivt_direction(sources, ivtx, ivty):
+    return np.rad2deg(np.arctan2(ivty, ivtx))
+
+
+# ERA5 整层水汽通量的东、北分量（cfgrib 中为参数号）
+@register_derived('ivt', ('viwve', 'viwvn'), ('p71.162', 'p72.162'), units='kg m-1 s-1', label='IVT 强度')
+def ivt_grid(sources, eastward, northward):
+    return np.hypot(eastward, northward)
+
+
+@register_derived('wind_speed', ('u', 'v'), units='m s-1', label='风速')
+def wind_speed(sources, u, v):
+    return np.hypot(u, v)
+
+
+@register_derived('wind_speed_10m', ('u10', 'v10'), units='m s-1', label='10 米风速')
+def wind_speed_10m(sources, u10, v10):
+    return np.hypot(u10, v10)
+
+
+# 降水量或降水率的单位 -> 换算为 mm/day 的方式：'step' 表示每个时间步的累积量（乘以
+# 每天的时间步数），'rate' 表示每秒的速率
+PRECIPITATION_UNITS = {
+    'm': (1000.0, 'step'),
+    'mm': (1.0, 'step'),
+    'kg m-2': (1.0, 'step'),
+    'kg m**-2': (1.0, 'step'),
+    'kg m-2 s-1': (86400.0, 'rate'),
+    'kg m**-2 s**-1': (86400.0, 'rate'),
+    'mm s-1': (86400.0, 'rate'),
+}
+
+
+def _precipitation_scale(source):
+    """返回把降水变量换算为 mm/day 的倍数，单位无法识别或时间步长未知时返回 None。"""
+    units = PRECIPITATION_UNITS.get(source.attrs.get('units', '').strip())
+    if units is None:
+        return None
+    factor, kind = units
+    if kind == 'rate':
+        return factor
+    if source.sizes['time'] < 2:
+        return None
+    step_seconds = float(np.median(np.diff(source['time'].values)) / np.timedelta64(1, 's'))
+    return factor * 86400.0 / step_seconds if step_seconds > 0 else None
+
+
+@register_derived('precipitation_mm_day', ('tp',), ('pr',), ('mtpr',), units='mm day-1', label='降水 (mm/day)',
+                  check=lambda sources: _precipitation_scale(sources[0]) is not None)
+def precipitation_mm_day(sources, precipitation):
+    return precipitation * _precipitation_scale(sources[0])
+
+
+class DerivedCache:
+    """
+    派生变量逐时间步结果的 LRU 缓存，键为 (输入标识, 变量名, 时间步)，按字节数限制大小。
+    """
+
+    def __init__(self, max_bytes=DERIVED_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._fields = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def current_bytes(self):
+        return self._current_bytes
+
+    def get(self, key):
+        with self._lock:
+            field = self._fields.get(key)
+            if field is not None:
+                self._fields.move_to_end(key)
+            return field
+
+    def put(self, key, field):
+        with self._lock:
+            if key in self._fields:
+                return
+            self._fields[key] = field
+            self._current_bytes += field.nbytes
+            while self._current_bytes > self.max_bytes and len(self._fields) > 1:
+                self._current_bytes -= self._fields.popitem(last=False)[1].nbytes
+
+
+# 进程内共享的派生变量缓存
+derived_cache = DerivedCache()
+
+metrics.register_gauge('ar_vis_derived_cache_bytes', '派生变量缓存的字节数', lambda: derived_cache.current_bytes)
+
+
+class _DerivedArray:
+    """
+    一个派生变量的惰性数组，供 dask.array.from_array 按时间块读取。
+    """
+
+    def __init__(self, sources, spec, token, shape, dtype, time_axis):
+        self.sources = sources
+        self.spec = spec
+        self.token = token
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len(shape)
+        self.time_axis = time_axis
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        time_key = key[self.time_axis]
+        steps = np.arange(self.shape[self.time_axis])[time_key]
+        fields = self._fields(np.atleast_1d(steps))
+        values = np.stack(fields, axis=self.time_axis)
+        # 时间维已按 time_key 取出，其余维度再按 key 取子集
+        rest = key[:self.time_axis] + (slice(None) if np.ndim(steps) else 0,) + key[self.time_axis + 1:]
+        return values[rest]
+
+    def _fields(self, steps):
+        fields = {}
+        for step in steps:
+            field = derived_cache.get((self.token, self.spec.name, int(step)))
+            metrics.inc('ar_vis_derived_cache_requests_total', result='hit' if field is not None else 'miss')
+            if field is not None:
+                fields[int(step)] = field
+        missing = [int(step) for step in steps if int(step) not in fields]
+        if missing:
+            # 在 dask 任务中读取输入，使用同步调度器，避免占用线程池造成死锁
+            with dask.config.set(scheduler='synchronous'):
+                arrays = [source.isel(time=missing).values for source in self.sources]
+            result = np.asarray(self.spec.func(self.sources, *arrays), dtype=self.dtype)
+            for position, step in enumerate(missing):
+                field = np.ascontiguousarray(np.take(result, position, axis=self.time_axis))
+                derived_cache.put((self.token, self.spec.name, step), field)
+                fields[step] = field
+        return [fields[int(step)] for step in steps]
+
+
+def _source_files(path):
+    """
+    数据来源对应的全部磁盘文件，不在磁盘上时为空列表。多文件数据集的 encoding 中记录的
+    是 glob 模式，这里换成模式匹配的全部文件；逐帧存储由多个时间段文件拼接而成，
+    encoding 中只记录了第一个文件，这里换成存储清单和清单中的全部时间段文件。
+    """
+    if is_multifile_pattern(path):
+        return match_files(path)
+    if not os.path.exists(path):
+        return []
+    store = os.path.dirname(os.path.abspath(path))
+    manifest = read_manifest(store)
+    if manifest is None or not manifest.get('complete', False):
+        return [os.path.abspath(path)]
+    return [os.path.join(store, MANIFEST_NAME)] + [part_path(store, start) for start in manifest['parts']]
+
+
+def _source_token(ds, sources):
+    """派生结果缓存键中的数据来源标识：文件在磁盘上时取其路径和状态，否则取输入数据的 dask 标识。"""
+    path = ds.encoding.get('source')
+    names = _source_files(path) if isinstance(path, str) else []
+    if names:
+        files = []
+        for name in names:
+            stat = os.stat(name)
+            files.append((name, stat.st_size, stat.st_mtime))
+        return tokenize(files, [source.name for source in sources])
+    return tokenize(*(source.variable for source in sources))
+
+
+def add_derived_variables(ds):
+    """
+    把输入齐全的派生变量以惰性数组加入数据集，名称与已有变量相同的不加入。
+
+    参数:
+    - ds (xarray.Dataset): 统一坐标名称后的数据集。
+
+    返回:
+    - xarray.Dataset: 加入派生变量后的数据集（不复制原有变量）。
+    """
+    derived = {}
+    for spec in DERIVED_VARIABLES.values():
+        if spec.name in ds.data_vars:
+            continue
+        inputs = next((group for group in spec.inputs if all(name in ds.data_vars for name in group)), None)
+        if inputs is None or len({ds[name].dims for name in inputs}) != 1 or 'time' not in ds[inputs[0]].dims:
+            continue
+        sources = [ds[name] for name in inputs]
+        if spec.check is not None and not spec.check(sources):
+            continue
+        source = sources[0]
+        time_axis = source.dims.index('time')
+        dtype = np.result_type(*(source.dtype for source in sources), np.float32)
+        token = _source_token(ds, sources)
+        array = _DerivedArray(sources, spec, token, source.shape, dtype, time_axis)
+        # 沿用输入的时间分块，其余维度不分块
+        time_chunks = source.chunks[time_axis] if source.chunks else 1
+        chunks = tuple(time_chunks if axis == time_axis else size for axis, size in enumerate(source.shape))
+        data = dsa.from_array(array, chunks=chunks, name=f"derived-{token}-{spec.name}", lock=False,
+                              meta=np.empty((0,) * source.ndim, dtype=dtype))
+        derived[spec.name] = (source.dims, data, {'units': spec.units, 'long_name': spec.label,
+                                                  'derived_from': ', '.join(inputs)})
+    if not derived:
+        return ds
+    print(f"加入派生变量：{', '.join(derived)}")
+    return ds.assign(derived)
@@ -0,0 +1,178 @@
+# frame_cache.py
+import numbers
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from metrics import metrics
+
+# 已渲染帧缓存默认可占用的内存上限（字节）
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2
+
+# 播放时在后台预先渲染的后续帧数
+PREFETCH_FRAMES = 4
+
+# 客户端播放时一次下发的帧数，以及剩余多少帧时请求下一个窗口
+PLAYBACK_WINDOW_FRAMES = 24
+PLAYBACK_WINDOW_MARGIN = 4
+
+# 估计图形大小时，JSON 列表中每个数值按该字节数计
+JSON_NUMBER_BYTES = 12
+
+
+def _estimate_nbytes(value):
+    """
+    估计图形属性序列化后的字节数：numpy 数组按 base64 类型化数组（nbytes 的 4/3），
+    列表中的数值按 JSON_NUMBER_BYTES，其余递归累加。不做序列化，耗时与属性个数成正比。
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes * 4 // 3
+    if isinstance(value, dict):
+        return sum(len(key) + _estimate_nbytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], numbers.Number):
+            return len(value) * JSON_NUMBER_BYTES
+        return sum(_estimate_nbytes(item) for item in value)
+    if isinstance(value, str):
+        return len(value)
+    return JSON_NUMBER_BYTES
+
+
+def estimate_figure_nbytes(figure):
+    """估计图形序列化后的字节数，直接读取各轨迹和布局的属性字典，不复制也不序列化。"""
+    return (sum(_estimate_nbytes(trace._props) for trace in figure.data)
+            + _estimate_nbytes(figure.layout._props))
+
+
+class FrameCache:
+    """
+    已渲染图形的 LRU 缓存，键为 (数据集ID, 变量, 时间索引, 渲染选项)。
+
+    拖动滑块回到已经显示过的帧时直接返回缓存结果；播放时通过 prefetch 在后台
+    线程池中提前渲染后续若干帧。总大小按估计的图形序列化字节数限制（见 estimate_figure_nbytes）。
+
+    每个数据集有一个代数，invalidate 时递增。渲染开始时记下代数，写入缓存前再比较，
+    invalidate 之前开始的渲染（包括仍在运行的预取）结果不会再进入缓存。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, prefetch_workers=2):
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._in_flight = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._current_bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix='frame-prefetch')
+
+    @property
+    def current_bytes(self):
+        return self._current_bytes
+
+    def get(self, key):
+        """返回缓存的 (图形, 时间显示字符串)，未命中时返回 None。"""
+        with self._lock:
+            cached = self._frames.get(key)
+            if cached is None:
+                return None
+            self._frames.move_to_end(key)
+            return cached[0]
+
+    def generation(self, dataset_id):
+        with self._lock:
+            return self._generations.get(dataset_id, 0)
+
+    def put(self, key, payload, generation=None):
+        """写入一帧；给出 generation 且数据集已在此后被 invalidate 时丢弃结果。"""
+        nbytes = estimate_figure_nbytes(payload[0])
+        with self._lock:
+            if generation is not None and generation != self._generations.get(key[0], 0):
+                return
+            if key in self._frames:
+                self._current_bytes -= self._frames.pop(key)[1]
+            self._frames[key] = (payload, nbytes)
+            self._current_bytes += nbytes
+            while self._current_bytes > self.max_bytes and len(self._frames) > 1:
+                self._current_bytes -= self._frames.popitem(last=False)[1][1]
+
+    def get_or_render(self, key, render):
+        """
+        返回缓存中的帧，未命中时调用 render() 渲染并写入缓存。
+
+        如果同一帧正在后台预取，则等待预取结果而不是重复渲染。
+
+        参数:
+        - key (tuple): 缓存键。
+        - render (callable): 无参数函数，返回 (go.Figure, str)。
+
+        返回:
+        - tuple: (go.Figure, str)
+        """
+        cached = self.get(key)
+        if cached is not None:
+            metrics.inc('ar_vis_frame_cache_requests_total', result='hit')
+            return cached
+
+        with self._lock:
+            future = self._in_flight.get(key)
+        if future is not None:
+            try:
+                payload = future.result()
+                metrics.inc('ar_vis_frame_cache_requests_total', result='prefetched')
+                return payload
+            except Exception:
+                # 预取失败时在前台重新渲染，以便把错误交给调用方处理
+                pass
+
+        metrics.inc('ar_vis_frame_cache_requests_total', result='miss')
+        generation = self.generation(key[0])
+        payload = render()
+        self.put(key, payload, generation)
+        return payload
+
+    def prefetch(self, jobs):
+        """
+        在后台线程池中渲染尚未缓存的帧。
+
+        参数:
+        - jobs (list): [(缓存键, render函数)] 列表，已缓存或正在渲染的帧会被跳过。
+        """
+        for key, render in jobs:
+            with self._lock:
+                if key in self._frames or key in self._in_flight:
+                    continue
+                generation = self._generations.get(key[0], 0)
+                future = self._executor.submit(self._render_in_background, key, render, generation)
+                self._in_flight[key] = future
+
+    def _render_in_background(self, key, render, generation):
+        try:
+            payload = render()
+            self.put(key, payload, generation)
+            return payload
+        except Exception as e:
+            print(f"警告：预取帧 {key} 失败 - {str(e)}")
+            raise
+        finally:
+            with self._lock:
+                # invalidate 之后同一个键可能已经有新的预取任务，只移除本代的记录
+                if generation == self._generations.get(key[0], 0):
+                    self._in_flight.pop(key, None)
+
+    def invalidate(self, dataset_id):
+        """
+        删除某个数据集的全部缓存帧，在数据集被释放时调用。正在进行的预取不再被等待，
+        其结果也不会写入缓存。
+        """
+        with self._lock:
+            self._generations[dataset_id] = self._generations.get(dataset_id, 0) + 1
+            for key in [k for k in self._frames if k[0] == dataset_id]:
+                self._current_bytes -= self._frames.pop(key)[1]
+            for key in [k for k in self._in_flight if k[0] == dataset_id]:
+                del self._in_flight[key]
+
+
+# 进程内共享的全局帧缓存
+frame_cache = FrameCache()
+metrics.register_gauge('ar_vis_frame_cache_bytes', '已渲染帧缓存的字节数', lambda: frame_cache.current_bytes)
@@ -0,0 +1,74 @@
+# frame_store.py
+"""
+按逐帧读取优化的本地分块存储（由 convert.py 生成）。
+
+存储是一个以 .frames 结尾的目录，其中 manifest.json 记录格式版本、源文件指纹、
+变量和打包方式，数据按时间段写成若干 part_<起始时间步>.nc 文件。每个变量按
+(时间分块, 完整纬度, 完整经度) 分块，读取一帧只需解压一个数据块。
+"""
+import json
+import os
+
+import xarray as xr
+
+STORE_SUFFIX = '.frames'
+STORE_FORMAT = 'ar-vis-frames'
+STORE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+
+def default_store_path(source_path):
+    return os.path.splitext(os.path.abspath(source_path))[0] + STORE_SUFFIX
+
+
+def part_path(store_path, start):
+    return os.path.join(store_path, f'part_{start:08d}.nc')
+
+
+def read_manifest(store_path):
+    try:
+        with open(os.path.join(store_path, MANIFEST_NAME), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('format') != STORE_FORMAT:
+        return None
+    return manifest
+
+
+def write_manifest(store_path, manifest):
+    # 先写临时文件再替换，中断时清单不会损坏
+    path = os.path.join(store_path, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def is_frame_store(path):
+    """判断路径是否为已转换完成的逐帧存储。"""
+    if not os.path.isdir(path):
+        return False
+    manifest = read_manifest(path)
+    return manifest is not None and manifest.get('complete', False)
+
+
+def open_frame_store(store_path, chunks=None):
+    """
+    惰性打开逐帧存储，各时间段文件沿 time 维拼接为一个数据集。
+
+    参数:
+    - store_path (str): 存储目录。
+    - chunks (dict): 传给 xarray 的 dask 分块，默认沿用存储的时间分块。
+
+    返回:
+    - xarray.Dataset
+    """
+    manifest = read_manifest(store_path)
+    if manifest is None or not manifest.get('complete', False):
+        raise ValueError(f"{store_path} 不是完整的逐帧存储")
+    if chunks is None:
+        chunks = {'time': manifest['time_chunk']}
+    paths = [part_path(store_path, start) for start in manifest['parts']]
+    # 各时间段的坐标和静态变量完全相同，不再逐个比较
+    return xr.open_mfdataset(paths, combine='nested', concat_dim='time', chunks=chunks,
+                             data_vars='minimal', coords='minimal', compat='override')
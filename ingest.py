@@ -0,0 +1,210 @@
+# ingest.py
+import os
+import re
+import tempfile
+import time
+from flask import request, jsonify, abort
+
+from data_loader import READERS
+from frame_store import is_frame_store
+from multifile import is_multifile_pattern, match_files
+
+# 可通过路径选择器打开的服务器本地数据目录，多个目录用 os.pathsep 分隔
+DATA_DIRS = [os.path.abspath(d) for d in
+             os.environ.get('AR_VIS_DATA_DIRS', os.path.join(os.getcwd(), 'data')).split(os.pathsep) if d]
+
+# 分块上传的临时文件目录
+SPOOL_DIR = os.environ.get('AR_VIS_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'ar_vis_spool'))
+
+# 路径选择器中列出、分块上传接受的文件类型，即 data_loader 中注册了读取函数的格式
+DATA_EXTENSIONS = tuple(READERS)
+
+# 从请求流写入临时文件时每次复制的字节数
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# 分块上传的文件大小上限（字节）
+MAX_UPLOAD_BYTES = int(os.environ.get('AR_VIS_MAX_UPLOAD_BYTES', 64 * 1024 ** 3))
+
+# 超过该时间（秒）没有再写入的未完成上传视为已放弃，其临时文件被删除
+STALE_UPLOAD_SECONDS = int(os.environ.get('AR_VIS_STALE_UPLOAD_SECONDS', 24 * 3600))
+
+_UPLOAD_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+
+def _is_within(path, directory):
+    return os.path.commonpath([path, directory]) == directory
+
+
+def resolve_data_path(path):
+    """
+    将用户输入的路径解析为绝对路径，并确认它位于允许访问的数据目录内。
+    路径为 glob 模式时（如 /data/era5/ERA5_*.nc），要求匹配的全部文件都在允许的目录内。
+
+    分块上传的临时目录 SPOOL_DIR 不可通过路径访问（即使它位于某个数据目录中），
+    其中别的用户正在上传的文件不能被浏览或打开；上传完成的文件只能通过上传 ID
+    由 spool_path 取得。
+
+    返回:
+    - str: 解析后的绝对路径；路径不存在或不在允许的目录中时返回 None。
+    """
+    if not path:
+        return None
+    if is_multifile_pattern(path):
+        resolved = os.path.abspath(os.path.expanduser(path.strip()))
+        matched = [os.path.realpath(p) for p in match_files(resolved)]
+    else:
+        resolved = os.path.realpath(os.path.expanduser(path.strip()))
+        matched = [resolved] if os.path.exists(resolved) else []
+    if not matched:
+        return None
+    allowed = [os.path.realpath(d) for d in DATA_DIRS]
+    spool = os.path.realpath(SPOOL_DIR)
+    if not all(any(_is_within(p, d) for d in allowed) and not _is_within(p, spool) for p in matched):
+        print(f"警告：拒绝访问数据目录之外的路径 {resolved}")
+        return None
+    return resolved
+
+
+def list_data_files(path):
+    """
+    列出路径中可供打开的数据文件和逐帧存储目录。路径为文件、逐帧存储或 glob 模式时
+    只返回它本身。目录中同一格式的文件有多个时，另外列出把它们按时间拼接打开的选项。
+
+    返回:
+    - list: 路径选择器使用的 [{'label', 'value'}] 选项列表。
+    """
+    resolved = resolve_data_path(path)
+    if resolved is None:
+        return []
+    if is_multifile_pattern(resolved):
+        return [{'label': f"{os.path.basename(resolved)} ({len(match_files(resolved))} 个文件)", 'value': resolved}]
+    if os.path.isfile(resolved) or is_frame_store(resolved):
+        return [{'label': os.path.basename(resolved), 'value': resolved}]
+
+    options = []
+    counts = {}
+    for name in os.listdir(resolved):
+        extension = os.path.splitext(name)[1].lower()
+        if extension in DATA_EXTENSIONS and os.path.isfile(os.path.join(resolved, name)):
+            counts[extension] = counts.get(extension, 0) + 1
+    for extension, count in sorted(counts.items()):
+        if count > 1:
+            options.append({'label': f"全部 *{extension} ({count} 个文件，按时间拼接)",
+                            'value': os.path.join(resolved, '*' + extension)})
+    spool = os.path.realpath(SPOOL_DIR)
+    for name in sorted(os.listdir(resolved)):
+        full_path = os.path.join(resolved, name)
+        if _is_within(os.path.realpath(full_path), spool):
+            continue
+        if os.path.isfile(full_path) and name.lower().endswith(DATA_EXTENSIONS):
+            options.append({'label': name, 'value': full_path})
+        elif is_frame_store(full_path):
+            options.append({'label': f"{name} (逐帧存储)", 'value': full_path})
+    return options
+
+
+def _part_path(upload_id):
+    return os.path.join(SPOOL_DIR, f"{upload_id}.part")
+
+
+def remove_stale_uploads(max_age=STALE_UPLOAD_SECONDS):
+    """删除临时目录中超过 max_age 秒未再写入的未完成上传（.part 文件）。"""
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(SPOOL_DIR):
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            if name.endswith('.part') and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                print(f"删除未完成的上传：{name}")
+        except OSError:
+            # 其他 worker 可能同时完成或删除了该文件
+            pass
+
+
+def spool_path(upload_id, filename, finalized=True):
+    """
+    分块上传完成后数据文件在临时目录中的路径，只保留原文件的扩展名。
+
+    finalized 为 True 时只接受已经完成的上传：扩展名是支持的数据格式且文件已存在，
+    否则返回 None，未完成的 .part 文件不能以这种方式打开。
+    """
+    if not _UPLOAD_ID_RE.fullmatch(upload_id or ''):
+        return None
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension not in DATA_EXTENSIONS:
+        return None
+    path = os.path.join(SPOOL_DIR, f"{upload_id}{extension}")
+    if finalized and not os.path.isfile(path):
+        return None
+    return path
+
+
+def register_ingest_routes(server):
+    """
+    在 Dash 底层的 Flask 服务器上注册分块上传接口。
+
+    浏览器将文件按块 POST 到 /upload/<upload_id>/chunk?offset=N，每块直接写入临时
+    文件的对应位置；全部发送后调用 /upload/<upload_id>/complete 完成上传。
+    文件不再经过 base64 编码和内存缓冲，之后可以从磁盘惰性读取。
+
+    浏览器按顺序发送分块，offset 不能超过已写入的字节数（可以重发已写入的分块），
+    文件总大小不能超过 MAX_UPLOAD_BYTES。开始新的上传时删除已放弃的临时文件。
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    remove_stale_uploads()
+
+    @server.route('/upload/<upload_id>/chunk', methods=['POST'])
+    def upload_chunk(upload_id):
+        if not _UPLOAD_ID_RE.fullmatch(upload_id):
+            abort(400)
+        offset = request.args.get('offset', default=0, type=int)
+        if offset < 0:
+            abort(400)
+
+        part_path = _part_path(upload_id)
+        received = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > received:
+            # 不允许跳过未写入的部分，否则可以制造任意大小的稀疏文件
+            return jsonify(error="分块位置超出已接收的数据", received=received), 409
+        if offset == 0 and received == 0:
+            remove_stale_uploads()
+        # 多个 worker 可能同时收到同一文件的不同分块：创建文件时不截断，避免覆盖已写入的分块
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        with open(fd, 'r+b') as f:
+            f.seek(offset)
+            too_large = False
+            while True:
+                block = request.stream.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+                if f.tell() + len(block) > MAX_UPLOAD_BYTES:
+                    too_large = True
+                    break
+                f.write(block)
+            end = f.tell()
+        if too_large:
+            os.remove(part_path)
+            return jsonify(error=f"文件超过上传大小上限 {MAX_UPLOAD_BYTES} 字节"), 413
+        return jsonify(upload_id=upload_id, received=end)
+
+    @server.route('/upload/<upload_id>/complete', methods=['POST'])
+    def upload_complete(upload_id):
+        if not _UPLOAD_ID_RE.fullmatch(upload_id):
+            abort(400)
+        payload = request.get_json(silent=True) or {}
+        filename = payload.get('filename', '')
+        if not filename.lower().endswith(DATA_EXTENSIONS):
+            return jsonify(error=f"不支持的文件格式: {filename}"), 400
+
+        part_path = _part_path(upload_id)
+        if not os.path.exists(part_path):
+            abort(404)
+        expected_size = payload.get('size')
+        if expected_size is not None and os.path.getsize(part_path) != int(expected_size):
+            return jsonify(error="文件大小不一致，上传未完成"), 400
+
+        os.replace(part_path, spool_path(upload_id, filename, finalized=False))
+        print(f"分块上传完成：{filename} ({upload_id})")
+        return jsonify(upload_id=upload_id, filename=filename)
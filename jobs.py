@@ -0,0 +1,164 @@
+# jobs.py
+"""
+在后台线程中执行耗时的文件加载任务。
+
+任务状态保存在磁盘上的任务目录中（每个任务一个 JSON 文件），浏览器通过
+dcc.Interval 定时查询；取消请求写入一个标记文件，任务在各阶段之间和扫描索引的
+每个时间块之后检查它。由于状态和取消标记都在磁盘上，多进程部署时任何 worker
+都可以回答查询和接受取消。
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_store import SHARED_DIR
+
+# 任务状态目录
+JOBS_DIR = os.environ.get('AR_VIS_JOBS_DIR', os.path.join(SHARED_DIR, 'jobs'))
+
+# 同时执行的加载任务数
+LOAD_JOB_WORKERS = 2
+
+# 任务状态文件的保留时间（秒）
+JOB_TTL_SECONDS = 24 * 3600
+
+# 加载任务的阶段 -> 显示文字，按执行顺序排列
+LOAD_STAGES = {
+    'queued': '排队中',
+    'decode': '解码上传内容',
+    'open': '打开数据集',
+    'first_frame': '渲染第一帧',
+    'index': '建立 AR 轨迹索引',
+    'done': '完成',
+}
+
+# 任务结束时的状态
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """任务已被用户取消。"""
+
+
+class Job:
+    """
+    传给任务函数的句柄，用于报告进度和检查取消请求。
+    """
+
+    def __init__(self, runner, job_id):
+        self.runner = runner
+        self.job_id = job_id
+
+    def report(self, stage, **fields):
+        """进入新的阶段，fields 一并写入任务状态（须可 JSON 序列化）。"""
+        self.runner._update(self.job_id, stage=stage, progress=None, **fields)
+
+    def progress(self, fraction):
+        """报告当前阶段的完成比例 (0~1)，同时检查取消请求。"""
+        self.runner._update(self.job_id, progress=round(float(fraction), 3))
+        self.check_cancelled()
+
+    def cancelled(self):
+        return os.path.exists(self.runner._cancel_path(self.job_id))
+
+    def check_cancelled(self):
+        if self.cancelled():
+            raise JobCancelled(self.job_id)
+
+
+class JobRunner:
+    """
+    线程池和磁盘上的任务状态表。
+    """
+
+    def __init__(self, jobs_dir=JOBS_DIR, max_workers=LOAD_JOB_WORKERS):
+        self.jobs_dir = jobs_dir
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ar-vis-job')
+        self._lock = threading.Lock()
+
+    def _status_path(self, job_id):
+        return os.path.join(self.jobs_dir, job_id + '.json')
+
+    def _cancel_path(self, job_id):
+        return os.path.join(self.jobs_dir, job_id + '.cancel')
+
+    def _write(self, job_id, status):
+        path = self._status_path(job_id)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(status, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            status = self.status(job_id) or {'job_id': job_id}
+            status.update(fields, updated=time.time())
+            self._write(job_id, status)
+
+    def submit(self, func, *args, **fields):
+        """
+        提交一个任务。
+
+        参数:
+        - func: 任务函数，以 (Job, *args) 调用；抛出 JobCancelled 时任务记为已取消，
+          抛出其他异常时记为失败。
+        - fields: 写入初始状态的附加字段（如文件名）。
+
+        返回:
+        - str: 任务ID。
+        """
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.prune()
+        job_id = uuid.uuid4().hex
+        self._write(job_id, dict(fields, job_id=job_id, state='running', stage='queued', progress=None,
+                                 created=time.time(), updated=time.time()))
+        self._executor.submit(self._run, func, Job(self, job_id), args)
+        return job_id
+
+    def _run(self, func, job, args):
+        try:
+            func(job, *args)
+            self._update(job.job_id, state='done', stage='done', progress=None)
+        except JobCancelled:
+            print(f"加载任务 {job.job_id} 已取消")
+            self._update(job.job_id, state='cancelled')
+        except Exception as e:
+            print(f"加载任务 {job.job_id} 失败: {e}")
+            self._update(job.job_id, state='failed', error=str(e))
+        finally:
+            if os.path.exists(self._cancel_path(job.job_id)):
+                os.remove(self._cancel_path(job.job_id))
+
+    def status(self, job_id):
+        """返回任务状态，任务不存在时返回 None。"""
+        if not job_id or os.sep in job_id or '/' in job_id:
+            return None
+        try:
+            with open(self._status_path(job_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def cancel(self, job_id):
+        """请求取消一个仍在执行的任务。"""
+        status = self.status(job_id)
+        if status is None or status['state'] in FINISHED_STATES:
+            return
+        open(self._cancel_path(job_id), 'w').close()
+
+    def prune(self, max_age=JOB_TTL_SECONDS):
+        """删除超过 max_age 秒的任务状态文件。"""
+        now = time.time()
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+# 进程内共享的任务执行器
+job_runner = JobRunner()
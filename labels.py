@@ -0,0 +1,201 @@
+# labels.py
+"""
+shapemap 标签场的稀疏存储。
+
+shapemap 每个时间步是一张稠密的浮点网格，但 AR 通常只覆盖百分之几的格点。这里把
+每个时间步的标签按行优先的扁平索引做游程编码：一段连续的、标签相同的格点记为
+(起点, 长度, 标签) 一条游程，起点用 int32，长度用 uint16（过长的游程拆开），
+标签按取值范围选用能容纳的最小整数类型。
+
+哪些格点属于某个 AR 由 ar_mask 统一判断：非 NaN 且不等于文件的填充值，标签为 0 或
+负数的格点同样算作 AR。稀疏编码、group_label_pixels、AR 次数统计和时间序列的覆盖
+比例都使用这一规则。各时间步的游程按标签稳定排序后首尾相接存放，
+time_bounds 给出每个时间步的游程范围，同一 AR 的游程是其中一段连续切片。
+
+于是取出某个 AR 的格点只需切出它的游程再展开，不必扫描整张网格；一个时间步的
+全部格点按标签分组的结果（与 plot_functions.group_label_pixels 相同的格式）
+也由游程直接展开得到。
+"""
+import numpy as np
+
+# 单条游程的最大长度（uint16）
+MAX_RUN_LENGTH = np.iinfo(np.uint16).max
+
+
+def label_fill_values(da):
+    """
+    标签变量中表示无标签的取值：文件中的 _FillValue 和 missing_value（NaN 除外）。
+
+    参数:
+    - da (xarray.DataArray): 标签变量，如 shapemap。
+
+    返回:
+    - tuple: 填充值，没有时为空。
+    """
+    values = set()
+    for attrs in (da.encoding, da.attrs):
+        for key in ('_FillValue', 'missing_value'):
+            if attrs.get(key) is not None:
+                values.update(float(value) for value in np.atleast_1d(attrs[key]))
+    return tuple(sorted(value for value in values if not np.isnan(value)))
+
+
+def ar_mask(values, fill_values=()):
+    """
+    标签场中属于某个 AR 的格点：非 NaN，且不等于文件的填充值。
+
+    参数:
+    - values (np.ndarray or xarray.DataArray): 标签场，可以是惰性的 DataArray。
+    - fill_values (tuple): label_fill_values 的结果。
+
+    返回:
+    - 与 values 形状相同的布尔数组。
+    """
+    mask = ~np.isnan(values)
+    for value in fill_values:
+        mask = mask & (values != value)
+    return mask
+
+
+def encode_label_grid(label_grid, fill_values=()):
+    """
+    对一个时间步的二维标签场做游程编码。
+
+    参数:
+    - label_grid (np.ndarray): 二维标签场，NaN 或填充值表示无标签，其余格点的值为整数标签。
+    - fill_values (tuple): label_fill_values 的结果。
+
+    返回:
+    - tuple: (起点, 长度, 标签) 三个数组，按 (标签, 起点) 排序。
+    """
+    flat = label_grid.ravel()
+    valid = ar_mask(flat, fill_values)
+    labels = np.where(valid, flat, 0).astype(np.int64)
+    # 标签变化处和进入、离开无标签区域处即游程的边界；有效性单独比较，标签 0 不会与 NaN 混淆
+    change = np.flatnonzero((np.diff(labels) != 0) | (np.diff(valid) != 0)) + 1
+    edges = np.concatenate([[0], change, [len(flat)]])
+    starts, stops = edges[:-1], edges[1:]
+    run_labels = labels[starts]
+    keep = valid[starts]
+    starts, lengths, run_labels = starts[keep], (stops - starts)[keep], run_labels[keep]
+    if len(lengths) and lengths.max() > MAX_RUN_LENGTH:
+        # 把过长的游程拆成若干段，使长度可以用 uint16 保存
+        pieces = -(-lengths // MAX_RUN_LENGTH)
+        offsets = np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        starts = np.repeat(starts, pieces) + offsets * MAX_RUN_LENGTH
+        lengths = np.minimum(np.repeat(lengths, pieces) - offsets * MAX_RUN_LENGTH, MAX_RUN_LENGTH)
+        run_labels = np.repeat(run_labels, pieces)
+    order = np.argsort(run_labels, kind='stable')
+    return starts[order], lengths[order], run_labels[order]
+
+
+def _label_dtype(labels):
+    """能容纳全部标签的最小整数类型。"""
+    if not len(labels):
+        return np.uint8
+    low, high = labels.min(), labels.max()
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+def _expand_runs(starts, lengths):
+    """把游程展开为扁平格点索引。"""
+    lengths = lengths.astype(np.int64)
+    total = int(lengths.sum())
+    if not total:
+        return np.array([], dtype=np.int64)
+    first = np.cumsum(lengths) - lengths
+    return np.repeat(starts.astype(np.int64) - first, lengths) + np.arange(total)
+
+
+class SparseLabels:
+    """
+    全部时间步的 shapemap 游程编码。
+
+    第 t 个时间步的游程为 run_start/run_length/run_label[time_bounds[t]:time_bounds[t + 1]]，
+    按标签排序；shape 为每个时间步网格的 (行数, 列数)。
+    """
+
+    def __init__(self, run_start, run_length, run_label, time_bounds, shape):
+        self.run_start = run_start
+        self.run_length = run_length
+        self.run_label = run_label
+        self.time_bounds = time_bounds
+        self.shape = tuple(int(size) for size in shape)
+
+    @classmethod
+    def from_frames(cls, frames, shape):
+        """
+        由逐时间步的编码结果拼接。
+
+        参数:
+        - frames (list): 每个时间步 encode_label_grid 的结果。
+        - shape (tuple): 网格的 (行数, 列数)。
+        """
+        counts = [len(starts) for starts, _, _ in frames]
+        labels = np.concatenate([run_labels for _, _, run_labels in frames]) if frames else np.array([], dtype=int)
+        label_dtype = _label_dtype(labels)
+        return cls(
+            np.concatenate([starts for starts, _, _ in frames]).astype(np.int32) if frames else
+            np.array([], dtype=np.int32),
+            np.concatenate([lengths for _, lengths, _ in frames]).astype(np.uint16) if frames else
+            np.array([], dtype=np.uint16),
+            labels.astype(label_dtype),
+            np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            shape)
+
+    @property
+    def n_times(self):
+        return len(self.time_bounds) - 1
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.run_start, self.run_length, self.run_label, self.time_bounds))
+
+    def _runs(self, time_index):
+        runs = slice(self.time_bounds[time_index], self.time_bounds[time_index + 1])
+        return self.run_start[runs], self.run_length[runs], self.run_label[runs]
+
+    def covered(self, time_index):
+        """某个时间步被 AR 覆盖的格点数。"""
+        return int(self._runs(time_index)[1].sum(dtype=np.int64))
+
+    def groups(self, time_index):
+        """
+        某个时间步的格点按标签分组，格式与 plot_functions.group_label_pixels 相同。
+
+        返回:
+        - tuple: (按升序排列的唯一标签, 按标签分组的扁平格点索引, 各标签切片的边界数组)。
+        """
+        starts, lengths, labels = self._runs(time_index)
+        unique_ids, first_runs = np.unique(labels, return_index=True)
+        run_offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        bounds = run_offsets[np.append(first_runs, len(labels))]
+        return unique_ids.astype(np.float32), _expand_runs(starts, lengths), bounds
+
+    def region(self, time_index, label):
+        """某个时间步中一个 AR 的扁平格点索引，只展开它自己的游程。"""
+        starts, lengths, labels = self._runs(time_index)
+        first, last = np.searchsorted(labels, [label, label + 1])
+        return _expand_runs(starts[first:last], lengths[first:last])
+
+    def dense(self, time_index):
+        """还原某个时间步的稠密标签场（NaN 表示无标签）。"""
+        starts, lengths, labels = self._runs(time_index)
+        grid = np.full(self.shape[0] * self.shape[1], np.nan, dtype=np.float32)
+        grid[_expand_runs(starts, lengths)] = np.repeat(labels, lengths.astype(np.int64))
+        return grid.reshape(self.shape)
+
+    def to_arrays(self, prefix):
+        """以 {prefix + 名称: 数组} 的形式返回，供 np.savez 保存。"""
+        return {f'{prefix}run_start': self.run_start, f'{prefix}run_length': self.run_length,
+                f'{prefix}run_label': self.run_label, f'{prefix}time_bounds': self.time_bounds,
+                f'{prefix}shape': np.array(self.shape)}
+
+    @classmethod
+    def from_arrays(cls, data, prefix):
+        return cls(data[f'{prefix}run_start'], data[f'{prefix}run_length'], data[f'{prefix}run_label'],
+                   data[f'{prefix}time_bounds'], data[f'{prefix}shape'])
@@ -2,10 +2,15 @@
 from dash import dcc, html
 import plotly.graph_objects as go
 
+from aggregation import AGGREGATE_OPS
+
 # 由于数据在启动时未加载，这里使用空列表和初始值
 time_coords = []
 visualization_options = []
 
+# 默认播放速度（帧/秒）
+PLAYBACK_FPS = 5
+
 initial_figure = go.Figure()
 initial_figure.update_geos(
     visible=True,
@@ -24,6 +29,8 @@ initial_figure.update_geos(
 initial_figure.update_layout(
     margin={"r": 0, "t": 50, "l": 0, "b": 0},
     title="请选择一个变量并拖动滑块",
+    # 逐帧更新时保留用户对地图的缩放和平移
+    uirevision='map',
     geo=dict(
         scope='world',
         showland=True,
@@ -60,8 +67,45 @@ app_layout = html.Div(style={'fontFamily': 'Arial, sans-serif', 'padding': '20px
     ),
     html.Div(id='output-filename', style={'textAlign': 'center', 'marginBottom': '20px'}),
 
+    # 大文件的另外两种导入方式：服务器本地路径，或分块流式上传到服务器临时目录
+    html.Div([
+        dcc.Input(
+            id='path-input',
+            type='text',
+            placeholder='服务器本地文件或目录路径',
+            debounce=True,
+            style={'width': '350px', 'marginRight': '10px'}
+        ),
+        dcc.Dropdown(
+            id='path-picker',
+            options=[],
+            value=None,
+            placeholder='选择文件',
+            style={'width': '300px', 'marginRight': '10px'}
+        ),
+        html.Button('打开', id='load-path-button', n_clicks=0, style={'marginRight': '30px'}),
+        # 点击后由 assets/chunked_upload.js 选择文件并分块上传
+        html.Button('大文件分块上传', id='stream-upload-button', n_clicks=0, style={'marginRight': '10px'}),
+        html.Div(id='stream-upload-progress'),
+    ], style={'display': 'flex', 'alignItems': 'center', 'justifyContent': 'center', 'marginBottom': '20px'}),
+    dcc.Store(id='stream-upload-store', data=None),
+
+    # 后台加载任务的进度：定时查询任务状态，第一帧渲染完成后立即显示
+    html.Div([
+        html.Div(id='load-progress', style={'marginRight': '10px'}),
+        html.Button('取消加载', id='cancel-load-button', n_clicks=0),
+    ], style={'display': 'flex', 'alignItems': 'center', 'justifyContent': 'center', 'marginBottom': '20px'}),
+    dcc.Store(id='load-job-store', data=None),
+    dcc.Interval(id='load-job-interval', interval=500, disabled=True),
+
     # 隐藏的dcc.Store组件，用于在回调函数之间存储数据
     dcc.Store(id='data-store', data=None),
+    # 记录浏览器中地图图形的轨迹布局，用于判断能否只发送增量更新
+    dcc.Store(id='map-layout-store', data=None),
+    # 客户端播放引擎使用的存储：服务器下发的播放窗口、向服务器请求窗口和单帧
+    dcc.Store(id='playback-window-store', data=None),
+    dcc.Store(id='window-request-store', data=None),
+    dcc.Store(id='frame-request-store', data=None),
 
     html.Div([
         html.Label('选择可视化变量:', style={'marginRight': '10px'}),
@@ -72,6 +116,53 @@ app_layout = html.Div(style={'fontFamily': 'Arial, sans-serif', 'padding': '20px
             clearable=False,
             style={'width': '250px'}
         ),
+        # 综合图中 AR 的绘制方式：逐格点标记，或按缩放级别简化的轮廓多边形
+        dcc.RadioItems(
+            id='ar-render-mode',
+            options=[{'label': '格点', 'value': 'pixels'}, {'label': '轮廓', 'value': 'outline'}],
+            value='pixels',
+            inline=True,
+            style={'marginLeft': '20px'}
+        ),
+    ], style={'display': 'flex', 'alignItems': 'center', 'marginBottom': '20px'}),
+
+    # 时间统计：对所选网格变量在一段时间内求平均、极值、百分位数等，结果替换当前地图
+    html.Div([
+        html.Label('时间统计:', style={'marginRight': '10px'}),
+        dcc.Dropdown(
+            id='aggregate-op',
+            options=[{'label': label, 'value': op} for op, label in AGGREGATE_OPS.items()],
+            value='mean',
+            clearable=False,
+            style={'width': '180px', 'marginRight': '10px'}
+        ),
+        html.Label('百分位:', style={'marginRight': '5px'}),
+        dcc.Input(id='aggregate-percentile', type='number', min=0, max=100, step=1, value=95,
+                  style={'width': '60px', 'marginRight': '10px'}),
+        html.Div(
+            dcc.RangeSlider(id='aggregate-range', min=0, max=0, value=[0, 0], marks=None,
+                            tooltip={"placement": "bottom", "always_visible": False}),
+            style={'flex': '1', 'marginRight': '10px'}
+        ),
+        html.Button('计算统计', id='aggregate-button', n_clicks=0),
+    ], style={'display': 'flex', 'alignItems': 'center', 'marginBottom': '20px'}),
+
+    # AR 轨迹：按寿命、长度和登陆区域（地图上的框选范围）筛选 AR，显示其完整路径或跳到生成/登陆时刻
+    html.Div([
+        html.Label('AR 轨迹:', style={'marginRight': '10px'}),
+        html.Label('最短寿命:', style={'marginRight': '5px'}),
+        dcc.Input(id='track-min-lifetime', type='number', min=0, value=None,
+                  style={'width': '80px', 'marginRight': '10px'}),
+        html.Label('最小长度:', style={'marginRight': '5px'}),
+        dcc.Input(id='track-min-length', type='number', min=0, value=None,
+                  style={'width': '80px', 'marginRight': '10px'}),
+        dcc.Checklist(id='track-landfall-only', options=[{'label': '只显示在框选区域内登陆的 AR', 'value': 'box'}],
+                      value=[], style={'marginRight': '10px'}),
+        dcc.Dropdown(id='track-selector', options=[], value=None, placeholder='选择 AR',
+                     style={'width': '260px', 'marginRight': '10px'}),
+        html.Button('显示轨迹', id='show-track-button', n_clicks=0, style={'marginRight': '10px'}),
+        html.Button('生成时刻', id='track-genesis-button', n_clicks=0, style={'marginRight': '10px'}),
+        html.Button('登陆时刻', id='track-landfall-button', n_clicks=0),
     ], style={'display': 'flex', 'alignItems': 'center', 'marginBottom': '20px'}),
 
     # 将dcc.Loading包裹在dcc.Graph周围，使其在图表更新时显示动画
@@ -85,11 +176,14 @@ app_layout = html.Div(style={'fontFamily': 'Arial, sans-serif', 'padding': '20px
         html.Button('播放', id='play-button', n_clicks=0, style={'marginRight': '10px'}),
         html.Button('暂停', id='pause-button', n_clicks=0, style={'marginRight': '20px'}),
         html.Button('上一帧', id='prev-button', n_clicks=0, style={'marginRight': '10px'}),
-        html.Button('下一帧', id='next-button', n_clicks=0),
+        html.Button('下一帧', id='next-button', n_clicks=0, style={'marginRight': '20px'}),
+        html.Label('帧/秒:', style={'marginRight': '10px'}),
+        dcc.Input(id='fps-input', type='number', min=1, max=30, step=1, value=PLAYBACK_FPS, style={'width': '60px'}),
 
+        # 播放由浏览器端的回调驱动，间隔由帧率换算
         dcc.Interval(
             id='interval-component',
-            interval=2000,
+            interval=1000 // PLAYBACK_FPS,
             n_intervals=0,
             disabled=True
         ),
@@ -107,5 +201,18 @@ app_layout = html.Div(style={'fontFamily': 'Arial, sans-serif', 'padding': '20px
             tooltip={"placement": "bottom", "always_visible": True}
         ),
         html.Div(id='time-display', style={'marginTop': '10px'}),
-    ], style={'padding': '20px', 'backgroundColor': '#f9f9f9', 'marginTop': '20px'})
+    ], style={'padding': '20px', 'backgroundColor': '#f9f9f9', 'marginTop': '20px'}),
+
+    # 点击地图上的格点显示该点的完整时间序列，框选区域显示区域平均时间序列
+    html.Div('提示：点击地图上的格点查看时间序列，使用框选工具查看区域平均。',
+             style={'marginTop': '10px', 'color': '#666'}),
+    dcc.Loading(
+        id="loading-series",
+        type="default",
+        children=dcc.Graph(id='series-graph', figure=go.Figure(), style={'display': 'none'})
+    ),
+    # 时间优先副本在后台建立时的进度，建好之前时间序列由 dask 直接计算
+    html.Div(id='series-progress', style={'marginTop': '5px', 'color': '#666'}),
+    dcc.Store(id='series-job-store', data=None),
+    dcc.Interval(id='series-job-interval', interval=1000, disabled=True),
 ])
@@ -0,0 +1,250 @@
+# metrics.py
+"""
+性能指标的记录和导出。
+
+记录的内容：
+- 每个 Dash 回调请求的总耗时、回调函数本身的耗时、请求和响应的字节数；
+- 各处理阶段的耗时：decode（base64 解码）、open（打开数据集）、slice（读取一个时间步）、
+  trace_build（构造图形轨迹）、serialize（回调返回后 Dash 生成 JSON 响应及请求解析）；
+- 帧缓存命中情况、进程常驻内存、注册表和帧缓存占用的内存。
+
+耗时和字节数以固定分桶的直方图累计，记录一次只需一次加锁和二分查找，可以在
+生产环境中一直开启。指标以 Prometheus 文本格式从 /metrics 导出；设置环境变量
+AR_VIS_METRICS_LOG 为文件路径（或 '-' 表示标准错误）时，每个回调请求另外写一行
+JSON 日志，包含该请求各阶段的耗时。
+"""
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+import flask
+import psutil
+
+# 耗时直方图的分桶上界（秒）
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# 字节数直方图的分桶上界
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+# 指标名称 -> (类型, 说明, 分桶)
+METRIC_TYPES = {
+    'ar_vis_callback_duration_seconds': ('histogram', 'Dash 回调请求的总耗时', DURATION_BUCKETS),
+    'ar_vis_callback_request_bytes': ('histogram', 'Dash 回调请求体的字节数', SIZE_BUCKETS),
+    'ar_vis_callback_response_bytes': ('histogram', 'Dash 回调响应体的字节数', SIZE_BUCKETS),
+    'ar_vis_callback_errors_total': ('counter', '返回错误状态的回调请求数', None),
+    'ar_vis_stage_duration_seconds': ('histogram', '各处理阶段的耗时', DURATION_BUCKETS),
+    'ar_vis_frame_cache_requests_total': ('counter', '帧缓存的命中和未命中次数', None),
+    'ar_vis_derived_cache_requests_total': ('counter', '派生变量缓存按时间步的命中和未命中次数', None),
+}
+
+# 结构化日志的输出位置，未设置时不写日志
+METRICS_LOG = os.environ.get('AR_VIS_METRICS_LOG')
+
+DASH_CALLBACK_PATH = '/_dash-update-component'
+
+
+class Histogram:
+    """固定分桶的直方图，与 Prometheus 的 histogram 类型对应。"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    进程内的指标表，键为 (指标名称, 标签)。
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {'ar_vis_process_resident_memory_bytes': ('进程常驻内存',
+                                                                 lambda: psutil.Process().memory_info().rss)}
+        self._lock = threading.Lock()
+        # 当前线程正在处理的回调请求，用于把阶段耗时归入该请求的日志
+        self._local = threading.local()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(METRIC_TYPES[name][2])
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_gauge(self, name, help_text, read):
+        """注册一个在导出时才读取的数值，read 为无参数函数。"""
+        self._gauges[name] = (help_text, read)
+
+    def observe_stage(self, stage, seconds):
+        """记录一个处理阶段的耗时；在回调请求中时同时计入该请求的记录。"""
+        self.observe('ar_vis_stage_duration_seconds', seconds, stage=stage)
+        record = getattr(self._local, 'request', None)
+        if record is not None:
+            record['stages'][stage] = record['stages'].get(stage, 0.0) + seconds
+
+    def stage(self, stage):
+        """计时上下文管理器，退出时调用 observe_stage。"""
+        return _StageTimer(self, stage)
+
+    def begin_request(self):
+        self._local.request = {'started': time.perf_counter(), 'stages': {}}
+
+    def end_request(self):
+        record = getattr(self._local, 'request', None)
+        self._local.request = None
+        return record
+
+    def current_request(self):
+        return getattr(self._local, 'request', None)
+
+    def render(self):
+        """按 Prometheus 文本格式导出全部指标。"""
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        for name, (kind, help_text, buckets) in METRIC_TYPES.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == 'histogram':
+                for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+
+        # 内存占用等数值在导出时读取
+        for name, (help_text, read) in list(self._gauges.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {read()}"]
+        return '\n'.join(lines) + '\n'
+
+
+class _StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe_stage(self.stage, time.perf_counter() - self.started)
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+# 进程内共享的指标表
+metrics = Metrics()
+
+
+def timed_callback(func):
+    """
+    记录回调函数本身的耗时（放在 @app.callback 之下）。
+
+    请求总耗时减去这部分即为 Dash 解析请求和序列化响应的耗时，记为 serialize 阶段。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record = metrics.current_request()
+            if record is not None:
+                record['callback_seconds'] = time.perf_counter() - started
+    return wrapper
+
+
+def _structured_logger():
+    if not METRICS_LOG:
+        return None
+    logger = logging.getLogger('ar_vis.metrics')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    # 多次创建应用（测试、多个 worker）时共用同一个 logger，只添加一次输出
+    if not logger.handlers:
+        handler = logging.StreamHandler() if METRICS_LOG == '-' else logging.FileHandler(METRICS_LOG, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+
+def register_metrics_routes(app):
+    """
+    在 Dash 底层的 Flask 服务器上记录每个回调请求的指标，并注册 /metrics 接口。
+    """
+    server = app.server
+    logger = _structured_logger()
+
+    def callback_name(output):
+        spec = app.callback_map.get(output)
+        return spec['callback'].__name__ if spec is not None else 'unknown'
+
+    @server.before_request
+    def start_request_timer():
+        if flask.request.path.endswith(DASH_CALLBACK_PATH):
+            metrics.begin_request()
+
+    @server.after_request
+    def record_request(response):
+        record = metrics.end_request()
+        if record is None:
+            return response
+        elapsed = time.perf_counter() - record['started']
+        body = flask.request.get_json(silent=True) or {}
+        name = callback_name(body.get('output'))
+        request_bytes = flask.request.content_length or 0
+        response_bytes = response.calculate_content_length() or 0
+        metrics.observe('ar_vis_callback_duration_seconds', elapsed, callback=name)
+        metrics.observe('ar_vis_callback_request_bytes', request_bytes, callback=name)
+        metrics.observe('ar_vis_callback_response_bytes', response_bytes, callback=name)
+        if response.status_code >= 400:
+            metrics.inc('ar_vis_callback_errors_total', callback=name)
+        if 'callback_seconds' in record:
+            record['stages']['serialize'] = max(0.0, elapsed - record['callback_seconds'])
+            metrics.observe_stage('serialize', record['stages']['serialize'])
+        if logger is not None:
+            logger.info(json.dumps({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'callback': name, 'status': response.status_code,
+                'duration_ms': round(elapsed * 1000, 2), 'request_bytes': request_bytes,
+                'response_bytes': response_bytes,
+                'stages_ms': {stage: round(seconds * 1000, 2) for stage, seconds in record['stages'].items()},
+                'rss_bytes': psutil.Process().memory_info().rss,
+            }, ensure_ascii=False))
+        return response
+
+    @server.route('/metrics')
+    def export_metrics():
+        return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
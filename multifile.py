@@ -0,0 +1,221 @@
+# multifile.py
+"""
+把按月、按日分开存放的多个文件作为沿 time 维拼接的一个虚拟数据集惰性打开。
+
+数据源用 glob 模式表示（如 /data/era5/ERA5_*.nc），匹配的文件按各自的第一个
+时刻排序。每个文件的时间坐标以 (路径, 大小, 修改时间) 为键缓存在 CATALOG_DIR
+中，再次打开时只需对各文件做一次 stat，并打开第一个文件读取变量结构，不读取
+任何变量数据。
+
+时间步到 (文件, 文件内时间步) 的映射由各文件起始位置组成的有序数组二分查找
+得到。读取时文件句柄从一个有上限的池中取出，超过上限时关闭最久未用的文件，
+打开十年的逐月文件也不会占用上百个文件句柄。各文件须使用相同的网格和变量。
+"""
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import dask.array as dsa
+import numpy as np
+import xarray as xr
+
+# 各文件时间坐标的缓存目录
+CATALOG_DIR = os.environ.get('AR_VIS_CATALOG_DIR', os.path.join(tempfile.gettempdir(), 'ar_vis_catalog'))
+
+# 每个虚拟数据集同时保持打开的文件数上限
+MAX_OPEN_FILES = 16
+
+GLOB_CHARS = '*?['
+
+
+def is_multifile_pattern(source):
+    """判断数据源是否为匹配多个文件的 glob 模式。"""
+    return isinstance(source, str) and any(char in source for char in GLOB_CHARS)
+
+
+def match_files(pattern):
+    """返回模式匹配的全部文件（绝对路径，按名称排序）。"""
+    return sorted(os.path.abspath(path) for path in glob.glob(os.path.expanduser(pattern)) if os.path.isfile(path))
+
+
+class FilePool:
+    """
+    有上限的已打开文件池，按最近使用顺序淘汰。
+
+    读取在池的锁内进行：被淘汰的文件不会在读取途中被关闭。netCDF/HDF5 的读取在
+    xarray 中本来就是串行的，这里加锁不会降低吞吐。
+    """
+
+    def __init__(self, opener, max_open=MAX_OPEN_FILES):
+        self.opener = opener
+        self.max_open = max_open
+        self._files = OrderedDict()
+        self._lock = threading.RLock()
+
+    def read(self, path, func):
+        """以 path 对应的已打开数据集调用 func，返回其结果。"""
+        with self._lock:
+            ds = self._files.get(path)
+            if ds is None:
+                ds = self._files[path] = self.opener(path)
+                while len(self._files) > self.max_open:
+                    _, oldest = self._files.popitem(last=False)
+                    oldest.close()
+            else:
+                self._files.move_to_end(path)
+            return func(ds)
+
+    def close(self):
+        with self._lock:
+            for ds in self._files.values():
+                ds.close()
+            self._files.clear()
+
+
+class MultiFileIndex:
+    """
+    多个文件沿时间维拼接后的时间索引。
+
+    paths 按第一个时刻排序；第 i 个文件的时间步为全局的 starts[i]:starts[i + 1]。
+    """
+
+    def __init__(self, paths, file_times):
+        self.paths = paths
+        self.starts = np.r_[0, np.cumsum([len(times) for times in file_times])].astype(np.int64)
+        self.times = np.concatenate(file_times)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def locate(self, time_index):
+        """全局时间步 -> (文件序号, 文件内时间步)。"""
+        file_index = int(np.searchsorted(self.starts, time_index, side='right')) - 1
+        return file_index, int(time_index - self.starts[file_index])
+
+    def segments(self, start, stop):
+        """把全局时间范围 [start, stop) 拆成 (文件序号, 文件内起点, 文件内终点) 的序列。"""
+        while start < stop:
+            file_index, local_start = self.locate(start)
+            local_stop = min(stop, int(self.starts[file_index + 1])) - int(self.starts[file_index])
+            yield file_index, local_start, local_stop
+            start += local_stop - local_start
+
+
+class _MultiFileArray:
+    """
+    一个变量在全部文件上的惰性数组，供 dask.array.from_array 按块读取。
+    """
+
+    def __init__(self, index, pool, var_name, shape, dtype, time_axis):
+        self.index = index
+        self.pool = pool
+        self.var_name = var_name
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len(shape)
+        self.time_axis = time_axis
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        time_key = key[self.time_axis]
+        if isinstance(time_key, (int, np.integer)):
+            file_index, local = self.index.locate(int(time_key) % self.shape[self.time_axis])
+            return self._read(file_index, key[:self.time_axis] + (local,) + key[self.time_axis + 1:])
+
+        start, stop, step = time_key.indices(self.shape[self.time_axis])
+        parts = [self._read(file_index, key[:self.time_axis] + (slice(local_start, local_stop),)
+                            + key[self.time_axis + 1:])
+                 for file_index, local_start, local_stop in self.index.segments(start, stop)]
+        if not parts:
+            empty_key = key[:self.time_axis] + (slice(0, 0),) + key[self.time_axis + 1:]
+            return np.empty(self.shape, dtype=self.dtype)[empty_key]
+        values = parts[0] if len(parts) == 1 else np.concatenate(parts, axis=self.time_axis)
+        if step != 1:
+            values = values[(slice(None),) * self.time_axis + (slice(None, None, step),)]
+        return values
+
+    def _read(self, file_index, key):
+        return self.pool.read(self.index.paths[file_index],
+                              lambda ds: np.asarray(ds[self.var_name][key].values, dtype=self.dtype))
+
+
+def _catalog_path(path):
+    stat = os.stat(path)
+    key = f"{path}|{stat.st_size}|{stat.st_mtime}"
+    return os.path.join(CATALOG_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+
+def _file_times(path, pool):
+    """读取一个文件的时间坐标，优先使用缓存。"""
+    cache_path = _catalog_path(path)
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+    times = pool.read(path, lambda ds: ds['time'].values)
+    # 非标准历法的时间为 cftime 对象，不写入缓存
+    if times.dtype != object:
+        os.makedirs(CATALOG_DIR, exist_ok=True)
+        with open(cache_path + '.tmp', 'wb') as f:
+            np.save(f, times)
+        os.replace(cache_path + '.tmp', cache_path)
+    return times
+
+
+def open_multifile(pattern, opener, chunks=None, max_open=MAX_OPEN_FILES):
+    """
+    惰性打开 glob 模式匹配的全部文件，沿 time 维拼接为一个数据集。
+
+    参数:
+    - pattern (str): glob 模式。
+    - opener: 打开单个文件并统一坐标名称的函数（data_loader.open_source）。
+    - chunks (dict): dask 分块，只使用其中的 time；为 None 时每个文件为一个时间块。
+    - max_open (int): 同时保持打开的文件数上限。
+
+    返回:
+    - xarray.Dataset: 关闭时一并关闭池中的文件。
+    """
+    paths = match_files(pattern)
+    if not paths:
+        raise ValueError(f"没有与 {pattern} 匹配的文件")
+    pool = FilePool(opener, max_open)
+    file_times = [_file_times(path, pool) for path in paths]
+    order = sorted((i for i in range(len(paths)) if len(file_times[i])), key=lambda i: file_times[i][0])
+    index = MultiFileIndex([paths[i] for i in order], [file_times[i] for i in order])
+    if np.any(index.times[1:] <= index.times[:-1]):
+        print(f"警告：{pattern} 中各文件的时间有重叠或乱序，按文件的第一个时刻拼接")
+
+    n_times = len(index)
+    time_chunks = tuple(int(n) for n in np.diff(index.starts))
+    if chunks and chunks.get('time'):
+        step = int(chunks['time'])
+        time_chunks = (step,) * (n_times // step) + ((n_times % step,) if n_times % step else ())
+
+    # 变量结构和非时间坐标取自第一个文件
+    def describe(ds):
+        variables = {var: (ds[var].dims, ds[var].shape, ds[var].dtype, dict(ds[var].attrs))
+                     for var in ds.data_vars if 'time' in ds[var].dims}
+        coords = {name: (coord.dims, coord.values, dict(coord.attrs))
+                  for name, coord in ds.coords.items() if 'time' not in coord.dims}
+        return variables, coords, dict(ds.attrs)
+    variables, coords, attrs = pool.read(index.paths[0], describe)
+
+    token = hashlib.sha1('|'.join(index.paths).encode('utf-8')).hexdigest()[:16]
+    data_vars = {}
+    for var, (dims, shape, dtype, var_attrs) in variables.items():
+        time_axis = dims.index('time')
+        shape = shape[:time_axis] + (n_times,) + shape[time_axis + 1:]
+        array = _MultiFileArray(index, pool, var, shape, dtype, time_axis)
+        var_chunks = tuple(time_chunks if axis == time_axis else (size,) for axis, size in enumerate(shape))
+        data_vars[var] = (dims, dsa.from_array(array, chunks=var_chunks, name=f"multifile-{token}-{var}",
+                                               lock=False, meta=np.empty((0,) * len(shape), dtype=dtype)),
+                          var_attrs)
+
+    ds = xr.Dataset(data_vars, coords=dict(coords, time=('time', index.times)), attrs=attrs)
+    ds.encoding['source'] = pattern
+    ds.set_close(pool.close)
+    print(f"按时间拼接 {len(index.paths)} 个文件：{n_times} 个时间步")
+    return ds
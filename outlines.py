@@ -0,0 +1,263 @@
+# outlines.py
+"""
+把 shapemap 中每个 AR 的格点区域描成轮廓多边形。
+
+用行进正方形法（marching squares）在 0.5 等值线上追踪二值掩码的边界：每个
+2x2 格点单元按四角是否属于该 AR 查表得到边界线段，线段端点位于单元边的中点，
+按“区域在左侧”的方向排列，首尾相接即得到闭合环。外环和洞的环绕方向相反，
+按有向面积区分后把洞归入包含它的外环。环再按与缩放相关的容差做
+Douglas-Peucker 简化，结果为 GeoJSON MultiPolygon（外环顺时针、洞逆时针，
+与 plotly.js 使用的 d3-geo 约定一致）。
+
+一个大 AR 在 0.25° 网格上有数千个格点，轮廓简化后通常只有几十到几百个顶点。
+简化结果按 (数据集, 时间步, AR 标签, 容差) 缓存。
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# 轮廓缓存最多保存的顶点总数
+OUTLINE_CACHE_MAX_VERTICES = 4 * 1024 ** 2
+
+# 单元四角的位权：左上、右上、右下、左下（行号向下增加）
+_CORNERS = ((0, 0), (0, 1), (1, 1), (1, 0))
+
+# 单元的四条边，以两个端点角的序号表示：上、右、下、左
+_EDGES = ((0, 1), (1, 2), (2, 3), (3, 0))
+
+
+def _build_case_table():
+    """
+    生成 16 种单元情形的线段表：case -> [(起点边, 终点边), ...]。
+
+    线段方向使单元中属于区域的角位于线段左侧（以列号为 x、行号为 y 计算叉积），
+    这样相邻单元的线段首尾相接，每个边中点恰好有一条入边和一条出边。两个对角
+    属于区域的鞍点情形按两个角分别切开处理（区域按 4 邻接连通）。
+    """
+    midpoints = [np.mean([_CORNERS[a], _CORNERS[b]], axis=0)[::-1] for a, b in _EDGES]
+    table = []
+    for case in range(16):
+        inside = [bool(case >> corner & 1) for corner in range(4)]
+        crossing = [edge for edge, (a, b) in enumerate(_EDGES) if inside[a] != inside[b]]
+        if len(crossing) == 4:
+            # 鞍点：每个区域内的角由与它相邻的两条边单独切出
+            pairs = [tuple(edge for edge in range(4) if corner in _EDGES[edge])
+                     for corner in range(4) if inside[corner]]
+        else:
+            pairs = [tuple(crossing)] if crossing else []
+        segments = []
+        for start, end in pairs:
+            # 普通情形取任一区域内的角，鞍点取被切出的那个角
+            corner = next(c for c in range(4)
+                          if inside[c] and (len(crossing) < 4 or c in _EDGES[start] and c in _EDGES[end]))
+            point = np.array(_CORNERS[corner][::-1], dtype=float)
+            direction = midpoints[end] - midpoints[start]
+            offset = point - midpoints[start]
+            # y 轴向下时叉积为负表示点在左侧
+            if direction[0] * offset[1] - direction[1] * offset[0] > 0:
+                start, end = end, start
+            segments.append((start, end))
+        table.append(segments)
+    return table
+
+
+_CASE_TABLE = _build_case_table()
+
+
+def _edge_vertices(mask):
+    """
+    对 (已在四周补零的) 二值掩码做行进正方形，返回所有有向线段的 (起点, 终点) 顶点编号。
+
+    顶点编号：水平边 (i, j)-(i, j+1) 的中点为 i * (W - 1) + j；
+    垂直边 (i, j)-(i+1, j) 的中点为 H * (W - 1) + i * W + j。
+    """
+    height, width = mask.shape
+    m = mask.astype(np.uint8)
+    case = m[:-1, :-1] | (m[:-1, 1:] << 1) | (m[1:, 1:] << 2) | (m[1:, :-1] << 3)
+    n_horizontal = height * (width - 1)
+
+    def edge_id(edge, i, j):
+        if edge == 0:
+            return i * (width - 1) + j
+        if edge == 2:
+            return (i + 1) * (width - 1) + j
+        if edge == 3:
+            return n_horizontal + i * width + j
+        return n_horizontal + i * width + j + 1
+
+    starts, ends = [], []
+    for value in np.unique(case):
+        segments = _CASE_TABLE[value]
+        if not segments:
+            continue
+        i, j = np.nonzero(case == value)
+        for start, end in segments:
+            starts.append(edge_id(start, i, j))
+            ends.append(edge_id(end, i, j))
+    if not starts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(starts), np.concatenate(ends)
+
+
+def _vertex_coords(vertex_ids, x, y):
+    """顶点编号 -> (经度, 纬度)，x、y 为补零后掩码各列、各行的坐标。"""
+    height, width = len(y), len(x)
+    n_horizontal = height * (width - 1)
+    horizontal = vertex_ids < n_horizontal
+    i = np.where(horizontal, vertex_ids // (width - 1), (vertex_ids - n_horizontal) // width)
+    j = np.where(horizontal, vertex_ids % (width - 1), (vertex_ids - n_horizontal) % width)
+    lon = np.where(horizontal, (x[j] + x[np.minimum(j + 1, width - 1)]) / 2, x[j])
+    lat = np.where(horizontal, y[i], (y[i] + y[np.minimum(i + 1, height - 1)]) / 2)
+    return np.column_stack([lon, lat])
+
+
+def _chain_rings(starts, ends):
+    """把有向线段首尾相接成闭合环，返回顶点编号数组的列表。"""
+    following = dict(zip(starts.tolist(), ends.tolist()))
+    rings = []
+    while following:
+        first, current = following.popitem()
+        ring = [first, current]
+        while current != first:
+            current = following.pop(current)
+            ring.append(current)
+        rings.append(np.array(ring))
+    return rings
+
+
+def _signed_area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def _contains(ring, point):
+    """射线法判断点是否在闭合环内。"""
+    x, y = ring[:, 0], ring[:, 1]
+    crosses = (y[:-1] > point[1]) != (y[1:] > point[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x[:-1] + (point[1] - y[:-1]) * (x[1:] - x[:-1]) / (y[1:] - y[:-1])
+    return int(np.count_nonzero(crosses & (point[0] < x_cross))) % 2 == 1
+
+
+def simplify_ring(ring, tolerance):
+    """
+    Douglas-Peucker 简化闭合环（首尾相同）。简化后不足三个不同顶点时返回原环。
+    """
+    points = ring[:-1]
+    if len(points) <= 3 or tolerance <= 0:
+        return ring
+    # 以离第一个点最远的点把环分成两条折线，分别简化
+    far = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    keep = np.zeros(len(points) + 1, dtype=bool)
+    keep[[0, far, len(points)]] = True
+    closed = np.vstack([points, points[:1]])
+    stack = [(0, far), (far, len(points))]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = closed[first], closed[last]
+        segment = closed[first + 1:last]
+        direction = b - a
+        length = np.hypot(*direction)
+        if length == 0:
+            distance = np.hypot(*(segment - a).T)
+        else:
+            distance = np.abs(direction[0] * (segment[:, 1] - a[1]) - direction[1] * (segment[:, 0] - a[0])) / length
+        index = int(np.argmax(distance))
+        if distance[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack += [(first, split), (split, last)]
+    simplified = closed[keep]
+    return simplified if len(simplified) >= 4 else ring
+
+
+def trace_outline(rows, cols, lons, lats, tolerance=0.0):
+    """
+    描出一组格点组成的区域的轮廓多边形。
+
+    参数:
+    - rows, cols (np.ndarray): 区域内各格点的行号（对应 lats）和列号（对应 lons）。
+    - lons, lats (np.ndarray): 网格各列的经度、各行的纬度（等间距）。
+    - tolerance (float): Douglas-Peucker 简化容差（度），0 表示只去掉共线顶点。
+
+    返回:
+    - list: GeoJSON MultiPolygon 的 coordinates：[[外环, 洞, ...], ...]，每个环为
+      [[经度, 纬度], ...] 且首尾相同。
+    """
+    if not len(rows):
+        return []
+    # 只处理外接矩形，并在四周补一圈零使所有环闭合
+    row0, row1, col0, col1 = rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+    window = np.zeros((row1 - row0 + 2, col1 - col0 + 2), dtype=bool)
+    window[rows - row0 + 1, cols - col0 + 1] = True
+    x = _padded_coords(lons, col0, col1)
+    y = _padded_coords(lats, row0, row1)
+
+    starts, ends = _edge_vertices(window)
+    rings = [_vertex_coords(ring, x, y) for ring in _chain_rings(starts, ends)]
+    rings = [simplify_ring(ring, max(tolerance, 1e-9)) for ring in rings]
+
+    # 外环和洞的环绕方向相反；纬度随行号增加或减少时方向也随之翻转，以面积最大的环为外环确定符号
+    areas = np.array([_signed_area(ring) for ring in rings])
+    outer_sign = np.sign(areas[np.argmax(np.abs(areas))])
+    polygons = [[ring] for ring, area in zip(rings, areas) if np.sign(area) == outer_sign]
+    for ring, area in zip(rings, areas):
+        if np.sign(area) != outer_sign:
+            owner = next((polygon for polygon in polygons if _contains(polygon[0], ring[0])), None)
+            if owner is not None:
+                owner.append(ring)
+
+    # d3-geo 约定外环顺时针、洞逆时针（经度为 x、纬度为 y）
+    coordinates = []
+    for polygon in polygons:
+        coordinates.append([np.round(ring if (_signed_area(ring) < 0) == (k == 0) else ring[::-1], 3).tolist()
+                            for k, ring in enumerate(polygon)])
+    return coordinates
+
+
+def _padded_coords(coords, start, stop):
+    coords = np.asarray(coords, dtype=float)
+    step = coords[1] - coords[0] if len(coords) > 1 else 1.0
+    inner = coords[start:stop]
+    return np.concatenate([[inner[0] - step], inner, [inner[-1] + step]])
+
+
+class OutlineCache:
+    """
+    简化后轮廓的 LRU 缓存，键为 (数据集ID, 时间步, AR 标签, 容差)，按顶点总数限制大小。
+    """
+
+    def __init__(self, max_vertices=OUTLINE_CACHE_MAX_VERTICES):
+        self.max_vertices = max_vertices
+        self._outlines = OrderedDict()
+        self._vertices = 0
+        self._lock = threading.Lock()
+
+    def get_or_trace(self, key, trace):
+        with self._lock:
+            cached = self._outlines.get(key)
+            if cached is not None:
+                self._outlines.move_to_end(key)
+                return cached[0]
+        coordinates = trace()
+        n_vertices = sum(len(ring) for polygon in coordinates for ring in polygon)
+        with self._lock:
+            if key not in self._outlines:
+                self._outlines[key] = (coordinates, n_vertices)
+                self._vertices += n_vertices
+                while self._vertices > self.max_vertices and len(self._outlines) > 1:
+                    self._vertices -= self._outlines.popitem(last=False)[1][1]
+        return coordinates
+
+    def invalidate(self, dataset_id):
+        """删除某个数据集的全部轮廓。"""
+        with self._lock:
+            for key in [key for key in self._outlines if key[0] == dataset_id]:
+                self._vertices -= self._outlines.pop(key)[1]
+
+
+# 进程内共享的轮廓缓存
+outline_cache = OutlineCache()
@@ -1,20 +1,101 @@
+import base64
+import time
+from functools import partial
+
 import plotly.graph_objects as go
 import plotly.colors
 import pandas as pd
 import numpy as np
+from dash import Patch
+from data_loader import read_frame
+from labels import ar_mask, label_fill_values
+from metrics import metrics
+from outlines import outline_cache, trace_outline
+from spatial_index import FrameSpatialIndex, frame_index_cache, in_viewport
+
+# 大气河流综合可视化每一帧需要读取的变量
+AR_VARIABLES = ['shapemap', 'length', 'width', 'klifetime', 'kdist', 'kid', 'axislon', 'axislat', 'kspeed', 'kstatus',
+                'clon', 'clat', 'ivt_magnitude', 'ivt_direction', 'hlon', 'hlat', 'tlon', 'tlat', 'lflon', 'lflat',
+                'lfivtdir', 'lfivtx', 'lfivty']
+
+# 以 (time, 行, 列) 网格存放、在 AR 轨迹索引中改为紧凑存储的变量（见 tracks.py）
+AR_GRID_VARIABLES = ('shapemap', 'axislon', 'axislat')
+
+# 综合可视化图形最前面的固定轨迹：質心、IVT向量、頭部、尾部、登陸點
+FIXED_TRACE_COUNT = 5
+
+# 每帧图形中预留的 AR 轨迹槽位数（每个槽位包括 AR 格点和 AR 軸两条轨迹）
+AR_TRACE_SLOTS = 32
+
+# 网格场渲染：地图显示宽度（像素）、每个粗化格点占用的像素数，以及单帧最多发送的格点数
+DISPLAY_WIDTH_PX = 1000
+FIELD_PIXELS_PER_CELL = 4
+MAX_FIELD_POINTS = 40000
+
+# 网格场按缩放比例重新渲染的粒度：缩放比例向上取到 2 的 1/FIELD_ZOOM_STEPS 次幂，
+# 方块格点按该级别的上限确定大小，级别内缩放时格点略有重叠而不会出现空隙
+FIELD_ZOOM_STEPS = 4
+
+# AR 轮廓的简化容差对应的屏幕像素数：小于该尺寸的轮廓细节在地图上不可见
+OUTLINE_TOLERANCE_PX = 1.5
+
+# 逐帧发送的坐标和数值使用 float32，以 base64 类型化数组传输
+TRACE_DTYPE = np.float32
+
+# numpy 数据类型 -> plotly.js 类型化数组的 dtype 代码
+TYPED_ARRAY_CODES = {'float32': 'f4', 'float64': 'f8', 'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'int32': 'i4'}
+
+# 时间序列图中每条曲线最多绘制的点数，超过时按区间保留最小值和最大值
+MAX_SERIES_POINTS = 4000
+
+
+def group_label_pixels(label_grid, fill_values=()):
+    """
+    一次遍历将标签场中的格点按标签分组。
+
+    对属于 AR 的格点（见 labels.ar_mask）的扁平索引按标签做稳定排序，每个标签的格点
+    成为排序结果中的一段连续切片，组内保持原来的行优先顺序。耗时只与格点数有关，
+    与标签个数无关。
+
+    参数:
+    - label_grid (np.ndarray): 二维标签场，NaN 或填充值表示无标签。
+    - fill_values (tuple): labels.label_fill_values 的结果。
+
+    返回:
+    - tuple: (按升序排列的唯一标签, 排序后的扁平格点索引, 各标签切片的边界数组)，
+      第 i 个标签的格点为 pixel_index[bounds[i]:bounds[i + 1]]。
+    """
+    flat_labels = label_grid.ravel()
+    flat_index = np.flatnonzero(ar_mask(flat_labels, fill_values))
+    labels = flat_labels[flat_index]
+    order = np.argsort(labels, kind='stable')
+    pixel_index = flat_index[order]
+    unique_ids, starts = np.unique(labels[order], return_index=True)
+    bounds = np.append(starts, len(pixel_index))
+    return unique_ids, pixel_index, bounds
 
 
-def create_combined_ar_figure(selected_time_index, current_figure, ds_dict, time_coords, lons, lats):
+def create_combined_ar_figure(selected_time_index, current_figure, ds, time_coords, lons, lats,
+                              outline_tolerance=None, cache_key=None, viewport=None, catalog=None):
     """
     根据给定的时间索引和当前图形数据，生成一个包含大气河流综合可视化数据的 Plotly Figure。
 
+    默认每个 AR 的格点绘制为一组标记点；给出 outline_tolerance 时改为绘制按该容差
+    简化的填充轮廓多边形（见 outlines.py），顶点数和传输量小得多。给出 viewport 时
+    只绘制视口内的 AR 和点要素（见 spatial_index.py）。给出 catalog 时 AR 格点、AR 軸和
+    逐 AR 变量都从其紧凑存储中读取，不读取稠密的 shapemap 和补齐的逐 AR 数组。
+
     参数:
     - selected_time_index (int): 选定的时间步索引。
     - current_figure (dict): 当前地图图形的 JSON 格式字典，用于更新。
-    - ds_dict (dict): 从dcc.Store中传递过来的数据集字典。
+    - ds (xarray.Dataset): 从服务器端注册表中取出的数据集。
     - time_coords (list): 时间坐标列表。
     - lons (list): 经度坐标列表。
     - lats (list): 纬度坐标列表。
+    - outline_tolerance (float): 轮廓简化容差（度），为 None 时绘制格点。
+    - cache_key: 轮廓缓存和空间索引缓存中区分数据集的键（数据集ID），为 None 时不缓存。
+    - viewport (tuple): 地图视口 (纬度下限, 纬度上限, 经度起点, 经度终点)，为 None 时绘制全球。
+    - catalog (ARTrackIndex): 保存了标签场和 AR 軸的 AR 轨迹索引，为 None 时从数据集读取。
 
     返回:
     - tuple: (go.Figure, str) 包含更新后的图形对象和时间显示字符串。
@@ -26,214 +107,774 @@ def create_combined_ar_figure(selected_time_index, current_figure, ds_dict, time
         'Asia/Tokyo').strftime('%Y-%m-%d %H:%M')
     time_display = f"当前时间 (JST): {current_time}"
 
-    # 从字典中提取数据
-    shapemap = np.array(ds_dict['variables']['shapemap'][selected_time_index])
-    ar_values = shapemap[::-1, :]
+    # 该时间步的空间索引已缓存时不必再读取 shapemap
+    frame_index = None
+    if viewport is not None and cache_key is not None:
+        frame_index = frame_index_cache.get((cache_key, selected_time_index))
+    var_names = AR_VARIABLES if frame_index is None else [name for name in AR_VARIABLES if name != 'shapemap']
+
+    if catalog is not None:
+        # 逐 AR 变量由出现记录还原为按槽位排列的数组，AR 軸按记录的偏移切出
+        frame = catalog.frame_values(selected_time_index,
+                                     [name for name in var_names if name not in AR_GRID_VARIABLES])
+        axis_points = partial(catalog.axis_at, selected_time_index)
+    else:
+        # 从数据集中只读取当前时间步所需的切片
+        frame = {name: values.astype(TRACE_DTYPE, copy=False)
+                 for name, values in read_frame(ds, var_names, selected_time_index).items()}
+        axis_points = partial(_padded_axis_points, frame['axislon'], frame['axislat'])
+    build_started = time.perf_counter()
 
     # 假设'length'等变量的数据结构与'shapemap'相同
-    length_data = np.array(ds_dict['variables']['length'][selected_time_index])
-    width_data = np.array(ds_dict['variables']['width'][selected_time_index])
-    life_data = np.array(ds_dict['variables']['klifetime'][selected_time_index])
-    distance_data = np.array(ds_dict['variables']['kdist'][selected_time_index])
-    id_data = np.array(ds_dict['variables']['kid'][selected_time_index])
-    axislon_data = np.array(ds_dict['variables']['axislon'][selected_time_index])
-    axislat_data = np.array(ds_dict['variables']['axislat'][selected_time_index])
-    kspeed_data = np.array(ds_dict['variables']['kspeed'][selected_time_index])
-    kstatus_data = np.array(ds_dict['variables']['kstatus'][selected_time_index])
-    clon_data = np.array(ds_dict['variables']['clon'][selected_time_index])
-    clat_data = np.array(ds_dict['variables']['clat'][selected_time_index])
-    ivt_x_data = np.array(ds_dict['variables']['ivtx'][selected_time_index])
-    ivt_y_data = np.array(ds_dict['variables']['ivty'][selected_time_index])
-    hlon_data = np.array(ds_dict['variables']['hlon'][selected_time_index])
-    hlat_data = np.array(ds_dict['variables']['hlat'][selected_time_index])
-    tlon_data = np.array(ds_dict['variables']['tlon'][selected_time_index])
-    tlat_data = np.array(ds_dict['variables']['tlat'][selected_time_index])
-    lflon_data = np.array(ds_dict['variables']['lflon'][selected_time_index])
-    lflat_data = np.array(ds_dict['variables']['lflat'][selected_time_index])
-    lfivtdir_data = np.array(ds_dict['variables']['lfivtdir'][selected_time_index])
-    lfivtx_data = np.array(ds_dict['variables']['lfivtx'][selected_time_index])
-    lfivty_data = np.array(ds_dict['variables']['lfivty'][selected_time_index])
-
-    lon_grid, lat_grid = np.meshgrid(lons, lats)
-    unique_ids = np.unique(ar_values[~np.isnan(ar_values)])
-    colors = plotly.colors.qualitative.Plotly
+    length_data = frame['length']
+    width_data = frame['width']
+    life_data = frame['klifetime']
+    distance_data = frame['kdist']
+    id_data = frame['kid']
+    kspeed_data = frame['kspeed']
+    kstatus_data = frame['kstatus']
+    clon_data = frame['clon']
+    clat_data = frame['clat']
+    ivt_magnitude_data = frame['ivt_magnitude']
+    ivt_direction_data = frame['ivt_direction']
+    hlon_data = frame['hlon']
+    hlat_data = frame['hlat']
+    tlon_data = frame['tlon']
+    tlat_data = frame['tlat']
+    lflon_data = frame['lflon']
+    lflat_data = frame['lflat']
+    lfivtdir_data = frame['lfivtdir']
+    lfivtx_data = frame['lfivtx']
+    lfivty_data = frame['lfivty']
+
+    lons = np.asarray(lons, dtype=TRACE_DTYPE)
+    lats = np.asarray(lats, dtype=TRACE_DTYPE)
+    n_lon = len(lons)
+    empty = np.array([], dtype=TRACE_DTYPE)
 
-    if len(unique_ids) > 0:
-        for idx, uid in enumerate(unique_ids):
-            mask = ar_values == uid
-            lon_points = lon_grid[mask]
-            lat_points = lat_grid[mask]
-            if len(lon_points) > 0:
-                # 确保索引在数据范围内
-                ar_idx = int(uid) - 1
-                if ar_idx < len(length_data):
-                    ar_length = length_data[ar_idx]
-                    ar_width = width_data[ar_idx]
-                    ar_life = life_data[ar_idx]
-                    ar_distance = distance_data[ar_idx]
-                    ar_id = id_data[ar_idx]
-                    ar_speed = kspeed_data[ar_idx]
-                    ar_status = kstatus_data[ar_idx]
-
-                    trace = go.Scattergeo(
-                        lon=lon_points,
-                        lat=lat_points,
-                        mode='markers',
-                        marker=dict(size=2, color=colors[idx % len(colors)], opacity=0.7),
-                        name=f'AR {int(uid)}',
-                        customdata=[[ar_length, ar_width, ar_life, ar_distance, ar_id, ar_speed, ar_status]] * len(
-                            lon_points),
-                        hovertemplate='<b>經度: %{lon:.2f} 緯度: %{lat:.2f}</b><br>'
-                                      'AR 長度: %{customdata[0]:.2f} m<br>'
-                                      'AR 寬度: %{customdata[1]:.2f} m<br>'
-                                      'AR 生命: %{customdata[2]:.2f} s<br>'
-                                      'AR 距離: %{customdata[3]:.2f} m<br>'
-                                      'AR 速度: %{customdata[5]:.2f} m/s<br>'
-                                      'AR 狀態: %{customdata[6]:.0f}<br>'
-                                      'AR 标识: %{customdata[4]:.2f} <extra></extra>',
-                        showlegend=True,
-                    )
-                    fig.add_trace(trace)
-
-            axis_lon_points = np.array(axislon_data[int(uid) - 1])
-            axis_lat_points = np.array(axislat_data[int(uid) - 1])
-
-            if len(axis_lon_points) > 0:
-                axis_trace = go.Scattergeo(
-                    lon=axis_lon_points,
-                    lat=axis_lat_points,
-                    mode='lines',
-                    line=dict(color='purple', width=1),
-                    name=f'AR {int(uid)} 軸',
-                    showlegend=False,
-                    hoverinfo='none',
-                )
-                fig.add_trace(axis_trace)
-
-    ar_indices = np.where(~np.isnan(clon_data))[0]
+    if frame_index is None:
+        if catalog is not None:
+            # 游程编码的标签场直接展开为按标签分组的格点，不扫描整张网格
+            unique_ids, pixel_index, bounds = catalog.labels.groups(selected_time_index)
+        else:
+            unique_ids, pixel_index, bounds = group_label_pixels(frame['shapemap'][::-1, :],
+                                                                 label_fill_values(ds['shapemap']))
+        covered_points = len(pixel_index)
+        if viewport is not None:
+            frame_index = FrameSpatialIndex(unique_ids, pixel_index, bounds, lons, lats, {
+                'centroid': (clon_data, clat_data), 'head': (hlon_data, hlat_data),
+                'tail': (tlon_data, tlat_data), 'landfall': (lflon_data, lflat_data)})
+            if cache_key is not None:
+                frame_index_cache.put((cache_key, selected_time_index), frame_index)
+    if frame_index is not None:
+        # 只处理视口内的 AR 格点，耗时与可见的格点数成正比
+        covered_points = frame_index.covered
+        unique_ids, pixel_index, bounds = frame_index.visible_groups(viewport)
+
+    # 固定的点要素轨迹始终位于最前面，空帧时隐藏而不是省略，保证各帧的轨迹顺序一致；
+    # legendrank 让它们在图例中仍排在各 AR 之后
+    ar_indices = _point_positions(frame_index, 'centroid', clon_data, viewport)
     lon_points_centroid = clon_data[ar_indices]
     lat_points_centroid = clat_data[ar_indices]
-    ivt_x_points = ivt_x_data[ar_indices]
-    ivt_y_points = ivt_y_data[ar_indices]
-
-    if len(lon_points_centroid) > 0:
-        ivt_magnitude = np.sqrt(ivt_x_points ** 2 + ivt_y_points ** 2)
-        ivt_direction_rad = np.arctan2(ivt_y_points, ivt_x_points)
-        ivt_direction_deg = np.rad2deg(ivt_direction_rad)
-
-        scatter_trace_centroid = go.Scattergeo(
-            lon=lon_points_centroid,
-            lat=lat_points_centroid,
-            mode='markers',
-            marker=dict(color='red', size=5, opacity=0.8),
-            name='質心',
-            showlegend=True,
-        )
-        fig.add_trace(scatter_trace_centroid)
-
-        ivt_vectors = go.Scattergeo(
-            lon=lon_points_centroid,
-            lat=lat_points_centroid,
-            mode='markers',
-            marker=dict(
-                symbol='arrow',
-                size=(ivt_magnitude / np.nanmax(ivt_magnitude)) * 10 + 2,
-                color=ivt_magnitude,
-                colorscale='Viridis',
-                cmin=0,
-                cmax=np.nanmax(ivt_magnitude),
-                showscale=True,
-                colorbar=dict(
-                    title='IVT強度',
-                    orientation='h',
-                    x=0.5,
-                    xanchor='center',
-                    y=-0.1,
-                    yanchor='top'
-                ),
-                opacity=0.7,
-                angle=ivt_direction_deg + 180,
+    # IVT 强度和方向是由 ivtx/ivty 计算的派生变量（见 derived.py），已按时间步缓存
+    ivt_magnitude = ivt_magnitude_data[ar_indices]
+    ivt_direction_deg = ivt_direction_data[ar_indices]
+    has_centroid = len(lon_points_centroid) > 0
+    ivt_max = np.nanmax(ivt_magnitude) if has_centroid else 1
+
+    scatter_trace_centroid = go.Scattergeo(
+        lon=lon_points_centroid,
+        lat=lat_points_centroid,
+        mode='markers',
+        marker=dict(color='red', size=5, opacity=0.8),
+        name='質心',
+        showlegend=True,
+        legendrank=1001,
+        visible=has_centroid,
+    )
+
+    ivt_vectors = go.Scattergeo(
+        lon=lon_points_centroid,
+        lat=lat_points_centroid,
+        mode='markers',
+        marker=dict(
+            symbol='arrow',
+            size=(ivt_magnitude / ivt_max) * 10 + 2,
+            color=ivt_magnitude,
+            colorscale='Viridis',
+            cmin=0,
+            cmax=ivt_max,
+            showscale=True,
+            colorbar=dict(
+                title='IVT強度',
+                orientation='h',
+                x=0.5,
+                xanchor='center',
+                y=-0.1,
+                yanchor='top'
             ),
-            text=[f"IVT強度: {mag:.2f}<br>方向: {dir:.0f}°" for mag, dir in
-                  zip(ivt_magnitude, ivt_direction_deg)],
-            hovertemplate='<b>經度: %{lon:.2f}<br>緯度: %{lat:.2f}</b><br>%{text}<extra></extra>',
-            name='IVT向量',
-            showlegend=False,
-        )
-        fig.add_trace(ivt_vectors)
-
-    head_lon_points = hlon_data[~np.isnan(hlon_data)]
-    head_lat_points = hlat_data[~np.isnan(hlat_data)]
-
-    if len(head_lon_points) > 0:
-        head_trace = go.Scattergeo(
-            lon=head_lon_points,
-            lat=head_lat_points,
-            mode='markers',
-            marker=dict(color='green', size=8, symbol='triangle-up',
-                        line=dict(width=1, color='DarkSlateGrey')),
-            name='頭部',
-            text=[f"經度: {lon:.2f}<br>緯度: {lat:.2f}" for lon, lat in
-                  zip(head_lon_points, head_lat_points)],
-            hovertemplate='<b>%{text}</b><extra></extra>',
-            showlegend=True,
-        )
-        fig.add_trace(head_trace)
-
-    tail_lon_points = tlon_data[~np.isnan(tlon_data)]
-    tail_lat_points = tlat_data[~np.isnan(tlat_data)]
-
-    if len(tail_lon_points) > 0:
-        tail_trace = go.Scattergeo(
-            lon=tail_lon_points,
-            lat=tail_lat_points,
-            mode='markers',
-            marker=dict(color='blue', size=8, symbol='square', line=dict(width=1, color='DarkSlateGrey')),
-            name='尾部',
-            text=[f"經度: {lon:.2f}<br>緯度: {lat:.2f}" for lon, lat in
-                  zip(tail_lon_points, tail_lat_points)],
-            hovertemplate='<b>%{text}</b><extra></extra>',
-            showlegend=True,
-        )
-        fig.add_trace(tail_trace)
-
-    lon_points_landfall = lflon_data[~np.isnan(lflon_data)]
-    lat_points_landfall = lflat_data[~np.isnan(lflat_data)]
-    ivtdir_points = lfivtdir_data[~np.isnan(lflon_data)]
-    ivtx_points = lfivtx_data[~np.isnan(lflon_data)]
-    ivty_points = lfivty_data[~np.isnan(lflon_data)]
-
-    if len(lon_points_landfall) > 0:
-        hover_text = [
-            f"經度: {lon:.2f}<br>緯度: {lat:.2f}<br>"
-            f"IVT 方向: {ivtdir:.2f}°<br>"
-            f"IVT 經向分量: {ivtx:.2f} kg m^-1 s^-1<br>"
-            f"IVT 緯向分量: {ivty:.2f} kg m^-1 s^-1"
-            for lon, lat, ivtdir, ivtx, ivty in zip(
-                lon_points_landfall,
-                lat_points_landfall,
-                ivtdir_points,
-                ivtx_points,
-                ivty_points
-            )
-        ]
-        landfall_trace = go.Scattergeo(
-            lon=lon_points_landfall,
-            lat=lat_points_landfall,
-            mode='markers',
-            marker=dict(color='#ff7f0e', size=7, opacity=1, symbol='star',
-                        line=dict(width=1, color='DarkSlateGrey')),
-            name='登陸點',
-            text=hover_text,
-            hovertemplate='<b>%{text}</b><extra></extra>',
-            showlegend=True,
-        )
-        fig.add_trace(landfall_trace)
+            opacity=0.7,
+            angle=ivt_direction_deg + 180,
+        ),
+        customdata=np.column_stack([ivt_magnitude, ivt_direction_deg]),
+        hovertemplate='<b>經度: %{lon:.2f}<br>緯度: %{lat:.2f}</b><br>'
+                      'IVT強度: %{customdata[0]:.2f}<br>方向: %{customdata[1]:.0f}°<extra></extra>',
+        name='IVT向量',
+        showlegend=False,
+        visible=has_centroid,
+    )
+
+    head_indices = _point_positions(frame_index, 'head', hlon_data, viewport)
+    head_lon_points = hlon_data[head_indices]
+    head_lat_points = hlat_data[head_indices]
+
+    head_trace = go.Scattergeo(
+        lon=head_lon_points,
+        lat=head_lat_points,
+        mode='markers',
+        marker=dict(color='green', size=8, symbol='triangle-up',
+                    line=dict(width=1, color='DarkSlateGrey')),
+        name='頭部',
+        hovertemplate='<b>經度: %{lon:.2f}<br>緯度: %{lat:.2f}</b><extra></extra>',
+        showlegend=True,
+        legendrank=1002,
+        visible=len(head_lon_points) > 0,
+    )
+
+    tail_indices = _point_positions(frame_index, 'tail', tlon_data, viewport)
+    tail_lon_points = tlon_data[tail_indices]
+    tail_lat_points = tlat_data[tail_indices]
+
+    tail_trace = go.Scattergeo(
+        lon=tail_lon_points,
+        lat=tail_lat_points,
+        mode='markers',
+        marker=dict(color='blue', size=8, symbol='square', line=dict(width=1, color='DarkSlateGrey')),
+        name='尾部',
+        hovertemplate='<b>經度: %{lon:.2f}<br>緯度: %{lat:.2f}</b><extra></extra>',
+        showlegend=True,
+        legendrank=1003,
+        visible=len(tail_lon_points) > 0,
+    )
+
+    landfall_indices = _point_positions(frame_index, 'landfall', lflon_data, viewport)
+    lon_points_landfall = lflon_data[landfall_indices]
+    lat_points_landfall = lflat_data[landfall_indices]
+    ivtdir_points = lfivtdir_data[landfall_indices]
+    ivtx_points = lfivtx_data[landfall_indices]
+    ivty_points = lfivty_data[landfall_indices]
+
+    landfall_trace = go.Scattergeo(
+        lon=lon_points_landfall,
+        lat=lat_points_landfall,
+        mode='markers',
+        marker=dict(color='#ff7f0e', size=7, opacity=1, symbol='star',
+                    line=dict(width=1, color='DarkSlateGrey')),
+        name='登陸點',
+        # 悬停文字由 plotly.js 按模板格式化，服务器端只发送数值
+        customdata=np.column_stack([ivtdir_points, ivtx_points, ivty_points]),
+        hovertemplate='<b>經度: %{lon:.2f}<br>緯度: %{lat:.2f}<br>'
+                      'IVT 方向: %{customdata[0]:.2f}°<br>'
+                      'IVT 經向分量: %{customdata[1]:.2f} kg m^-1 s^-1<br>'
+                      'IVT 緯向分量: %{customdata[2]:.2f} kg m^-1 s^-1</b><extra></extra>',
+        showlegend=True,
+        legendrank=1004,
+        visible=len(lon_points_landfall) > 0,
+    )
+
+    traces = [scatter_trace_centroid, ivt_vectors, head_trace, tail_trace, landfall_trace]
+
+    # 之后是成对的 AR 格点/AR 軸轨迹槽位，槽位数固定（至少 AR_TRACE_SLOTS 个），
+    # 多余的槽位隐藏，这样逐帧更新时只需修改各槽位的数据
+    n_slots = max(AR_TRACE_SLOTS, len(unique_ids))
+    for idx in range(n_slots):
+        if idx >= len(unique_ids):
+            if outline_tolerance is not None:
+                traces.append(_ar_outline_trace(idx, [], None, '', visible=False))
+            else:
+                traces.append(_ar_pixel_trace(idx, empty, empty, None, '', visible=False))
+            traces.append(_ar_axis_trace(empty, empty, '', visible=False))
+            continue
+
+        uid = unique_ids[idx]
+        # 每个 AR 的格点是排序后索引中的一段连续切片
+        group = pixel_index[bounds[idx]:bounds[idx + 1]]
 
+        # 确保索引在数据范围内
+        ar_idx = int(uid) - 1
+        if outline_tolerance is not None:
+            # 轮廓按 AR 的完整区域描出，与视口无关，可以在不同视口之间共用
+            region = group if frame_index is None else frame_index.full_group(uid)
+            trace_ar = partial(trace_outline, region // n_lon, region % n_lon, lons, lats, outline_tolerance)
+            if cache_key is not None:
+                coordinates = outline_cache.get_or_trace(
+                    (cache_key, selected_time_index, int(uid), outline_tolerance), trace_ar)
+            else:
+                coordinates = trace_ar()
+        if ar_idx < len(length_data):
+            # 同一 AR 的属性对所有格点相同，只在轨迹的 meta 中保存一份
+            ar_attributes = [float(values[ar_idx]) for values in (length_data, width_data, life_data, distance_data,
+                                                                   id_data, kspeed_data, kstatus_data)]
+            if outline_tolerance is not None:
+                traces.append(_ar_outline_trace(idx, coordinates, ar_attributes, f'AR {int(uid)}'))
+            else:
+                traces.append(_ar_pixel_trace(idx, lons[group % n_lon], lats[group // n_lon], ar_attributes,
+                                              f'AR {int(uid)}'))
+        elif outline_tolerance is not None:
+            traces.append(_ar_outline_trace(idx, [], None, f'AR {int(uid)}', visible=False))
+        else:
+            traces.append(_ar_pixel_trace(idx, empty, empty, None, f'AR {int(uid)}', visible=False))
+
+        axis_lon_points, axis_lat_points = axis_points(ar_idx)
+        traces.append(_ar_axis_trace(axis_lon_points, axis_lat_points, f'AR {int(uid)} 軸',
+                                     visible=len(axis_lon_points) > 0))
+
+    # 一次性添加所有轨迹，避免逐条 add_trace 的重复校验开销
+    fig.add_traces(traces)
     fig.update_layout(title=f"全球大气河流綜合可視化 - 時間: {current_time}", showlegend=True)
 
-    covered_points = np.sum(~np.isnan(ar_values))
     total_points = len(lons) * len(lats)
     time_display += f" | 覆蓋格點: {covered_points}/{total_points} ({covered_points / total_points * 100:.2f}%)"
 
+    metrics.observe_stage('trace_build', time.perf_counter() - build_started)
+    return fig, time_display
+
+
+def _point_positions(frame_index, name, lon_data, viewport):
+    """点要素中需要绘制的位置：有视口时取空间索引的查询结果，否则取全部非 NaN 的位置。"""
+    if frame_index is None:
+        return np.flatnonzero(~np.isnan(lon_data))
+    return frame_index.visible_points(name, viewport)
+
+
+def _trailing_valid_length(values):
+    valid = np.flatnonzero(~np.isnan(values))
+    return int(valid[-1]) + 1 if len(valid) else 0
+
+
+def _padded_axis_points(axislon_data, axislat_data, slot):
+    """从 (槽位, 点) 网格中取出一个槽位的 AR 軸；軸上各点之后的 NaN 只是补齐长度，不发送。"""
+    if slot >= len(axislon_data):
+        return axislon_data[:0, 0], axislat_data[:0, 0]
+    axis_length = _trailing_valid_length(axislon_data[slot])
+    return axislon_data[slot][:axis_length], axislat_data[slot][:axis_length]
+
+
+def _ar_pixel_trace(slot, lon_points, lat_points, attributes, name, visible=True):
+    colors = plotly.colors.qualitative.Plotly
+    return go.Scattergeo(
+        lon=lon_points,
+        lat=lat_points,
+        mode='markers',
+        marker=dict(size=2, color=colors[slot % len(colors)], opacity=0.7),
+        name=name,
+        meta=attributes,
+        hovertemplate='<b>經度: %{lon:.2f} 緯度: %{lat:.2f}</b><br>'
+                      'AR 長度: %{meta[0]:.2f} m<br>'
+                      'AR 寬度: %{meta[1]:.2f} m<br>'
+                      'AR 生命: %{meta[2]:.2f} s<br>'
+                      'AR 距離: %{meta[3]:.2f} m<br>'
+                      'AR 速度: %{meta[5]:.2f} m/s<br>'
+                      'AR 狀態: %{meta[6]:.0f}<br>'
+                      'AR 标识: %{meta[4]:.2f} <extra></extra>',
+        showlegend=True,
+        visible=visible,
+    )
+
+
+def _ar_outline_trace(slot, coordinates, attributes, name, visible=True):
+    # 每个槽位的 geojson 只有一个 id 固定的要素，逐帧更新时只替换其几何
+    color = plotly.colors.qualitative.Plotly[slot % len(plotly.colors.qualitative.Plotly)]
+    return go.Choropleth(
+        geojson={'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'id': 'ar', 'properties': {},
+             'geometry': {'type': 'MultiPolygon', 'coordinates': coordinates}}]},
+        locations=['ar'],
+        z=[0],
+        colorscale=[[0, color], [1, color]],
+        showscale=False,
+        marker=dict(opacity=0.5, line=dict(color=color, width=1)),
+        name=name,
+        meta=attributes,
+        hovertemplate='AR 長度: %{meta[0]:.2f} m<br>'
+                      'AR 寬度: %{meta[1]:.2f} m<br>'
+                      'AR 生命: %{meta[2]:.2f} s<br>'
+                      'AR 距離: %{meta[3]:.2f} m<br>'
+                      'AR 速度: %{meta[5]:.2f} m/s<br>'
+                      'AR 狀態: %{meta[6]:.0f}<br>'
+                      'AR 标识: %{meta[4]:.2f} <extra></extra>',
+        showlegend=True,
+        visible=visible,
+    )
+
+
+def _ar_axis_trace(lon_points, lat_points, name, visible=True):
+    return go.Scattergeo(
+        lon=lon_points,
+        lat=lat_points,
+        mode='lines',
+        line=dict(color='purple', width=1),
+        name=name,
+        showlegend=False,
+        hoverinfo='none',
+        visible=visible,
+    )
+
+
+def count_ar_slots(fig):
+    """返回综合可视化图形中 AR 轨迹槽位的个数。"""
+    return (len(fig.data) - FIXED_TRACE_COUNT) // 2
+
+
+def combined_frame_updates(fig, client_slots):
+    """
+    从完整渲染的一帧中提取逐帧变化的轨迹属性。
+
+    浏览器中的图形需要已经是 create_combined_ar_figure 生成的固定轨迹布局，
+    地图底图、样式、悬停模板等静态设置保留在客户端，不再重复传输。
+
+    参数:
+    - fig (go.Figure): create_combined_ar_figure 生成的完整图形。
+    - client_slots (int): 浏览器中图形现有的 AR 槽位数。
+
+    返回:
+    - list: [(轨迹索引, {属性: 值})] 列表，嵌套的字典表示只更新其中的子属性；
+      如果该帧需要的槽位多于浏览器中现有的槽位，返回 None，此时需要发送完整图形。
+    """
+    # 已使用的槽位总是连续排在前面，未使用的槽位名称为空
+    used_slots = sum(1 for slot in range(count_ar_slots(fig)) if fig.data[FIXED_TRACE_COUNT + 2 * slot].name)
+    if used_slots > client_slots:
+        return None
+
+    centroid, ivt, head, tail, landfall = fig.data[:FIXED_TRACE_COUNT]
+    updates = [
+        (0, {'lon': centroid.lon, 'lat': centroid.lat, 'visible': centroid.visible}),
+        (1, {'lon': ivt.lon, 'lat': ivt.lat, 'customdata': ivt.customdata, 'visible': ivt.visible,
+             'marker': {'size': ivt.marker.size, 'color': ivt.marker.color, 'cmax': ivt.marker.cmax,
+                        'angle': ivt.marker.angle}}),
+        (2, {'lon': head.lon, 'lat': head.lat, 'visible': head.visible}),
+        (3, {'lon': tail.lon, 'lat': tail.lat, 'visible': tail.visible}),
+        (4, {'lon': landfall.lon, 'lat': landfall.lat, 'customdata': landfall.customdata,
+             'visible': landfall.visible}),
+    ]
+
+    for slot in range(client_slots):
+        pixel_index = FIXED_TRACE_COUNT + 2 * slot
+        if slot < used_slots:
+            pixel, axis = fig.data[pixel_index], fig.data[pixel_index + 1]
+            if pixel.type == 'choropleth':
+                updates.append((pixel_index, {'geojson': pixel.geojson, 'meta': pixel.meta, 'name': pixel.name,
+                                              'visible': pixel.visible}))
+            else:
+                updates.append((pixel_index, {'lon': pixel.lon, 'lat': pixel.lat, 'meta': pixel.meta,
+                                              'name': pixel.name, 'visible': pixel.visible}))
+            updates.append((pixel_index + 1, {'lon': axis.lon, 'lat': axis.lat, 'name': axis.name,
+                                              'visible': axis.visible}))
+        else:
+            updates.append((pixel_index, {'visible': False}))
+            updates.append((pixel_index + 1, {'visible': False}))
+    return [(index, compact_props(props)) for index, props in updates]
+
+
+def create_combined_ar_patch(fig, client_slots):
+    """
+    根据完整渲染的一帧生成 Dash Patch，只包含逐帧变化的轨迹数据和标题。
+
+    参数:
+    - fig (go.Figure): create_combined_ar_figure 生成的完整图形。
+    - client_slots (int): 浏览器中图形现有的 AR 槽位数。
+
+    返回:
+    - Patch: 增量更新；如果该帧需要的槽位多于浏览器中现有的槽位，返回 None。
+    """
+    updates = combined_frame_updates(fig, client_slots)
+    if updates is None:
+        return None
+
+    patch = Patch()
+    for index, props in updates:
+        _apply_to_patch(patch['data'][index], props)
+    patch['layout']['title']['text'] = fig.layout.title.text
+    return patch
+
+
+def _apply_to_patch(location, props):
+    flat = {key: value for key, value in props.items() if not _is_nested(value)}
+    if flat:
+        location.update(flat)
+    for key, value in props.items():
+        if _is_nested(value):
+            _apply_to_patch(location[key], value)
+
+
+def _is_nested(value):
+    # 类型化数组虽然是字典，但作为一个整体替换
+    return isinstance(value, dict) and 'bdata' not in value
+
+
+def encode_typed_array(values):
+    """
+    将数值数组编码为 plotly.js 的 base64 类型化数组 {'dtype', 'bdata'(, 'shape')}。
+
+    完整图形由 plotly 自动编码；Patch 和播放窗口中的逐帧数据由 Dash 直接序列化，
+    numpy 数组会被展开成 JSON 数字列表，因此需要显式编码。浮点数组转为 float32，
+    整数数组在取值范围允许时转为 int16。
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = values.astype(TRACE_DTYPE, copy=False)
+    elif values.dtype.kind in 'iu':
+        fits = not values.size or (values.min() >= np.iinfo(np.int16).min and values.max() <= np.iinfo(np.int16).max)
+        values = values.astype(np.int16 if fits else np.int32, copy=False)
+    encoded = {'dtype': TYPED_ARRAY_CODES[values.dtype.name],
+               'bdata': base64.b64encode(np.ascontiguousarray(values).tobytes()).decode('ascii')}
+    if values.ndim > 1:
+        encoded['shape'] = ', '.join(str(size) for size in values.shape)
+    return encoded
+
+
+def compact_props(props):
+    """将轨迹属性（可嵌套）中的数值数组替换为类型化数组编码，其他值不变。"""
+    compact = {}
+    for key, value in props.items():
+        if isinstance(value, dict):
+            compact[key] = compact_props(value)
+        elif isinstance(value, np.ndarray) and value.dtype.kind in 'fiu':
+            compact[key] = encode_typed_array(value)
+        else:
+            compact[key] = value
+    return compact
+
+
+def field_coarsening_factor(n_lat, n_lon, zoom=1.0, visible_cells=None):
+    """
+    根据地图显示分辨率和缩放级别计算网格场的粗化倍数。
+
+    缩放级别为 1 时全球 360° 经度约占满地图宽度，每个粗化格点占 FIELD_PIXELS_PER_CELL
+    个像素；放大后允许更细的格点，但视口内发送的格点总数始终不超过 MAX_FIELD_POINTS。
+
+    参数:
+    - n_lat, n_lon (int): 原始网格的纬向、经向格点数。
+    - zoom (float): 地图投影的缩放比例（geo.projection.scale）。
+    - visible_cells (int): 裁剪到视口后的格点数（见 visible_grid_size），为 None 时为整个网格。
+
+    返回:
+    - int: 经纬两个方向共用的粗化倍数，1 表示不粗化。
+    """
+    target_lon_cells = max(1, int(DISPLAY_WIDTH_PX * max(zoom, 1.0) / FIELD_PIXELS_PER_CELL))
+    screen_factor = int(np.ceil(n_lon / target_lon_cells))
+    if visible_cells is None:
+        visible_cells = n_lat * n_lon
+    budget_factor = int(np.ceil(np.sqrt(visible_cells / MAX_FIELD_POINTS)))
+    return max(1, screen_factor, budget_factor)
+
+
+def field_zoom_level(zoom):
+    """把缩放比例向上取到 2 的 1/FIELD_ZOOM_STEPS 次幂，相近的缩放共用同一渲染结果。"""
+    return float(2.0 ** (np.ceil(np.log2(max(zoom, 1.0)) * FIELD_ZOOM_STEPS) / FIELD_ZOOM_STEPS))
+
+
+def field_marker_size(lons, factor, zoom=1.0):
+    """
+    粗化后一个格点在屏幕上的宽度（像素），方块格点按此大小绘制，放大后相邻格点之间没有空隙。
+    """
+    grid_step = abs(float(lons[1] - lons[0])) if len(lons) > 1 else 1.0
+    cell_px = grid_step * factor * DISPLAY_WIDTH_PX * max(zoom, 1.0) / 360.0
+    return float(max(2, np.ceil(cell_px) + 1))
+
+
+def _viewport_rows_cols(lons, lats, viewport):
+    """视口内的行号和列号；列按自视口经度起点向东的顺序排列（跨越 0° 经线时也连续）。"""
+    lat0, lat1 = viewport[:2]
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    rows = np.flatnonzero((lats >= lat0) & (lats <= lat1))
+    cols = np.flatnonzero(in_viewport(lons, np.full(len(lons), lat0), viewport))
+    cols = cols[np.argsort(np.mod(lons[cols] - viewport[2], 360), kind='stable')]
+    return rows, cols
+
+
+def visible_grid_size(lons, lats, viewport):
+    """视口内的格点数，viewport 为 None 时为整个网格。"""
+    if viewport is None:
+        return len(lats) * len(lons)
+    rows, cols = _viewport_rows_cols(lons, lats, viewport)
+    return len(rows) * len(cols)
+
+
+def crop_to_viewport(field, lons, lats, viewport):
+    """
+    把二维场 (lat, lon) 裁剪到视口内，viewport 为 None 时原样返回。
+
+    返回:
+    - tuple: (场, 经度, 纬度)。跨越 0° 经线时经度连续递增（可以超过 360），粗化时不会
+      把两侧的经度平均到一起。
+    """
+    if viewport is None:
+        return field, np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+    rows, cols = _viewport_rows_cols(lons, lats, viewport)
+    lons = np.asarray(lons, dtype=float)[cols]
+    lons = viewport[2] + np.mod(lons - viewport[2], 360)
+    return field[np.ix_(rows, cols)], lons, np.asarray(lats, dtype=float)[rows]
+
+
+def outline_tolerance(lons, zoom=1.0):
+    """
+    按地图缩放比例选择 AR 轮廓的简化容差（度）。
+
+    取 OUTLINE_TOLERANCE_PX 个屏幕像素对应的经度跨度，向下取到 2 的整数次幂，使相近的
+    缩放级别共用同一容差和轮廓缓存；不小于网格间距的四分之一。
+    """
+    grid_step = abs(float(lons[1] - lons[0])) if len(lons) > 1 else 1.0
+    degrees = OUTLINE_TOLERANCE_PX * 360.0 / (DISPLAY_WIDTH_PX * max(zoom, 1.0))
+    return float(max(2.0 ** np.floor(np.log2(degrees)), grid_step / 4))
+
+
+def coarsen_field(field, factor):
+    """
+    对场的最后两个维度 (lat, lon) 做块平均粗化，忽略 NaN；整块都是 NaN 的粗化格点仍为 NaN。
+
+    参数:
+    - field (np.ndarray): 二维场 (lat, lon)，也可以带有前导维度，如 (time, lat, lon)。
+    - factor (int): 粗化倍数，末尾不足一块的行列被丢弃。
+
+    返回:
+    - np.ndarray: 粗化后的场。
+    """
+    if factor <= 1:
+        return field
+    n_lat = field.shape[-2] // factor * factor
+    n_lon = field.shape[-1] // factor * factor
+    leading = field.shape[:-2]
+    blocks = field[..., :n_lat, :n_lon].reshape(leading + (n_lat // factor, factor, n_lon // factor, factor))
+    valid = ~np.isnan(blocks)
+    counts = valid.sum(axis=(-3, -1))
+    sums = np.where(valid, blocks, 0).sum(axis=(-3, -1))
+    return np.divide(sums, counts, out=np.full(counts.shape, np.nan), where=counts > 0)
+
+
+def coarsen_coords(coords, factor):
+    """对一维坐标做与 coarsen_field 一致的块平均。"""
+    coords = np.asarray(coords, dtype=float)
+    if factor <= 1:
+        return coords
+    n = len(coords) // factor * factor
+    return coords[:n].reshape(-1, factor).mean(axis=1)
+
+
+def is_gridded_variable(ds, var_name):
+    """判断变量是否为可以按网格场渲染的 (time, lat, lon) 变量。"""
+    return var_name in ds.data_vars and set(ds[var_name].dims) == {'time', 'lat', 'lon'}
+
+
+def create_field_figure(selected_time_index, current_figure, ds, var_name, time_coords, lons, lats, factor,
+                        pyramid=None, zoom=1.0, viewport=None):
+    """
+    将一个 (time, lat, lon) 网格变量在选定时间步的二维场渲染为着色的格点图。
+
+    二维场先裁剪到地图视口，在服务器端按 factor 做块平均粗化，再去掉 NaN 格点，因此
+    渲染时间和传输量由显示分辨率决定，而不是原始网格大小。如果该文件已经预先生成了
+    多分辨率金字塔，则直接读取与 factor 匹配的层级，只对剩余的倍数做即时粗化。
+    方块格点的大小按 zoom 下粗化格点的屏幕宽度确定。
+
+    参数:
+    - selected_time_index (int): 选定的时间步索引。
+    - current_figure (dict): 作为底图的图形。
+    - ds (xarray.Dataset): 数据集。
+    - var_name (str): 变量名。
+    - time_coords, lons, lats: 时间、经度、纬度坐标（lats 与 AR 图一致为翻转后的顺序）。
+    - factor (int): 粗化倍数，由 field_coarsening_factor 计算。
+    - pyramid (Pyramid): 可选的多分辨率金字塔，见 pyramid.py。
+    - zoom (float): 地图缩放比例（field_zoom_level 取整后的值）。
+    - viewport (tuple): 地图视口 (纬度下限, 纬度上限, 经度起点, 经度终点)，为 None 时绘制全球。
+
+    返回:
+    - tuple: (go.Figure, str) 图形和时间显示字符串。
+    """
+    fig = go.Figure(current_figure)
+    fig.data = []
+
+    current_time = pd.Timestamp(time_coords[selected_time_index]).tz_localize('UTC').tz_convert(
+        'Asia/Tokyo').strftime('%Y-%m-%d %H:%M')
+
+    level, remaining = 1, factor
+    if pyramid is not None and var_name in pyramid.variables:
+        level, remaining = pyramid.select_level(factor)
+    if level > 1:
+        with metrics.stage('slice'):
+            field, level_lons, level_lats = pyramid.read_field(var_name, selected_time_index, level)
+        lons, lats = level_lons, level_lats[::-1]
+    else:
+        field = read_frame(ds, [var_name], selected_time_index)[var_name]
+
+    build_started = time.perf_counter()
+    marker_size = field_marker_size(lons, remaining, zoom)
+    field, lons, lats = crop_to_viewport(field[::-1, :], lons, lats, viewport)
+    field = field.astype(float)
+    units = ds[var_name].attrs.get('units', '')
+    n_points = _add_field_trace(fig, field, lons, lats, remaining, var_name,
+                                f"{var_name} ({units})" if units else var_name, marker_size=marker_size)
+    fig.update_layout(title=f"{var_name} - 時間: {current_time}", showlegend=True)
+
+    time_display = (f"当前时间 (JST): {current_time} | 变量: {var_name} | "
+                    f"显示格点: {n_points} (粗化倍数 {level * remaining}"
+                    f"{f'，金字塔层级 1/{level}' if level > 1 else ''})")
+    metrics.observe_stage('trace_build', time.perf_counter() - build_started)
     return fig, time_display
+
+
+def _add_field_trace(fig, field, lons, lats, factor, name, colorbar_title, colorscale='Viridis', cmid=None,
+                     marker_size=FIELD_PIXELS_PER_CELL):
+    """
+    将二维场按 factor 粗化后作为方块格点轨迹加入图形，NaN 格点不绘制。
+    方块边长为 marker_size 像素（见 field_marker_size）。
+
+    返回:
+    - int: 绘制的格点数。
+    """
+    values = coarsen_field(field, factor)
+    # 裁剪后跨越 0° 经线的经度可以超过 360，发送前取回 [0, 360)
+    lon_centers = coarsen_coords(lons, factor)
+    lon_grid, lat_grid = np.meshgrid(np.where(lon_centers >= 360, lon_centers - 360, lon_centers),
+                                     coarsen_coords(lats, factor))
+    valid = ~np.isnan(values)
+
+    fig.add_trace(go.Scattergeo(
+        lon=lon_grid[valid].astype(TRACE_DTYPE),
+        lat=lat_grid[valid].astype(TRACE_DTYPE),
+        mode='markers',
+        marker=dict(
+            symbol='square',
+            size=marker_size,
+            color=values[valid].astype(TRACE_DTYPE),
+            colorscale=colorscale,
+            cmid=cmid,
+            showscale=True,
+            colorbar=dict(title=colorbar_title, orientation='h', x=0.5, xanchor='center', y=-0.1, yanchor='top'),
+        ),
+        name=name,
+        hovertemplate='<b>經度: %{lon:.2f} 緯度: %{lat:.2f}</b><br>' + name + ': %{marker.color:.2f}<extra></extra>',
+        showlegend=False,
+    ))
+    return int(valid.sum())
+
+
+def create_aggregate_figure(current_figure, field, lons, lats, var_name, units, title, factor, diverging=False,
+                            zoom=1.0, viewport=None):
+    """
+    将时间统计结果（见 aggregation.py）渲染为与网格场相同样式的格点图。
+
+    参数:
+    - current_figure (dict): 作为底图的图形。
+    - field (np.ndarray): 统计得到的二维场 (lat, lon)，纬度保持源文件顺序。
+    - lons, lats: 经度、纬度坐标（lats 为翻转后的顺序）。
+    - var_name (str): 变量名，units (str): 统计结果的单位。
+    - title (str): 图形标题。
+    - factor (int): 粗化倍数。
+    - diverging (bool): 为 True 时使用以 0 为中心的发散色标（用于距平）。
+    - zoom, viewport: 地图缩放比例和视口，含义同 create_field_figure。
+
+    返回:
+    - tuple: (go.Figure, int) 图形和绘制的格点数。
+    """
+    fig = go.Figure(current_figure)
+    fig.data = []
+    marker_size = field_marker_size(lons, factor, zoom)
+    field, lons, lats = crop_to_viewport(np.asarray(field, dtype=float)[::-1, :], lons, lats, viewport)
+    n_points = _add_field_trace(fig, field, lons, lats, factor, var_name,
+                                f"{var_name} ({units})" if units else var_name,
+                                colorscale='RdBu_r' if diverging else 'Viridis', cmid=0 if diverging else None,
+                                marker_size=marker_size)
+    fig.update_layout(title=title, showlegend=True)
+    return fig, n_points
+
+
+def create_field_patch(fig):
+    """网格场图形的增量更新：底图和样式不变，只更新格点位置、颜色、大小和标题。"""
+    patch = Patch()
+    trace = fig.data[0]
+    patch['data'][0].update(compact_props({'lon': trace.lon, 'lat': trace.lat}))
+    patch['data'][0]['marker']['color'] = encode_typed_array(trace.marker.color)
+    patch['data'][0]['marker']['size'] = trace.marker.size
+    patch['layout']['title']['text'] = fig.layout.title.text
+    return patch
+
+
+def decimate_series(values, max_points=MAX_SERIES_POINTS):
+    """
+    将长时间序列均匀分成若干区间，每个区间只保留最小值和最大值所在的位置，
+    使曲线的峰值在降采样后仍然可见。
+
+    返回:
+    - np.ndarray: 保留的下标（升序）。
+    """
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    n_buckets = max_points // 2
+    size = int(np.ceil(n / n_buckets))
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = values
+    buckets = padded.reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+    low = np.where(np.isnan(buckets), np.inf, buckets).argmin(axis=1) + offsets
+    high = np.where(np.isnan(buckets), -np.inf, buckets).argmax(axis=1) + offsets
+    return np.unique(np.concatenate([low, high]).clip(0, n - 1))
+
+
+def create_series_figure(time_coords, series, names, title, y_title):
+    """
+    绘制一条或多条时间序列，时间轴为日本标准时间。
+
+    参数:
+    - time_coords (np.ndarray): 时间坐标 (UTC)。
+    - series (np.ndarray): (曲线数, 时间步数) 的数值。
+    - names (list): 各曲线名称。
+    - title, y_title (str): 图标题和纵轴标题。
+
+    返回:
+    - go.Figure
+    """
+    times = pd.DatetimeIndex(time_coords).tz_localize('UTC').tz_convert('Asia/Tokyo').tz_localize(None)
+    fig = go.Figure()
+    for values, name in zip(np.atleast_2d(series), names):
+        values = np.asarray(values, dtype=float)
+        keep = decimate_series(values)
+        fig.add_trace(go.Scattergl(x=times[keep], y=values[keep], mode='lines', name=name))
+    fig.update_layout(title=title, xaxis_title='时间 (JST)', yaxis_title=y_title,
+                      margin={"r": 20, "t": 50, "l": 60, "b": 40}, showlegend=len(names) > 1)
+    return fig
+
+
+def create_track_trace(track_index, kid, time_coords):
+    """
+    绘制某个 AR 从生成到消亡的质心路径，作为叠加在当前地图上的一条轨迹。
+
+    参数:
+    - track_index (ARTrackIndex): 数据集的 AR 轨迹索引（见 tracks.py）。
+    - kid (float): AR 标识。
+    - time_coords (np.ndarray): 时间坐标 (UTC)。
+
+    返回:
+    - go.Scattergeo
+    """
+    rows = track_index.track(kid)
+    columns = track_index.columns
+    times = pd.DatetimeIndex(time_coords[columns['time_index'][rows]]).tz_localize('UTC').tz_convert('Asia/Tokyo')
+    customdata = np.column_stack([times.strftime('%Y-%m-%d %H:%M'), columns['length'][rows],
+                                  columns['speed'][rows]])
+    return go.Scattergeo(
+        lon=columns['clon'][rows],
+        lat=columns['clat'][rows],
+        mode='lines+markers',
+        line=dict(color='black', width=2),
+        marker=dict(size=5, color='black'),
+        name=f'AR {kid:g} 軌跡',
+        customdata=customdata,
+        hovertemplate='<b>AR ' + f'{kid:g}' + ' 質心</b><br>'
+                      '時間 (JST): %{customdata[0]}<br>'
+                      '經度: %{lon:.2f} 緯度: %{lat:.2f}<br>'
+                      'AR 長度: %{customdata[1]:.2f} m<br>'
+                      'AR 速度: %{customdata[2]:.2f} m/s<extra></extra>',
+        showlegend=True,
+    )
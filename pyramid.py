@@ -0,0 +1,271 @@
+# pyramid.py
+"""
+为大型网格数据集预先生成多分辨率金字塔。
+
+每个 (time, lat, lon) 变量按 1/2、1/4、1/8 等倍数做块平均粗化，按层级和时间块
+写入 <源文件>.pyramid/level_<倍数>/chunk_<起始时间步>.nc，并用 manifest.json 记录
+源文件指纹和已完成的时间块。生成过程按时间块在多个进程中并行执行，中断后再次
+运行会跳过已完成的时间块；每个时间块再按 WRITE_BLOCK_BYTES 大小逐块读入、粗化并
+追加写入各层级文件，工作进程的内存占用与时间块长度无关。应用打开文件时只读取清单，
+浏览时按当前视图选择层级。
+
+用法:
+    python pyramid.py ERA5_AR.nc --levels 2 4 8 --workers 4
+"""
+import argparse
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import netCDF4
+import numpy as np
+import xarray as xr
+from xarray.coding.times import encode_cf_datetime
+
+from data_loader import open_source
+from plot_functions import coarsen_field, coarsen_coords
+
+# 默认生成的粗化层级（1/1 即源文件本身，不重复存储）
+PYRAMID_LEVELS = (2, 4, 8)
+
+# 每个时间块包含的时间步数，也是并行和断点续做的单位
+DEFAULT_TIME_CHUNK = 64
+
+# 工作进程每次读入并写出的时间块的字节数上限（至少一个时间步）
+WRITE_BLOCK_BYTES = 256 * 1024 ** 2
+
+# 浏览时同时保持打开的层级文件个数
+MAX_OPEN_FILES = 16
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def default_pyramid_dir(source_path):
+    return os.path.abspath(source_path) + '.pyramid'
+
+
+def _fingerprint(source_path):
+    stat = os.stat(source_path)
+    return {'path': os.path.abspath(source_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _chunk_path(pyramid_dir, level, start):
+    return os.path.join(pyramid_dir, f'level_{level}', f'chunk_{start:08d}.nc')
+
+
+def _read_manifest(pyramid_dir):
+    try:
+        with open(os.path.join(pyramid_dir, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(pyramid_dir, manifest):
+    # 先写临时文件再替换，中断时清单不会损坏
+    path = os.path.join(pyramid_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _block_times(ds, variables, nbytes):
+    """nbytes 字节内可以容纳的时间步数（各变量一个时间步的 float32 大小之和），至少为 1。"""
+    step_bytes = sum(4 * ds[var].size // ds.sizes['time'] for var in variables)
+    return int(max(1, nbytes // max(1, step_bytes)))
+
+
+def _coarsen_block(block, variables, level):
+    return {var: coarsen_field(block[var].transpose('time', 'lat', 'lon').values.astype(np.float32),
+                               level).astype(np.float32)
+            for var in variables}
+
+
+def _build_chunk(source_path, pyramid_dir, variables, levels, start, stop, block_times):
+    """
+    在工作进程中生成一个时间块在所有层级上的粗化结果。
+
+    源数据按 block_times 个时间步逐块读入；第一块写出时创建各层级文件（time 为不限长
+    维度），之后的块直接追加到文件末尾，内存中同时只有一个时间块。
+    """
+    paths = {level: _chunk_path(pyramid_dir, level, start) + '.tmp' for level in levels}
+    with open_source(source_path) as ds:
+        source = ds[variables].isel(time=slice(start, stop))
+        # 整个时间块的时间坐标统一编码，追加的时间步与第一块使用相同的单位
+        times, units, calendar = encode_cf_datetime(source.time.values)
+        for offset in range(0, stop - start, block_times):
+            block = source.isel(time=slice(offset, offset + block_times)).load()
+            end = offset + block.sizes['time']
+            for level, path in paths.items():
+                fields = _coarsen_block(block, variables, level)
+                if offset == 0:
+                    level_ds = xr.Dataset(
+                        {var: (('time', 'lat', 'lon'), fields[var], block[var].attrs) for var in variables},
+                        coords={'time': block.time.values,
+                                'lat': coarsen_coords(block.lat.values, level),
+                                'lon': coarsen_coords(block.lon.values, level)})
+                    # 按单个时间步分块存储，逐帧读取时只解压一个时间步
+                    encoding = {var: {'zlib': True, 'complevel': 1,
+                                      'chunksizes': (1, level_ds.sizes['lat'], level_ds.sizes['lon'])}
+                                for var in variables}
+                    encoding['time'] = {'units': units, 'calendar': calendar, 'dtype': times.dtype}
+                    level_ds.to_netcdf(path, encoding=encoding, format='NETCDF4', unlimited_dims=['time'])
+                else:
+                    with netCDF4.Dataset(path, 'a') as nc:
+                        nc['time'][offset:end] = times[offset:end]
+                        for var in variables:
+                            nc[var][offset:end] = fields[var]
+
+    for level, path in paths.items():
+        os.replace(path, _chunk_path(pyramid_dir, level, start))
+    return start
+
+
+def build_pyramid(source_path, pyramid_dir=None, levels=PYRAMID_LEVELS, time_chunk=DEFAULT_TIME_CHUNK, workers=None):
+    """
+    为源文件生成（或继续生成）多分辨率金字塔。
+
+    参数:
+    - source_path (str): 源数据文件路径（NetCDF、GRIB 等 data_loader 支持的格式）。
+    - pyramid_dir (str): 金字塔目录，默认为 <源文件>.pyramid。
+    - levels (tuple): 粗化倍数列表。
+    - time_chunk (int): 每个时间块的时间步数。
+    - workers (int): 并行进程数，默认为 CPU 核数。
+
+    返回:
+    - dict: 生成完成后的清单。
+    """
+    pyramid_dir = pyramid_dir or default_pyramid_dir(source_path)
+    with open_source(source_path) as ds:
+        variables = [var for var in ds.data_vars if set(ds[var].dims) == {'time', 'lat', 'lon'}]
+        n_times = ds.sizes['time']
+        n_lat, n_lon = ds.sizes['lat'], ds.sizes['lon']
+        block_times = _block_times(ds, variables, WRITE_BLOCK_BYTES)
+    levels = sorted(level for level in set(levels) if 1 < level <= min(n_lat, n_lon))
+
+    settings = {'source': _fingerprint(source_path), 'variables': variables, 'levels': levels,
+                'time_chunk': time_chunk, 'n_times': n_times}
+    manifest = _read_manifest(pyramid_dir)
+    if manifest is None or any(manifest.get(key) != value for key, value in settings.items()):
+        # 源文件或参数发生变化时从头生成
+        manifest = dict(settings, completed=[], complete=False)
+    for level in levels:
+        os.makedirs(os.path.join(pyramid_dir, f'level_{level}'), exist_ok=True)
+    _write_manifest(pyramid_dir, manifest)
+
+    completed = set(manifest['completed'])
+    starts = [start for start in range(0, n_times, time_chunk) if start not in completed]
+    total_chunks = math.ceil(n_times / time_chunk)
+    print(f"金字塔 {pyramid_dir}: 共 {total_chunks} 个时间块，待生成 {len(starts)} 个")
+
+    if starts:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_build_chunk, source_path, pyramid_dir, variables, levels, start,
+                                   min(start + time_chunk, n_times), block_times)
+                       for start in starts]
+            for future in as_completed(futures):
+                completed.add(future.result())
+                manifest['completed'] = sorted(completed)
+                _write_manifest(pyramid_dir, manifest)
+                print(f"已完成 {len(completed)}/{total_chunks} 个时间块")
+
+    manifest['complete'] = True
+    _write_manifest(pyramid_dir, manifest)
+    return manifest
+
+
+class Pyramid:
+    """
+    已生成的多分辨率金字塔的只读访问接口。
+
+    打开时只读取清单，层级文件在首次访问对应时间块时才打开，并以 LRU 方式限制
+    同时打开的文件数。
+    """
+
+    def __init__(self, pyramid_dir, manifest):
+        self.pyramid_dir = pyramid_dir
+        self.manifest = manifest
+        self.variables = manifest['variables']
+        self.levels = manifest['levels']
+        self.time_chunk = manifest['time_chunk']
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def select_level(self, factor):
+        """
+        选择与所需粗化倍数匹配的层级。
+
+        返回:
+        - tuple: (层级倍数, 还需即时粗化的倍数)。factor 不大于 1 或小于最小层级时返回
+          (1, factor)，即读取原始分辨率；否则取不大于 factor 的最大层级，剩余倍数为
+          ceil(factor / 层级)。
+        """
+        if factor <= 1 or not self.levels or factor < self.levels[0]:
+            return 1, factor
+        level = max(level for level in self.levels if level <= factor)
+        return level, math.ceil(factor / level)
+
+    def _open(self, level, start):
+        """取出（必要时打开）一个层级文件，调用方需持有 self._lock。"""
+        key = (level, start)
+        ds = self._files.get(key)
+        if ds is not None:
+            self._files.move_to_end(key)
+            return ds
+        ds = xr.open_dataset(_chunk_path(self.pyramid_dir, level, start))
+        self._files[key] = ds
+        while len(self._files) > MAX_OPEN_FILES:
+            self._files.popitem(last=False)[1].close()
+        return ds
+
+    def read_field(self, var_name, time_index, level):
+        """
+        读取某个层级上一个时间步的粗化场。
+
+        返回:
+        - tuple: (二维场, 该层级的经度, 该层级的纬度)，纬度保持源文件中的顺序。
+        """
+        start = time_index // self.time_chunk * self.time_chunk
+        # 读取期间保持持锁，其他线程打开新文件时不会把正在读取的文件淘汰关闭
+        with self._lock:
+            ds = self._open(level, start)
+            field = ds[var_name].isel(time=time_index - start).transpose('lat', 'lon').values
+            return field, ds.lon.values, ds.lat.values
+
+    def close(self):
+        with self._lock:
+            for ds in self._files.values():
+                ds.close()
+            self._files.clear()
+
+
+def open_pyramid(source_path, pyramid_dir=None):
+    """
+    打开源文件对应的金字塔。金字塔不存在、未生成完或源文件已改变时返回 None。
+    """
+    pyramid_dir = pyramid_dir or default_pyramid_dir(source_path)
+    manifest = _read_manifest(pyramid_dir)
+    if manifest is None or not manifest.get('complete'):
+        return None
+    if manifest.get('source') != _fingerprint(source_path):
+        print(f"警告：金字塔 {pyramid_dir} 与源文件不一致，已忽略")
+        return None
+    return Pyramid(pyramid_dir, manifest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='为 NetCDF 网格数据生成多分辨率金字塔')
+    parser.add_argument('source', help='源数据文件（NetCDF、GRIB 等）')
+    parser.add_argument('--out', default=None, help='金字塔目录，默认为 <源文件>.pyramid')
+    parser.add_argument('--levels', type=int, nargs='+', default=list(PYRAMID_LEVELS), help='粗化倍数')
+    parser.add_argument('--time-chunk', type=int, default=DEFAULT_TIME_CHUNK, help='每个时间块的时间步数')
+    parser.add_argument('--workers', type=int, default=None, help='并行进程数')
+    args = parser.parse_args()
+    build_pyramid(args.source, args.out, args.levels, args.time_chunk, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# shared_store.py
+"""
+多进程部署时在各 worker 之间共享已加载的数据集。
+
+每个数据集句柄 (dataset_id) 对应共享目录中的一个清单文件，记录数据所在的路径。
+浏览器上传的文件内容在这里写成共享目录中的文件（Linux 上默认位于 /dev/shm，即
+共享内存），之后与服务器路径上的文件一样由 xarray 惰性打开。任何 worker 收到
+不认识的句柄时读取清单、按路径打开即可：变量数据通过操作系统的页缓存按需读取，
+所有 worker 共用同一份物理内存，内存占用不随 worker 数增加。
+
+清单和上传文件在句柄被释放时删除；超过 SHARED_TTL_SECONDS 未被释放的会在之后
+发布新句柄时清理。
+"""
+import base64
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from metrics import metrics
+
+# 共享目录：优先使用内存文件系统 /dev/shm
+SHARED_DIR = os.environ.get(
+    'AR_VIS_SHARED_DIR',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'ar_vis_shared'))
+
+# 清单和上传文件的最长保留时间（秒）
+SHARED_TTL_SECONDS = 24 * 3600
+
+MANIFEST_SUFFIX = '.json'
+
+
+def _manifest_path(dataset_id):
+    return os.path.join(SHARED_DIR, dataset_id + MANIFEST_SUFFIX)
+
+
+def save_upload(file_content, file_name):
+    """
+    将 dcc.Upload 的 base64 内容解码后写入共享目录。
+
+    参数:
+    - file_content (str): data URL 形式的 base64 文件内容。
+    - file_name (str): 上传的文件名，只保留其扩展名。
+
+    返回:
+    - str: 共享目录中的文件路径。
+    """
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    path = os.path.join(SHARED_DIR, uuid.uuid4().hex + os.path.splitext(file_name)[1].lower())
+    with metrics.stage('decode'):
+        decoded = base64.b64decode(file_content.split(',', 1)[1])
+    with open(path + '.tmp', 'wb') as f:
+        f.write(decoded)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def publish(dataset_id, source, temp_path=None, indexed=False):
+    """
+    发布一个句柄，使其他 worker 可以按清单打开同一份数据。
+
+    参数:
+    - dataset_id (str): 数据集句柄。
+    - source (str): 数据文件或逐帧存储路径。
+    - temp_path (str): 句柄释放时需要删除的文件（上传到共享目录或临时目录的文件）。
+    - indexed (bool): AR 轨迹索引是否已建立并写入磁盘缓存。后台加载任务先发布句柄、
+      显示第一帧，建好索引后再以 indexed=True 重新发布。
+    """
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    prune()
+    path = _manifest_path(dataset_id)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'dataset_id': dataset_id, 'source': source, 'temp_path': temp_path, 'indexed': indexed,
+                   'created': time.time()}, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+def read_manifest(dataset_id):
+    """返回句柄的清单，未发布（或已释放）时返回 None。"""
+    if not dataset_id or os.sep in dataset_id or '/' in dataset_id:
+        return None
+    try:
+        with open(_manifest_path(dataset_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def unpublish(dataset_id):
+    """释放句柄：删除清单及其临时文件。已经打开该数据的 worker 在 LRU 淘汰时关闭它。"""
+    manifest = read_manifest(dataset_id)
+    if manifest is None:
+        return
+    for path in (_manifest_path(dataset_id), manifest.get('temp_path')):
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"警告：删除共享文件 {path} 失败 - {str(e)}")
+
+
+def prune(max_age=SHARED_TTL_SECONDS):
+    """清理超过 max_age 秒仍未释放的句柄。"""
+    if not os.path.isdir(SHARED_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(SHARED_DIR):
+        if name.endswith(MANIFEST_SUFFIX):
+            manifest = read_manifest(name[:-len(MANIFEST_SUFFIX)])
+            if manifest is not None and now - manifest.get('created', now) > max_age:
+                print(f"清理过期的共享数据集 {manifest['dataset_id']}")
+                unpublish(manifest['dataset_id'])
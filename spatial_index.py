@@ -0,0 +1,205 @@
+# spatial_index.py
+"""
+按地图视口裁剪逐帧发送的 AR 要素。
+
+地图缩放到局部区域时，只需发送视口（加上一圈余量）内的 AR 格点和质心、头部、
+尾部、登陆点。每个时间步建立一次网格分桶索引：要素按所在的 INDEX_BUCKET_DEG
+经纬度桶排序，各桶是排序结果中的一段连续切片；查询时只取与视口相交的桶再精确
+过滤，耗时与视口内的要素数成正比。索引按 (数据集, 时间步) 缓存，同一时间步的
+平移和缩放不再重新读取 shapemap。
+
+视口以 (纬度下限, 纬度上限, 经度起点, 经度终点) 表示，经度起点在 [0, 360) 内，
+终点可以超过 360，表示跨越 0° 经线。
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# 分桶的经纬度跨度（度）
+INDEX_BUCKET_DEG = 10.0
+
+# 视口四周附加的余量（视口跨度的比例），平移少许时仍在已发送的范围内
+VIEWPORT_MARGIN = 0.1
+
+# 视口边界对齐的粒度（度），使相近的视图共用同一帧缓存
+VIEWPORT_SNAP_DEG = 5.0
+
+# 图形区域宽高比与地图不同、以及 natural earth 投影在高纬度横向收缩，同样的缩放下
+# 可见的经度范围最多约为 360/scale 的两倍，按此放宽经度范围
+VIEWPORT_LON_FACTOR = 2.0
+
+# 索引缓存最多保存的要素总数
+FRAME_INDEX_CACHE_MAX_POINTS = 4 * 1024 ** 2
+
+
+def geo_viewport(scale, center_lon, center_lat):
+    """
+    由地图的缩放比例和中心估计可见范围。
+
+    参数:
+    - scale (float): geo.projection.scale，1 表示显示全球。
+    - center_lon, center_lat (float): 地图中心的经纬度。
+
+    返回:
+    - tuple: 视口 (纬度下限, 纬度上限, 经度起点, 经度终点)，已加上余量并向外对齐到
+      VIEWPORT_SNAP_DEG；显示全球时返回 None。
+    """
+    if scale is None or scale <= 1:
+        return None
+    # 缩放比例向下取到 2 的整数次幂、中心取到 VIEWPORT_SNAP_DEG 的整数倍（范围相应放宽），
+    # 滚轮缩放和小幅平移得到的是同一个视口
+    scale = 2.0 ** np.floor(np.log2(scale))
+    center_lon = np.round(center_lon / VIEWPORT_SNAP_DEG) * VIEWPORT_SNAP_DEG
+    center_lat = np.round(center_lat / VIEWPORT_SNAP_DEG) * VIEWPORT_SNAP_DEG
+    half_lat = 90.0 / scale * (1 + 2 * VIEWPORT_MARGIN) + VIEWPORT_SNAP_DEG / 2
+    half_lon = 180.0 / scale * VIEWPORT_LON_FACTOR * (1 + 2 * VIEWPORT_MARGIN) + VIEWPORT_SNAP_DEG / 2
+    lat0 = max(-90.0, np.floor((center_lat - half_lat) / VIEWPORT_SNAP_DEG) * VIEWPORT_SNAP_DEG)
+    lat1 = min(90.0, np.ceil((center_lat + half_lat) / VIEWPORT_SNAP_DEG) * VIEWPORT_SNAP_DEG)
+    if half_lon >= 180:
+        lon0, lon1 = 0.0, 360.0
+    else:
+        west = np.floor((center_lon - half_lon) / VIEWPORT_SNAP_DEG) * VIEWPORT_SNAP_DEG
+        east = np.ceil((center_lon + half_lon) / VIEWPORT_SNAP_DEG) * VIEWPORT_SNAP_DEG
+        lon0 = west % 360
+        lon1 = lon0 + min(east - west, 360.0)
+    if lat0 <= -90 and lat1 >= 90 and lon1 - lon0 >= 360:
+        return None
+    return (float(lat0), float(lat1), float(lon0), float(lon1))
+
+
+def in_viewport(lon, lat, viewport):
+    """逐点判断是否在视口内，处理经度的 0/360 环绕。"""
+    lat0, lat1, lon0, lon1 = viewport
+    return (lat >= lat0) & (lat <= lat1) & (np.mod(lon - lon0, 360) <= lon1 - lon0)
+
+
+class BucketIndex:
+    """
+    一组点要素的经纬度分桶索引。
+
+    点按桶号稳定排序，第 k 个桶的点为 order[bounds[k]:bounds[k + 1]]。
+    """
+
+    def __init__(self, lon, lat, ids=None, bucket_deg=INDEX_BUCKET_DEG):
+        lon = np.asarray(lon, dtype=np.float32)
+        lat = np.asarray(lat, dtype=np.float32)
+        ids = np.arange(len(lon)) if ids is None else np.asarray(ids)
+        valid = ~(np.isnan(lon) | np.isnan(lat))
+        self.lon, self.lat, self.ids = lon[valid], lat[valid], ids[valid]
+        self.bucket_deg = bucket_deg
+        self.n_rows = int(np.ceil(180 / bucket_deg))
+        self.n_cols = int(np.ceil(360 / bucket_deg))
+        keys = self._rows(self.lat) * self.n_cols + self._cols(self.lon)
+        self.order = np.argsort(keys, kind='stable').astype(np.int32)
+        self.bounds = np.searchsorted(keys[self.order], np.arange(self.n_rows * self.n_cols + 1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _rows(self, lat):
+        return np.clip(np.floor((lat + 90) / self.bucket_deg).astype(np.int64), 0, self.n_rows - 1)
+
+    def _cols(self, lon):
+        return np.floor(np.mod(lon, 360) / self.bucket_deg).astype(np.int64) % self.n_cols
+
+    def query(self, viewport):
+        """返回视口内各点的 ids（升序）。"""
+        lat0, lat1, lon0, lon1 = viewport
+        rows = np.arange(self._rows(np.float64(lat0)), self._rows(np.float64(lat1)) + 1)
+        if lon1 - lon0 >= 360:
+            cols = np.arange(self.n_cols)
+        else:
+            first = int(np.floor(lon0 / self.bucket_deg))
+            cols = np.unique(np.arange(first, int(np.floor(lon1 / self.bucket_deg)) + 1) % self.n_cols)
+        keys = (rows[:, None] * self.n_cols + cols[None, :]).ravel()
+        slices = [self.order[self.bounds[key]:self.bounds[key + 1]] for key in keys
+                  if self.bounds[key + 1] > self.bounds[key]]
+        if not slices:
+            return self.ids[:0]
+        candidates = np.concatenate(slices)
+        # 桶的边缘不与视口对齐，候选点还需精确判断
+        visible = candidates[in_viewport(self.lon[candidates], self.lat[candidates], viewport)]
+        return np.sort(self.ids[visible])
+
+
+class FrameSpatialIndex:
+    """
+    一个时间步的 AR 要素索引。
+
+    参数:
+    - unique_ids, pixel_index, bounds: group_label_pixels 的结果，AR 格点按标签分组。
+    - lons, lats (np.ndarray): 网格各列的经度、各行的纬度。
+    - points (dict): 点要素名 -> (经度数组, 纬度数组)，NaN 表示该位置无要素。
+    """
+
+    def __init__(self, unique_ids, pixel_index, bounds, lons, lats, points):
+        n_lon = len(lons)
+        self.unique_ids = unique_ids
+        self.pixel_index = pixel_index
+        self.bounds = bounds
+        self.covered = len(pixel_index)
+        # 格点在 pixel_index 中的位置即其 id：位置按标签分组，查询结果升序时仍按标签分组
+        self.pixels = BucketIndex(lons[pixel_index % n_lon], lats[pixel_index // n_lon])
+        self.points = {name: BucketIndex(lon, lat) for name, (lon, lat) in points.items()}
+
+    def __len__(self):
+        return len(self.pixels) + sum(len(index) for index in self.points.values())
+
+    def visible_groups(self, viewport):
+        """
+        返回视口内的 AR 格点，格式与 group_label_pixels 相同：
+        (唯一标签, 按标签分组的扁平格点索引, 各标签切片的边界)。
+        """
+        positions = self.pixels.query(viewport)
+        # 每个格点所属的标签即其位置所在的分组
+        groups = np.searchsorted(self.bounds, positions, side='right') - 1
+        present, starts = np.unique(groups, return_index=True)
+        return self.unique_ids[present], self.pixel_index[positions], np.append(starts, len(positions))
+
+    def full_group(self, uid):
+        """返回一个 AR 的全部格点（描轮廓需要完整的区域，不只视口内的部分）。"""
+        k = int(np.searchsorted(self.unique_ids, uid))
+        return self.pixel_index[self.bounds[k]:self.bounds[k + 1]]
+
+    def visible_points(self, name, viewport):
+        """返回视口内某种点要素在原数组中的位置。"""
+        return self.points[name].query(viewport)
+
+
+class FrameIndexCache:
+    """
+    逐帧空间索引的 LRU 缓存，键为 (数据集ID, 时间步)，按要素总数限制大小。
+    """
+
+    def __init__(self, max_points=FRAME_INDEX_CACHE_MAX_POINTS):
+        self.max_points = max_points
+        self._indexes = OrderedDict()
+        self._points = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+            return index
+
+    def put(self, key, index):
+        with self._lock:
+            if key in self._indexes:
+                return
+            self._indexes[key] = index
+            self._points += len(index)
+            while self._points > self.max_points and len(self._indexes) > 1:
+                self._points -= len(self._indexes.popitem(last=False)[1])
+
+    def invalidate(self, dataset_id):
+        """删除某个数据集的全部索引。"""
+        with self._lock:
+            for key in [key for key in self._indexes if key[0] == dataset_id]:
+                self._points -= len(self._indexes.pop(key))
+
+
+# 进程内共享的逐帧空间索引缓存
+frame_index_cache = FrameIndexCache()
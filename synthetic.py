@@ -0,0 +1,246 @@
+# synthetic.py
+"""
+生成与真实 ERA5/AR 识别结果结构相同的合成 NetCDF 文件，用于基准测试和回归检查。
+
+文件中的变量与 create_combined_ar_figure 读取的变量一致：
+- shapemap (time, lat, lon): AR 标签，取值为该时间步中的槽位号加 1，AR 之外为 NaN；
+- ivt (time, lat, lon): 整层水汽通量强度，AR 内部为高值；
+- axislon/axislat (time, lat, lon): 第 i 行为槽位 i 的 AR 軸上各点的经纬度；
+- length、width、kid、clon/clat、ivtx/ivty、hlon/hlat、tlon/tlat、lflon/lflat 等
+  (time, lon) 逐 AR 变量，第二维为槽位，未使用的槽位为 NaN。
+
+每个 AR 有固定的 kid，在若干个时间步内向东移动，长度随生命周期先增后减，
+AR 头部进入陆地区域时记录登陆点。数据按时间步惰性生成并逐步写入文件，
+内存占用只与网格大小有关。
+
+用法:
+    python synthetic.py synthetic.nc --grid 721x1440 --times 48 --ars 30
+"""
+import argparse
+import time
+
+import dask
+import dask.array
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# 逐 AR 变量及其单位
+AR_FIELDS = {
+    'length': 'm', 'width': 'm', 'klifetime': 's', 'kdist': 'm', 'kid': '', 'kspeed': 'm s-1', 'kstatus': '',
+    'clon': 'degrees_east', 'clat': 'degrees_north', 'ivtx': 'kg m-1 s-1', 'ivty': 'kg m-1 s-1',
+    'hlon': 'degrees_east', 'hlat': 'degrees_north', 'tlon': 'degrees_east', 'tlat': 'degrees_north',
+    'lflon': 'degrees_east', 'lflat': 'degrees_north', 'lfivtdir': 'degree', 'lfivtx': 'kg m-1 s-1',
+    'lfivty': 'kg m-1 s-1',
+}
+
+# AR 軸上的点数
+AXIS_POINTS = 16
+
+# 每个 AR 的平均持续时间步数
+MEAN_LIFETIME_STEPS = 12
+
+# 判定登陆用的简化陆地区域：(最小纬度, 最大纬度, 最小经度, 最大经度)
+LAND_BOXES = [
+    (15, 70, 235, 300),   # 北美
+    (-55, 10, 280, 325),  # 南美
+    (35, 70, 0, 40),      # 欧洲
+    (20, 60, 100, 145),   # 东亚
+    (-40, -12, 115, 153),  # 澳大利亚
+]
+
+METERS_PER_DEGREE = 111e3
+
+
+def _on_land(lat, lon):
+    lon = np.mod(lon, 360)
+    return any((lat >= lat0) & (lat <= lat1) & (lon >= lon0) & (lon <= lon1) for lat0, lat1, lon0, lon1 in LAND_BOXES)
+
+
+def generate_tracks(n_times, n_ars, seed=0):
+    """
+    随机生成 AR 的生命周期和运动参数。
+
+    参数:
+    - n_times (int): 时间步数。
+    - n_ars (int): 平均每个时间步同时存在的 AR 个数（AR 密度）。
+    - seed (int): 随机数种子，相同参数生成相同的数据。
+
+    返回:
+    - dict: 每个键为一个参数数组，长度为 AR 总数。
+    """
+    rng = np.random.default_rng(seed)
+    # 生成时刻分布在 [-MEAN_LIFETIME_STEPS, n_times) 内，使每个时间步平均约有 n_ars 个 AR
+    n_total = max(n_ars, int(round(n_ars * (n_times + MEAN_LIFETIME_STEPS) / MEAN_LIFETIME_STEPS)))
+    life = rng.integers(4, 2 * MEAN_LIFETIME_STEPS - 3, n_total)
+    hemisphere = rng.choice([-1, 1], n_total)
+    return {
+        'kid': 100 + np.arange(n_total),
+        'birth': rng.integers(-MEAN_LIFETIME_STEPS, n_times, n_total),
+        'life': life,
+        'lat0': hemisphere * rng.uniform(15, 55, n_total),
+        'lon0': rng.uniform(0, 360, n_total),
+        # 每个时间步的移动距离（度），向东并缓慢向极地移动
+        'dlon': rng.uniform(1, 4, n_total),
+        'dlat': hemisphere * rng.uniform(0, 0.4, n_total),
+        # 軸的方向（度），北半球偏东北，南半球偏东南
+        'angle': hemisphere * rng.uniform(10, 50, n_total),
+        'length': rng.uniform(15, 40, n_total),
+        'aspect': rng.uniform(0.15, 0.3, n_total),
+        'ivt': rng.uniform(400, 1000, n_total),
+    }
+
+
+def _ar_state(tracks, i, t):
+    """第 i 个 AR 在时间步 t 的几何形状，长度和宽度单位为度。"""
+    age = t - tracks['birth'][i]
+    growth = np.sin(np.pi * (age + 1) / (tracks['life'][i] + 1))
+    length = tracks['length'][i] * (0.4 + 0.6 * growth)
+    return {
+        'age': age,
+        'clat': float(np.clip(tracks['lat0'][i] + tracks['dlat'][i] * age, -80, 80)),
+        'clon': float(np.mod(tracks['lon0'][i] + tracks['dlon'][i] * age, 360)),
+        'angle': np.deg2rad(tracks['angle'][i]),
+        'length': length,
+        'width': length * tracks['aspect'][i],
+        'ivt': tracks['ivt'][i] * (0.5 + 0.5 * growth),
+    }
+
+
+def generate_frame(tracks, t, lats, lons, step_seconds):
+    """
+    生成一个时间步的全部变量。
+
+    返回:
+    - dict: 变量名 -> numpy 数组（(lat, lon) 或 (lon,)）。
+    """
+    n_lat, n_lon = len(lats), len(lons)
+    lon_step = lons[1] - lons[0]
+    frame = {name: np.full(n_lon, np.nan, dtype=np.float32) for name in AR_FIELDS}
+    shapemap = np.full((n_lat, n_lon), np.nan, dtype=np.float32)
+    axislon = np.full((n_lat, n_lon), np.nan, dtype=np.float32)
+    axislat = np.full((n_lat, n_lon), np.nan, dtype=np.float32)
+    # 背景 IVT 为随纬度和时间缓慢变化的弱场
+    ivt = (60 + 40 * np.cos(np.deg2rad(lats))[:, None] *
+           (1 + 0.3 * np.sin(np.deg2rad(lons)[None, :] * 3 + t * 0.2))).astype(np.float32)
+
+    active = np.flatnonzero((tracks['birth'] <= t) & (t < tracks['birth'] + tracks['life']))
+    # 槽位按 kid 顺序分配；axislon/axislat 每个槽位占一行，槽位数不超过纬度和经度格点数
+    for slot, i in enumerate(active[:min(n_lon, n_lat)]):
+        state = _ar_state(tracks, i, t)
+        direction = np.array([np.cos(state['angle']), np.sin(state['angle'])])
+        half = state['length'] / 2
+
+        # 只在 AR 外接范围内计算，经度方向按 0°/360° 回绕
+        rows = np.flatnonzero(np.abs(lats - state['clat']) <= half * 1.5)
+        cols = np.mod(np.arange(int(np.floor((state['clon'] - half * 1.5) / lon_step)),
+                                int(np.ceil((state['clon'] + half * 1.5) / lon_step)) + 1), n_lon)
+        if len(rows):
+            dlat = lats[rows][:, None] - state['clat']
+            dlon = (lons[cols][None, :] - state['clon'] + 180) % 360 - 180
+            along = dlon * direction[0] + dlat * direction[1]
+            across = -dlon * direction[1] + dlat * direction[0]
+            distance = (along / half) ** 2 + (across / (state['width'] / 2)) ** 2
+            region = np.ix_(rows, cols)
+            shapemap[region] = np.where(distance <= 1, slot + 1, shapemap[region])
+            ivt[region] += (state['ivt'] * np.exp(-distance)).astype(np.float32)
+
+        along_axis = np.linspace(-half, half, AXIS_POINTS)
+        bend = 0.1 * state['length'] * np.sin(np.pi * (along_axis / half + 1) / 2)
+        axis_lon = np.mod(state['clon'] + along_axis * direction[0] - bend * direction[1], 360)
+        axis_lat = np.clip(state['clat'] + along_axis * direction[1] + bend * direction[0], -90, 90)
+        axislon[slot, :AXIS_POINTS] = axis_lon
+        axislat[slot, :AXIS_POINTS] = axis_lat
+
+        speed = np.hypot(tracks['dlon'][i], tracks['dlat'][i]) * METERS_PER_DEGREE / step_seconds
+        ivtx, ivty = state['ivt'] * direction
+        values = {
+            'length': state['length'] * METERS_PER_DEGREE, 'width': state['width'] * METERS_PER_DEGREE,
+            'klifetime': state['age'] * step_seconds, 'kdist': speed * state['age'] * step_seconds,
+            'kid': tracks['kid'][i], 'kspeed': speed,
+            'kstatus': 0 if state['age'] == 0 else (2 if state['age'] == tracks['life'][i] - 1 else 1),
+            'clon': state['clon'], 'clat': state['clat'], 'ivtx': ivtx, 'ivty': ivty,
+            'hlon': axis_lon[-1], 'hlat': axis_lat[-1], 'tlon': axis_lon[0], 'tlat': axis_lat[0],
+        }
+        if _on_land(axis_lat[-1], axis_lon[-1]):
+            values.update({'lflon': axis_lon[-1], 'lflat': axis_lat[-1],
+                           'lfivtdir': np.rad2deg(state['angle']), 'lfivtx': ivtx, 'lfivty': ivty})
+        for name, value in values.items():
+            frame[name][slot] = value
+
+    frame.update({'shapemap': shapemap, 'ivt': ivt, 'axislon': axislon, 'axislat': axislat})
+    return frame
+
+
+def generate_dataset(n_times=24, n_lat=181, n_lon=360, n_ars=20, seed=0, start='2020-01-01', freq='6h'):
+    """
+    生成惰性的合成数据集，每个时间步在写入或读取时才计算。
+
+    参数:
+    - n_times (int): 时间步数。
+    - n_lat, n_lon (int): 全球规则经纬度网格的格点数，纬度从 -90 到 90，经度从 0 开始。
+    - n_ars (int): 平均每个时间步同时存在的 AR 个数。
+    - seed (int): 随机数种子。
+    - start, freq (str): 起始时间和时间间隔（UTC）。
+
+    返回:
+    - xarray.Dataset
+    """
+    lats = np.linspace(-90, 90, n_lat)
+    lons = np.arange(n_lon) * (360 / n_lon)
+    times = pd.date_range(start, periods=n_times, freq=freq)
+    step_seconds = pd.Timedelta(freq).total_seconds()
+    tracks = generate_tracks(n_times, n_ars, seed)
+
+    frames = [dask.delayed(generate_frame)(tracks, t, lats, lons, step_seconds) for t in range(n_times)]
+    grid_units = {'shapemap': '', 'ivt': 'kg m-1 s-1', 'axislon': 'degrees_east', 'axislat': 'degrees_north'}
+    data_vars = {}
+    for name, units in list(grid_units.items()) + list(AR_FIELDS.items()):
+        shape, dims = ((n_lat, n_lon), ('time', 'lat', 'lon')) if name in grid_units else ((n_lon,), ('time', 'lon'))
+        stacked = dask.array.stack([dask.array.from_delayed(frame[name], shape, dtype=np.float32) for frame in frames])
+        data_vars[name] = xr.Variable(dims, stacked, attrs={'units': units} if units else {})
+    return xr.Dataset(data_vars, coords={'time': times, 'lat': lats, 'lon': lons},
+                      attrs={'title': 'synthetic ERA5/AR test data', 'seed': seed})
+
+
+def write_synthetic(path, n_times=24, n_lat=181, n_lon=360, n_ars=20, seed=0, complevel=1):
+    """
+    生成合成数据并写入 NetCDF 文件，按单个时间步分块压缩。
+
+    返回:
+    - str: 输出路径。
+    """
+    started = time.perf_counter()
+    ds = generate_dataset(n_times, n_lat, n_lon, n_ars, seed)
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = {'dtype': 'float32', 'chunksizes': (1,) + var.shape[1:]}
+        if complevel:
+            encoding[name].update({'zlib': True, 'complevel': complevel})
+    ds.to_netcdf(path, encoding=encoding, format='NETCDF4')
+    print(f"合成数据 {path}: {n_times} 个时间步，{n_lat}x{n_lon} 网格，平均 {n_ars} 个 AR，"
+          f"用时 {time.perf_counter() - started:.1f} 秒")
+    return path
+
+
+def parse_grid(text):
+    """将 '721x1440' 解析为 (721, 1440)。"""
+    n_lat, n_lon = (int(part) for part in text.lower().split('x'))
+    return n_lat, n_lon
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成合成的 ERA5/AR NetCDF 文件')
+    parser.add_argument('path', help='输出文件路径')
+    parser.add_argument('--grid', default='181x360', help='纬度x经度格点数，例如 721x1440')
+    parser.add_argument('--times', type=int, default=24, help='时间步数')
+    parser.add_argument('--ars', type=int, default=20, help='平均每个时间步的 AR 个数')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--complevel', type=int, default=1, help='zlib 压缩级别，0 表示不压缩')
+    args = parser.parse_args()
+    n_lat, n_lon = parse_grid(args.grid)
+    write_synthetic(args.path, args.times, n_lat, n_lon, args.ars, args.seed, args.complevel)
+
+
+if __name__ == '__main__':
+    main()
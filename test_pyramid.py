@@ -0,0 +1,20 @@
+# test_pyramid.py
+import pytest
+
+from pyramid import Pyramid
+
+
+@pytest.mark.parametrize('factor, expected', [
+    (1, (1, 1)),
+    (3, (2, 2)),
+    (5, (4, 2)),
+    (9, (8, 2)),
+])
+def test_select_level(factor, expected):
+    pyramid = Pyramid('unused', {'variables': [], 'levels': [2, 4, 8], 'time_chunk': 64})
+    assert pyramid.select_level(factor) == expected
+
+
+def test_select_level_without_levels():
+    pyramid = Pyramid('unused', {'variables': [], 'levels': [], 'time_chunk': 64})
+    assert pyramid.select_level(3) == (1, 3)
@@ -0,0 +1,352 @@
+# timeseries.py
+"""
+单点、多点和区域的时间序列提取。
+
+数据文件按时间步组织，取一个格点的完整时间序列需要读取每个时间步的整张二维场。
+这里为 (文件, 变量) 建立一份按时间优先排列的副本：形状为 (lat, lon, time) 的 float32
+.npy 文件，以内存映射方式读取。每个格点的时间序列在文件中是连续的一段，
+多点查询用一次花式索引完成，区域平均只读取区域内的行。
+
+副本在第一次查询时提交到后台任务（见 jobs.py）中按时间块建立（内存占用受
+SERIES_BUILD_BLOCK_BYTES 限制），查询请求不等待；建好之前的查询直接用 dask 从数据集
+计算，之后一直复用副本。也可以用命令行预先建立:
+    python timeseries.py ERA5.nc --var ivt --benchmark
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+import xarray as xr
+
+from aggregation import open_in_time_blocks, source_fingerprint
+from data_loader import load_dataset_from_path
+from jobs import JobRunner
+from labels import ar_mask, label_fill_values
+
+# 时间优先副本的存放目录
+SERIES_DIR = os.environ.get('AR_VIS_SERIES_DIR', os.path.join(tempfile.gettempdir(), 'ar_vis_timeseries'))
+
+# 建立副本时每次读入的时间块允许占用的内存（字节）
+SERIES_BUILD_BLOCK_BYTES = 512 * 1024 ** 2
+
+# 区域平均时每次读入的纬度行数上限对应的内存（字节）
+BOX_READ_BYTES = 256 * 1024 ** 2
+
+# 同时在后台建立的副本个数，与文件加载任务分开排队
+SERIES_JOB_WORKERS = 1
+
+
+def _layout_path(series_dir, fingerprint, var_name):
+    return os.path.join(series_dir, f"{fingerprint}_{var_name}.npy")
+
+
+def build_series_layout(source, var_name, path, block_bytes=SERIES_BUILD_BLOCK_BYTES, progress=None):
+    """
+    将 (time, lat, lon) 变量转存为 (lat, lon, time) 的 float32 .npy 文件。
+
+    按时间块读取源数据，转置后写入内存映射文件的对应时间段，完成后原子地替换为
+    正式文件，中断时不会留下不完整的副本。临时文件名各不相同，多个进程同时建立
+    同一副本时互不干扰。
+
+    参数:
+    - source (str): 数据文件或逐帧存储路径。
+    - var_name (str): 变量名。
+    - path (str): 输出的 .npy 路径。
+    - block_bytes (int): 每个时间块允许占用的内存。
+    - progress (callable): 可选，每写完一个时间块以完成比例 (0~1) 调用。
+    """
+    started = time.perf_counter()
+    with open_in_time_blocks(source) as ds:
+        n_times, n_lat, n_lon = (ds.sizes[dim] for dim in ('time', 'lat', 'lon'))
+    block = int(max(1, block_bytes // (n_lat * n_lon * 4)))
+    # 按写入的时间块重新打开，每块只对应一个 dask 任务
+    with open_in_time_blocks(source, time_chunk=block) as ds:
+        da = ds[var_name].transpose('time', 'lat', 'lon')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            values = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32,
+                                               shape=(n_lat, n_lon, n_times))
+            reported = 0
+            for start in range(0, n_times, block):
+                stop = min(start + block, n_times)
+                values[:, :, start:stop] = \
+                    da.isel(time=slice(start, stop)).values.astype(np.float32).transpose(1, 2, 0)
+                if stop * 10 // n_times > reported:
+                    reported = stop * 10 // n_times
+                    print(f"建立 {var_name} 的时间序列副本: {stop}/{n_times} 个时间步")
+                if progress is not None:
+                    progress(stop / n_times)
+            values.flush()
+            del values
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    print(f"时间序列副本 {path} 建立完成，用时 {time.perf_counter() - started:.1f} 秒")
+
+
+class SeriesLayout:
+    """
+    时间优先副本的只读访问接口。坐标索引均为源文件中的 (纬度, 经度) 下标。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.values = np.load(path, mmap_mode='r')
+
+    @property
+    def n_times(self):
+        return self.values.shape[2]
+
+    def points(self, lat_index, lon_index):
+        """
+        多点时间序列。
+
+        参数:
+        - lat_index, lon_index (array-like): 等长的格点下标数组。
+
+        返回:
+        - np.ndarray: (点数, 时间步数)。
+        """
+        return np.asarray(self.values[np.asarray(lat_index), np.asarray(lon_index), :])
+
+    def box_sums(self, lat_slice, lon_slice, indicator=False, fill_values=()):
+        """
+        矩形区域内各时间步的有效值之和与个数（忽略 NaN），按纬度带分批读取以限制内存。
+        indicator 为 True 时对 labels.ar_mask 求和（非 NaN 且不等于 fill_values 的格点），
+        即标签图中被 AR 覆盖的格点数。
+
+        返回:
+        - tuple: (和, 个数)，均为 (时间步数,)。
+        """
+        region = self.values[lat_slice, lon_slice, :]
+        row_bytes = max(1, region.shape[1] * region.shape[2] * 4)
+        rows = int(max(1, BOX_READ_BYTES // row_bytes))
+        total = np.zeros(self.n_times)
+        count = np.zeros(self.n_times)
+        for start in range(0, region.shape[0], rows):
+            band = np.asarray(region[start:start + rows], dtype=np.float64)
+            if indicator:
+                # 标签图中 NaN 和填充值表示没有 AR，按 0 计入
+                band = ar_mask(band, fill_values).astype(np.float64)
+            valid = ~np.isnan(band)
+            total += np.where(valid, band, 0).sum(axis=(0, 1))
+            count += valid.sum(axis=(0, 1))
+        return total, count
+
+
+def _build_layout_job(job, source, var_name, path):
+    """后台任务：建立时间优先副本，按时间块报告进度。"""
+    job.report('series')
+    build_series_layout(source, var_name, path, progress=job.progress)
+
+
+class TimeSeriesCache:
+    """
+    按 (文件指纹, 变量) 管理时间优先副本。
+
+    副本不存在时 layout 把建立过程提交为后台任务并立即返回 None，调用方在副本建好之前
+    改用 dask 计算；副本建好后直接打开。同一副本在一个进程中只提交一个任务，失败的
+    任务不再重试，其后的查询一直使用 dask。
+    """
+
+    def __init__(self, series_dir=SERIES_DIR, runner=None):
+        self.series_dir = series_dir
+        self.runner = runner or JobRunner(max_workers=SERIES_JOB_WORKERS)
+        self._layouts = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _opened(self, key, path):
+        """返回已打开或已在磁盘上的副本，调用方需持有 self._lock。"""
+        layout = self._layouts.get(key)
+        if layout is None and os.path.exists(path):
+            layout = self._layouts[key] = SeriesLayout(path)
+        return layout
+
+    def layout(self, source, var_name):
+        """
+        返回 source 中 var_name 的时间优先副本。source 不是磁盘上的数据，或副本仍在
+        后台建立时返回 None；副本尚未建立时同时提交建立任务。
+        """
+        fingerprint = source_fingerprint(source)
+        if fingerprint is None:
+            return None
+        key = (fingerprint, var_name)
+        path = _layout_path(self.series_dir, fingerprint, var_name)
+        with self._lock:
+            layout = self._opened(key, path)
+            if layout is None:
+                status = self.runner.status(self._jobs.get(key))
+                # 已完成但副本不在磁盘上（例如被清理）或被取消时重新提交
+                if status is None or status['state'] in ('done', 'cancelled'):
+                    self._jobs[key] = self.runner.submit(_build_layout_job, source, var_name, path,
+                                                         variable=var_name)
+            return layout
+
+    def build_job(self, source, var_name):
+        """返回正在建立该副本的后台任务ID，副本已建好或没有任务时返回 None。"""
+        fingerprint = source_fingerprint(source)
+        if fingerprint is None:
+            return None
+        key = (fingerprint, var_name)
+        with self._lock:
+            if self._opened(key, _layout_path(self.series_dir, fingerprint, var_name)) is not None:
+                return None
+            return self._jobs.get(key)
+
+    def build(self, source, var_name):
+        """在当前线程中建立（或直接打开已有的）副本，用于命令行预先建立。"""
+        fingerprint = source_fingerprint(source)
+        if fingerprint is None:
+            return None
+        key = (fingerprint, var_name)
+        path = _layout_path(self.series_dir, fingerprint, var_name)
+        if not os.path.exists(path):
+            build_series_layout(source, var_name, path)
+        with self._lock:
+            return self._opened(key, path)
+
+
+# 进程内共享的时间序列副本管理器
+series_cache = TimeSeriesCache()
+
+
+def nearest_index(coords, values):
+    """返回 values 中每个坐标在一维坐标数组 coords 中最近格点的下标。"""
+    coords = np.asarray(coords, dtype=float)
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    return np.abs(coords[None, :] - values[:, None]).argmin(axis=1)
+
+
+def point_series(ds, var_name, lats, lons, source=None):
+    """
+    提取若干经纬度位置的完整时间序列（取最近格点）。
+
+    source 为磁盘上的文件且时间优先副本已建好时读取副本（首次调用时在后台开始建立）；
+    否则直接从数据集读取。
+
+    返回:
+    - np.ndarray: (点数, 时间步数)。
+    """
+    lat_index = nearest_index(ds.lat.values, lats)
+    lon_index = nearest_index(ds.lon.values, np.mod(lons, 360) if ds.lon.values.min() >= 0 else lons)
+    layout = series_cache.layout(source, var_name)
+    if layout is not None:
+        return layout.points(lat_index, lon_index)
+    da = ds[var_name].isel(lat=xr.DataArray(lat_index, dims='point'), lon=xr.DataArray(lon_index, dims='point'))
+    return np.asarray(da.transpose('point', 'time').values, dtype=np.float32)
+
+
+def transect_series(ds, var_name, start, end, n_points, source=None):
+    """
+    提取从 start 到 end (各为 (纬度, 经度)) 的直线断面上 n_points 个点的时间序列。
+
+    返回:
+    - tuple: (断面上的纬度, 经度, (点数, 时间步数) 的序列)。
+    """
+    lats = np.linspace(start[0], end[0], n_points)
+    lons = np.linspace(start[1], end[1], n_points)
+    return lats, lons, point_series(ds, var_name, lats, lons, source)
+
+
+def _to_dataset_lon(lon, lon_values):
+    """把经度换算到数据集的约定：经度坐标有负值时为 [-180, 180)，否则为 [0, 360)。"""
+    if lon_values.min() < 0:
+        return (lon + 180) % 360 - 180
+    return lon % 360
+
+
+def _box_lon_slices(lon_values, lon_range):
+    """
+    区域在经度方向上的列切片。lon_range 为 (西边界, 东边界)，自西向东；西边界在换算后
+    大于东边界时区域跨过数据集经度的接缝（0° 或 180°），分为两段。
+    """
+    west, east = (_to_dataset_lon(lon, lon_values) for lon in lon_range)
+    if west <= east:
+        masks = [(lon_values >= west) & (lon_values <= east)]
+    else:
+        masks = [lon_values >= west, lon_values <= east]
+    slices = []
+    for mask in masks:
+        cols = np.flatnonzero(mask)
+        if len(cols):
+            slices.append(slice(cols[0], cols[-1] + 1))
+    return slices
+
+
+def box_mean_series(ds, var_name, lat_range, lon_range, source=None, indicator=False):
+    """
+    计算经纬度矩形区域内的区域平均时间序列。
+
+    参数:
+    - lat_range (tuple): (最小值, 最大值)，包含边界上的格点。
+    - lon_range (tuple): (西边界, 东边界)，自西向东，可以跨过 0°/360°（如 (350, 10)）；
+      任意经度约定均可，按数据集的约定换算。
+    - indicator (bool): 为 True 时统计被 AR 覆盖（见 labels.ar_mask：非 NaN 且不等于文件的
+      填充值）的格点比例，用于 shapemap 等标签变量。
+
+    返回:
+    - np.ndarray: (时间步数,)。
+    """
+    lat_values, lon_values = ds.lat.values, ds.lon.values
+    lat_rows = np.flatnonzero((lat_values >= min(lat_range)) & (lat_values <= max(lat_range)))
+    lon_slices = _box_lon_slices(lon_values, lon_range)
+    if not len(lat_rows) or not lon_slices:
+        raise ValueError("区域内没有格点")
+    lat_slice = slice(lat_rows[0], lat_rows[-1] + 1)
+    layout = series_cache.layout(source, var_name)
+    fill_values = label_fill_values(ds[var_name]) if indicator else ()
+    total = np.zeros(ds.sizes['time'])
+    count = np.zeros(ds.sizes['time'])
+    # 跨过接缝的区域分两段求和，再合并为一个平均值
+    for lon_slice in lon_slices:
+        if layout is not None:
+            part_total, part_count = layout.box_sums(lat_slice, lon_slice, indicator, fill_values)
+        else:
+            da = ds[var_name].transpose('time', 'lat', 'lon').isel(lat=lat_slice, lon=lon_slice)
+            if indicator:
+                da = ar_mask(da, fill_values).astype(np.float64)
+            part_total = da.sum(dim=('lat', 'lon'), skipna=True).values
+            part_count = da.notnull().sum(dim=('lat', 'lon')).values
+        total += part_total
+        count += part_count
+    return np.divide(total, count, out=np.full(len(total), np.nan), where=count > 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='为网格变量建立时间优先副本并测试时间序列查询')
+    parser.add_argument('source', help='数据文件或逐帧存储目录')
+    parser.add_argument('--var', required=True, help='(time, lat, lon) 变量名')
+    parser.add_argument('--benchmark', action='store_true', help='建立后测量单点、断面和区域平均查询耗时')
+    args = parser.parse_args()
+
+    ds = load_dataset_from_path(args.source)[0]
+    if ds is None:
+        raise SystemExit(f"无法打开 {args.source}")
+    layout = series_cache.build(args.source, args.var)
+    if not args.benchmark:
+        return
+
+    lats, lons = ds.lat.values, ds.lon.values
+    queries = {
+        '单点': lambda: point_series(ds, args.var, [lats[len(lats) // 2]], [lons[len(lons) // 2]], args.source),
+        '断面 100 点': lambda: transect_series(ds, args.var, (lats[0], lons[0]), (lats[-1], lons[-1]), 100,
+                                             args.source),
+        '区域平均 10%x10%': lambda: box_mean_series(ds, args.var, (lats[0], lats[len(lats) // 10]),
+                                                   (lons[0], lons[len(lons) // 10]), args.source),
+    }
+    for name, query in queries.items():
+        started = time.perf_counter()
+        query()
+        print(f"{name}: {layout.n_times} 个时间步，用时 {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
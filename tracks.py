@@ -0,0 +1,341 @@
+# tracks.py
+"""
+全部时间步的大气河流出现记录索引。
+
+每个时间步的逐 AR 变量 (time, 槽位) 中，kid 不为 NaN 的槽位对应一次 AR 出现。
+加载文件时按时间块做一次向量化扫描，把所有出现记录收集为列式表（每列一个
+numpy 数组，按时间排序），并建立按时间和按 kid 的索引。之后可以直接取出某个
+AR 的完整轨迹、按寿命/长度/登陆区域筛选 AR，或定位其生成和登陆时刻。
+
+同一次扫描还把 AR 軸（axislon/axislat 中每个槽位一行、以 NaN 补齐的折线）存为按
+出现记录偏移索引的不等长数组，并把 shapemap 游程编码为 SparseLabels（见 labels.py）。
+综合图逐帧渲染时直接读取这些紧凑的数组，不再读取稠密的网格和补齐的逐 AR 数组。
+索引以 (文件指纹) 为键缓存在磁盘上，再次打开同一文件时直接读取。
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from aggregation import open_in_time_blocks, source_fingerprint
+from labels import SparseLabels, encode_label_grid, label_fill_values
+
+# 索引的磁盘缓存目录
+TRACK_INDEX_DIR = os.environ.get('AR_VIS_TRACK_DIR', os.path.join(tempfile.gettempdir(), 'ar_vis_tracks'))
+
+# 索引文件的格式版本，列或编码方式改变时递增，旧版本的缓存不再读取
+TRACK_INDEX_VERSION = 4
+
+# 列名 -> 数据集中的变量名
+TRACK_COLUMNS = {
+    'kid': 'kid',
+    'clon': 'clon', 'clat': 'clat',
+    'hlon': 'hlon', 'hlat': 'hlat',
+    'tlon': 'tlon', 'tlat': 'tlat',
+    'lflon': 'lflon', 'lflat': 'lflat',
+    'length': 'length', 'width': 'width',
+    'lifetime': 'klifetime', 'distance': 'kdist',
+    'speed': 'kspeed', 'status': 'kstatus',
+    'ivtx': 'ivtx', 'ivty': 'ivty',
+    'ivt_magnitude': 'ivt_magnitude', 'ivt_direction': 'ivt_direction',
+    'lfivtdir': 'lfivtdir', 'lfivtx': 'lfivtx', 'lfivty': 'lfivty',
+}
+
+# 数据集中的变量名 -> 列名
+VARIABLE_COLUMNS = {var: column for column, var in TRACK_COLUMNS.items()}
+
+# 逐时间步的网格变量：AR 軸折线（每个槽位一行）和 AR 标签场
+AXIS_VARIABLES = ('axislon', 'axislat')
+LABEL_VARIABLE = 'shapemap'
+
+# 扫描时每次读入的时间块允许占用的内存（字节）
+TRACK_SCAN_BLOCK_BYTES = 256 * 1024 ** 2
+
+
+class ARTrackIndex:
+    """
+    AR 出现记录的列式表。
+
+    columns 中每列长度相同，另有 time_index（时间步）和 slot（该时间步中的槽位，
+    即 shapemap 标签减 1）两列。行按 (时间步, 槽位) 排序。
+
+    axes 为 (axis_bounds, axis_lon, axis_lat)：第 r 条记录的 AR 軸为
+    axis_lon[axis_bounds[r]:axis_bounds[r + 1]]；labels 为 shapemap 的 SparseLabels。
+    文件中没有相应变量时两者为 None。n_slots 为逐 AR 变量的槽位数。
+    """
+
+    def __init__(self, columns, n_times, n_slots=None, axes=None, labels=None):
+        self.columns = columns
+        self.n_times = n_times
+        self.n_slots = n_slots
+        self.axis_bounds, self.axis_lon, self.axis_lat = axes if axes is not None else (None, None, None)
+        self.labels = labels
+        # 按时间的索引：第 t 个时间步的记录为 time_bounds[t]:time_bounds[t + 1]
+        self.time_bounds = np.searchsorted(columns['time_index'], np.arange(n_times + 1))
+        # 按 kid 的索引：同一 kid 的记录在 kid_order 中连续，且保持时间顺序
+        self.kid_order = np.argsort(columns['kid'], kind='stable')
+        sorted_kids = columns['kid'][self.kid_order]
+        starts = np.flatnonzero(np.r_[True, sorted_kids[1:] != sorted_kids[:-1]]) if len(sorted_kids) else \
+            np.array([], dtype=int)
+        self.kids = sorted_kids[starts]
+        self.kid_bounds = np.r_[starts, len(sorted_kids)]
+
+    def __len__(self):
+        return len(self.columns['kid'])
+
+    @property
+    def nbytes(self):
+        """索引占用的内存字节数。"""
+        arrays = list(self.columns.values()) + [self.time_bounds, self.kid_order, self.kids, self.kid_bounds]
+        if self.axis_bounds is not None:
+            arrays += [self.axis_bounds, self.axis_lon, self.axis_lat]
+        return sum(array.nbytes for array in arrays) + (self.labels.nbytes if self.labels is not None else 0)
+
+    @property
+    def has_frames(self):
+        """是否保存了逐帧渲染所需的 AR 軸和标签场，可以代替读取稠密的网格。"""
+        return self.n_slots is not None and self.axis_bounds is not None and self.labels is not None
+
+    def rows_at(self, time_index):
+        """某个时间步的记录下标。"""
+        return np.arange(self.time_bounds[time_index], self.time_bounds[time_index + 1])
+
+    def frame_values(self, time_index, names):
+        """
+        按数据集中的变量名取出某个时间步的逐 AR 变量，还原为按槽位排列的数组
+        （没有 AR 的槽位为 NaN），与直接读取 (time, 槽位) 变量的结果相同。
+        """
+        rows = self.rows_at(time_index)
+        slots = self.columns['slot'][rows]
+        values = {}
+        for name in names:
+            column = np.full(self.n_slots, np.nan, dtype=np.float32)
+            column[slots] = self.columns[VARIABLE_COLUMNS[name]][rows]
+            values[name] = column
+        return values
+
+    def axis_at(self, time_index, slot):
+        """某个时间步中一个槽位的 AR 軸 (经度, 纬度)，没有记录时为空数组。"""
+        rows = self.rows_at(time_index)
+        position = int(np.searchsorted(self.columns['slot'][rows], slot))
+        if position >= len(rows) or self.columns['slot'][rows[position]] != slot:
+            empty = np.array([], dtype=np.float32)
+            return empty, empty
+        row = rows[position]
+        points = slice(self.axis_bounds[row], self.axis_bounds[row + 1])
+        return self.axis_lon[points], self.axis_lat[points]
+
+    def track(self, kid):
+        """某个 kid 的全部记录下标（按时间排序），不存在时为空数组。"""
+        position = np.searchsorted(self.kids, kid)
+        if position >= len(self.kids) or self.kids[position] != kid:
+            return np.array([], dtype=int)
+        return self.kid_order[self.kid_bounds[position]:self.kid_bounds[position + 1]]
+
+    def genesis(self, kid):
+        """AR 首次出现的时间步，不存在时返回 None。"""
+        rows = self.track(kid)
+        return int(self.columns['time_index'][rows[0]]) if len(rows) else None
+
+    def landfall(self, kid):
+        """AR 首次登陆的时间步，没有登陆记录时返回 None。"""
+        rows = self.track(kid)
+        landed = rows[~np.isnan(self.columns['lflon'][rows])]
+        return int(self.columns['time_index'][landed[0]]) if len(landed) else None
+
+    def summary(self):
+        """
+        每个 kid 一行的汇总：出现时间步数、生成和消亡时间步、最大长度、最大寿命、
+        是否登陆。全部按 kid_bounds 分段用 reduceat 计算。
+
+        返回:
+        - dict: 列名 -> 数组，行与 self.kids 对应。
+        """
+        if not len(self.kids):
+            empty = np.array([])
+            return {'kid': empty, 'steps': empty, 'first': empty, 'last': empty, 'max_length': empty,
+                    'lifetime': empty, 'landfall': empty.astype(bool)}
+        starts = self.kid_bounds[:-1]
+        ordered = {name: column[self.kid_order] for name, column in self.columns.items()}
+        times = ordered['time_index']
+        return {
+            'kid': self.kids,
+            'steps': np.diff(self.kid_bounds),
+            'first': np.minimum.reduceat(times, starts),
+            'last': np.maximum.reduceat(times, starts),
+            'max_length': np.fmax.reduceat(ordered['length'], starts),
+            'lifetime': np.fmax.reduceat(ordered['lifetime'], starts),
+            'landfall': np.maximum.reduceat((~np.isnan(ordered['lflon'])).astype(np.int8), starts) > 0,
+        }
+
+    def filter(self, min_lifetime=None, min_length=None, landfall_box=None):
+        """
+        按寿命、最大长度和登陆区域筛选 AR。
+
+        参数:
+        - min_lifetime (float): 最小寿命（klifetime 的最大值）。
+        - min_length (float): 最大长度的下限。
+        - landfall_box (tuple): ((最小纬度, 最大纬度), (最小经度, 最大经度))，只保留在该区域内
+          有登陆记录的 AR。
+
+        返回:
+        - np.ndarray: 满足条件的 kid。
+        """
+        summary = self.summary()
+        keep = np.ones(len(self.kids), dtype=bool)
+        if min_lifetime is not None:
+            keep &= summary['lifetime'] >= min_lifetime
+        if min_length is not None:
+            keep &= summary['max_length'] >= min_length
+        if landfall_box is not None:
+            (lat0, lat1), (lon0, lon1) = landfall_box
+            lat, lon = self.columns['lflat'], self.columns['lflon'] % 360
+            inside = (lat >= min(lat0, lat1)) & (lat <= max(lat0, lat1))
+            if lon0 % 360 <= lon1 % 360:
+                inside &= (lon >= lon0 % 360) & (lon <= lon1 % 360)
+            else:
+                # 区域跨过 0° 经线
+                inside &= (lon >= lon0 % 360) | (lon <= lon1 % 360)
+            keep &= np.isin(self.kids, self.columns['kid'][inside])
+        return self.kids[keep]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {f'column_{name}': column for name, column in self.columns.items()}
+        if self.n_slots is not None:
+            arrays['n_slots'] = np.array(self.n_slots)
+        if self.axis_bounds is not None:
+            arrays.update(axis_bounds=self.axis_bounds, axis_lon=self.axis_lon, axis_lat=self.axis_lat)
+        if self.labels is not None:
+            arrays.update(self.labels.to_arrays('labels_'))
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, n_times=self.n_times, **arrays)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            columns = {name[len('column_'):]: data[name] for name in data.files if name.startswith('column_')}
+            axes = (data['axis_bounds'], data['axis_lon'], data['axis_lat']) if 'axis_bounds' in data.files else None
+            labels = SparseLabels.from_arrays(data, 'labels_') if 'labels_run_start' in data.files else None
+            n_slots = int(data['n_slots']) if 'n_slots' in data.files else None
+            return cls(columns, int(data['n_times']), n_slots, axes, labels)
+
+
+def _slot_dim(ds):
+    return next(dim for dim in ds['kid'].dims if dim != 'time')
+
+
+def _grid_variables(ds):
+    """扫描时一并读取的网格变量：AR 軸两个变量齐全时读取，shapemap 存在时读取。"""
+    names = list(AXIS_VARIABLES) if all(name in ds.data_vars for name in AXIS_VARIABLES) else []
+    return names + ([LABEL_VARIABLE] if LABEL_VARIABLE in ds.data_vars else [])
+
+
+def _scan_block(ds, block_bytes):
+    n_vars = sum(var in ds.data_vars for var in TRACK_COLUMNS.values())
+    step_bytes = ds.sizes[_slot_dim(ds)] * 8 * n_vars + sum(ds[name][0].nbytes for name in _grid_variables(ds))
+    return int(max(1, block_bytes // step_bytes))
+
+
+def _ragged_axes(axislon, axislat, times, slots):
+    """
+    取出各条出现记录的 AR 軸，去掉补齐用的尾部 NaN，拼接为不等长数组。
+
+    返回:
+    - tuple: (各记录在拼接数组中的长度, 经度, 纬度)。
+    """
+    n_points = axislon.shape[-1]
+    # 槽位号超出 AR 軸的行数时该记录没有軸
+    has_row = slots < axislon.shape[1]
+    lon = np.full((len(times), n_points), np.nan, dtype=np.float32)
+    lat = np.full((len(times), n_points), np.nan, dtype=np.float32)
+    lon[has_row] = axislon[times[has_row], slots[has_row]]
+    lat[has_row] = axislat[times[has_row], slots[has_row]]
+    valid = ~np.isnan(lon)
+    lengths = np.where(valid.any(axis=1), n_points - np.argmax(valid[:, ::-1], axis=1), 0)
+    keep = np.arange(n_points) < lengths[:, None]
+    return lengths, lon[keep], lat[keep]
+
+
+def build_track_index(ds, block_bytes=TRACK_SCAN_BLOCK_BYTES, progress=None):
+    """
+    对数据集做一次按时间块的向量化扫描，建立 AR 出现记录索引。
+
+    参数:
+    - ds (xarray.Dataset): 含 kid 等逐 AR 变量的数据集。
+    - block_bytes (int): 每个时间块允许占用的内存。
+    - progress: 每读完一个时间块以已完成的比例调用一次，可在其中抛出异常中止扫描。
+
+    返回:
+    - ARTrackIndex，数据集中没有 kid 变量时返回 None。
+    """
+    if 'kid' not in ds.data_vars:
+        return None
+    names = {column: var for column, var in TRACK_COLUMNS.items() if var in ds.data_vars}
+    grid_names = _grid_variables(ds)
+    slot_dim = _slot_dim(ds)
+    n_times = ds.sizes['time']
+    block = _scan_block(ds, block_bytes)
+
+    started = time.perf_counter()
+    parts = {column: [] for column in list(TRACK_COLUMNS) + ['time_index', 'slot']}
+    axis_parts = ([], [], [])
+    label_frames = []
+    for start in range(0, n_times, block):
+        frame = ds[list(names.values()) + grid_names].isel(time=slice(start, start + block)).compute()
+        grids = {name: frame[name].transpose('time', ...).values for name in grid_names}
+        frame = frame[list(names.values())].transpose('time', slot_dim)
+        kid = frame['kid'].values
+        # 每个时间步中 kid 有效的槽位即为一次 AR 出现，按 (时间步, 槽位) 的顺序取出
+        times, slots = np.nonzero(~np.isnan(kid))
+        parts['time_index'].append((times + start).astype(np.int32))
+        parts['slot'].append(slots.astype(np.int32))
+        for column in TRACK_COLUMNS:
+            if column in names:
+                parts[column].append(frame[names[column]].values[times, slots].astype(np.float32))
+            else:
+                parts[column].append(np.full(len(times), np.nan, dtype=np.float32))
+        if 'axislon' in grids:
+            for part, values in zip(axis_parts, _ragged_axes(grids['axislon'], grids['axislat'], times, slots)):
+                part.append(values)
+        if LABEL_VARIABLE in grids:
+            # 行的顺序与综合图中的标签场相同（shapemap[::-1, :]）
+            fill_values = label_fill_values(ds[LABEL_VARIABLE])
+            label_frames += [encode_label_grid(grid[::-1, :], fill_values) for grid in grids[LABEL_VARIABLE]]
+        if progress is not None:
+            progress(min(start + block, n_times) / n_times)
+
+    columns = {column: np.concatenate(values) for column, values in parts.items()}
+    axes = None
+    if axis_parts[0]:
+        lengths, axis_lon, axis_lat = (np.concatenate(values) for values in axis_parts)
+        axes = (np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64), axis_lon, axis_lat)
+    labels = None
+    if label_frames:
+        labels = SparseLabels.from_frames(label_frames, ds[LABEL_VARIABLE].transpose('time', ...).shape[1:])
+    index = ARTrackIndex(columns, n_times, ds.sizes[slot_dim], axes, labels)
+    print(f"AR 轨迹索引：{len(index)} 条出现记录，{len(index.kids)} 个 AR，"
+          f"{index.nbytes / 1024 ** 2:.1f} MB，用时 {time.perf_counter() - started:.1f} 秒")
+    return index
+
+
+def load_track_index(ds, source=None, progress=None):
+    """
+    返回数据集的 AR 轨迹索引；source 为磁盘上的文件时优先读取缓存，否则扫描后写入缓存。
+    progress 的含义同 build_track_index。
+    """
+    if 'kid' not in ds.data_vars:
+        return None
+    fingerprint = source_fingerprint(source)
+    path = os.path.join(TRACK_INDEX_DIR, f"{fingerprint}.v{TRACK_INDEX_VERSION}.npz") if fingerprint else None
+    if path is not None and os.path.exists(path):
+        return ARTrackIndex.load(path)
+    if path is None:
+        return build_track_index(ds, progress=progress)
+    # 按扫描的时间块重新打开文件，每块只对应一个 dask 任务
+    with open_in_time_blocks(source, time_chunk=_scan_block(ds, TRACK_SCAN_BLOCK_BYTES)) as blocked:
+        index = build_track_index(blocked, progress=progress)
+    index.save(path)
+    return index